@@ -1,6 +1,19 @@
 # simple b-tree implementation
+import heapq
+import importlib
+import itertools
+import os
+import pickle
+import struct
+import tempfile
+import threading
+from bisect import bisect_left, bisect_right
 from typing import Union, Tuple
 
+heapdb = importlib.import_module("heap-db")
+
+PAGE_SIZE = heapdb.PAGE_SIZE
+
 # make a type for B_plus_Tree_Node
 B_plus_Tree_Node = object
 
@@ -12,7 +25,9 @@ class B_plus_Tree_Node(object):
         self.min_nodes = min_nodes
         self.max_nodes = max_nodes
         self.is_leaf = is_leaf
-        
+        # leaves are chained in key order, so range scans can walk across them
+        self.prev_leaf = None
+        self.next_leaf = None
 
 
     def insert(self, key, value) -> Union[Tuple[B_plus_Tree_Node, B_plus_Tree_Node], B_plus_Tree_Node]:
@@ -27,43 +42,28 @@ class B_plus_Tree_Node(object):
 
         # find a leaf type node, while keeping a call stack of parent calls in case we need to cascade splits
         if not self.is_leaf:
-            k_idx = -1
-            for i, k_node in enumerate(self.keys):
-                if key < k_node:
-                    k_idx = i
-                    break
-            n_idx = k_idx if k_idx != -1 else len(self.keys)
-            print(f"inserting {key} into child {n_idx}. k_idx was {k_idx}")
+            # the first separator greater than key, i.e. keys >= a separator go to its right
+            n_idx = bisect_right(self.keys, key)
             ret = self.children[n_idx].insert(key, value)
             if isinstance(ret, tuple):
                 # we can use an isinstance check for if a split occurred
                 # importantly, this could be a leaf split or an internal split
                 # but, we know the current node is an internal node, so we can safely use the result
                 median_key, left_node = ret
-                if median_key == 32 and left_node.keys == [20,21]:
-                    breakpoint()
-                self.keys.insert(k_idx if k_idx != -1 else len(self.keys), median_key)
+                self.keys.insert(n_idx, median_key)
                 self.children.insert(n_idx, left_node)
                 if len(self.keys) > self.max_nodes:
-                    median_key, left_node = self.split_internal()
-                    # create a new root node
-                    new_root = B_plus_Tree_Node(is_leaf=False)
-                    new_root.keys = [median_key]
-                    new_root.children = [left_node, self]
-                    return new_root
+                    # pass the split up to our parent, the tree makes a new root if we are the root
+                    return self.split_internal()
                 return self
             # if not, there was no split, just keep cascading the return up the callstack
             return ret
         
         # if we reach here, we're in a leaf node
-        k_idx = -1
-        for i, k_node in enumerate(self.keys):
-            if key < k_node:
-                k_idx = i
-                break
-        n_idx = k_idx + 1 if k_idx != -1 else len(self.keys)
+        n_idx = bisect_right(self.keys, key)
         
-        self.keys.insert(k_idx if k_idx != -1 else len(self.keys), key)
+        # keys and vals have to stay aligned
+        self.keys.insert(n_idx, key)
         self.vals.insert(n_idx, value)
          
         if len(self.keys) > self.max_nodes:
@@ -82,7 +82,7 @@ class B_plus_Tree_Node(object):
         median_value = self.keys[median_idx]
         
         # Create new left internal node
-        left_node = B_plus_Tree_Node(is_leaf=False)
+        left_node = B_plus_Tree_Node(self.min_nodes, self.max_nodes, is_leaf=False)
         left_node.keys = self.keys[:median_idx]  # Exclude median!
         left_node.children = self.children[:median_idx + 1]
         
@@ -97,7 +97,7 @@ class B_plus_Tree_Node(object):
         Split the node into two new nodes.
         """
         # make the current node the right, and create a new left node   
-        left = B_plus_Tree_Node()
+        left = B_plus_Tree_Node(self.min_nodes, self.max_nodes)
         # for example if we have 5 keys, median will be index 2
         # so left slice should be 0, 1, and right slice should be 2, 3, 4
         median_idx = len(self.keys) // 2
@@ -107,8 +107,85 @@ class B_plus_Tree_Node(object):
         # preserve median in the current node
         self.keys = self.keys[median_idx:]
         self.vals = self.vals[median_idx:]
+        # the new left leaf goes between us and our old left neighbour
+        left.prev_leaf, left.next_leaf = self.prev_leaf, self
+        if self.prev_leaf is not None:
+            self.prev_leaf.next_leaf = left
+        self.prev_leaf = left
         return median_key, left 
 
+    def delete(self, key) -> bool:
+        """
+        Remove one entry for key from this subtree, returning whether there was one.
+
+        Like insert this recurses down to the leaf, and on the way back up each parent fixes a
+        child left with fewer than min_nodes keys, by borrowing from or merging with a sibling.
+        The node itself may be left underfull, for its own parent to fix.
+        """
+        i = bisect_left(self.keys, key)
+        if self.is_leaf:
+            if i < len(self.keys) and self.keys[i] == key:
+                del self.keys[i]
+                del self.vals[i]
+                return True
+            return False
+        # equal keys can be either side of a separator after a split, so look left first
+        while not self.children[i].delete(key):
+            if i == len(self.keys) or self.keys[i] != key:
+                return False
+            i += 1
+        if len(self.children[i].keys) < self.min_nodes:
+            self.rebalance(i)
+        return True
+
+    def rebalance(self, c_idx):
+        """
+        Bring the underfull child at c_idx back to min_nodes keys: borrow one from a sibling
+        that can spare it, or else merge it with one. Merging needs max_nodes >= 2 * min_nodes.
+        """
+        child = self.children[c_idx]
+        left = self.children[c_idx - 1] if c_idx > 0 else None
+        right = self.children[c_idx + 1] if c_idx < len(self.keys) else None
+        if left is not None and len(left.keys) > self.min_nodes:
+            if child.is_leaf:
+                child.keys.insert(0, left.keys.pop())
+                child.vals.insert(0, left.vals.pop())
+                self.keys[c_idx - 1] = child.keys[0]
+            else:
+                # rotate through the parent: the separator comes down, left's last key goes up
+                child.keys.insert(0, self.keys[c_idx - 1])
+                child.children.insert(0, left.children.pop())
+                self.keys[c_idx - 1] = left.keys.pop()
+        elif right is not None and len(right.keys) > self.min_nodes:
+            if child.is_leaf:
+                child.keys.append(right.keys.pop(0))
+                child.vals.append(right.vals.pop(0))
+                self.keys[c_idx] = right.keys[0]
+            else:
+                child.keys.append(self.keys[c_idx])
+                child.children.append(right.children.pop(0))
+                self.keys[c_idx] = right.keys.pop(0)
+        else:
+            self.merge(c_idx - 1 if left is not None else c_idx)
+
+    def merge(self, k_idx):
+        """
+        Merge the child right of separator k_idx into the one left of it, dropping the
+        separator (internal nodes pull it down between their keys).
+        """
+        left, right = self.children[k_idx], self.children[k_idx + 1]
+        if left.is_leaf:
+            left.keys += right.keys
+            left.vals += right.vals
+            left.next_leaf = right.next_leaf
+            if right.next_leaf is not None:
+                right.next_leaf.prev_leaf = left
+        else:
+            left.keys += [self.keys[k_idx]] + right.keys
+            left.children += right.children
+        del self.keys[k_idx]
+        del self.children[k_idx + 1]
+
     def pprint(self):
         """
         Pretty print the tree in a nice ascii-type format.
@@ -134,29 +211,758 @@ class B_plus_Tree(object):
     
     And lets us make a new root node when we need to.
     """
+    node_type = B_plus_Tree_Node
+
     def __init__(self, min_nodes = 2, max_nodes = 4):
-        self.root = B_plus_Tree_Node(min_nodes, max_nodes, is_leaf=True)
-    
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self.root = self.node_type(min_nodes, max_nodes, is_leaf=True)
+
+    @classmethod
+    def bulk_load(cls, sorted_items, fill_factor=1.0, min_nodes=2, max_nodes=4):
+        """
+        Build a tree from (key, value) pairs already in key order, bottom up in one pass,
+        instead of inserting them one at a time.
+
+        Leaves are filled to fill_factor of max_nodes keys, then each level of internal nodes
+        is built over the one below, with the first key under each child as its separator.
+        If the last node on a level would be underfull it shares with its neighbour.
+        """
+        tree = cls(min_nodes, max_nodes)
+        per_leaf = max(min_nodes, min(max_nodes, int(max_nodes * fill_factor)))
+        leaves = []
+        for key, value in sorted_items:
+            if not leaves or len(leaves[-1].keys) == per_leaf:
+                leaves.append(cls.node_type(min_nodes, max_nodes))
+            leaves[-1].keys.append(key)
+            leaves[-1].vals.append(value)
+        if not leaves:
+            return tree
+        if len(leaves) > 1 and len(leaves[-1].keys) < min_nodes:
+            left, right = leaves[-2], leaves[-1]
+            keys, vals = left.keys + right.keys, left.vals + right.vals
+            if len(keys) <= max_nodes:
+                left.keys, left.vals = keys, vals
+                leaves.pop()
+            else:
+                half = len(keys) // 2
+                left.keys, left.vals, right.keys, right.vals = keys[:half], vals[:half], keys[half:], vals[half:]
+        for left, right in zip(leaves, leaves[1:]):
+            left.next_leaf, right.prev_leaf = right, left
+        level, firsts = leaves, [leaf.keys[0] for leaf in leaves]
+        per_node = max(min_nodes, min(max_nodes, int(max_nodes * fill_factor))) + 1
+        while len(level) > 1:
+            groups = [range(i, min(i + per_node, len(level))) for i in range(0, len(level), per_node)]
+            if len(groups) > 1 and len(groups[-1]) < min_nodes + 1:
+                # an internal node needs min_nodes + 1 children
+                start, end = groups[-2].start, groups[-1].stop
+                half = start + (end - start) // 2
+                groups[-2:] = [range(start, end)] if end - start <= max_nodes + 1 else [range(start, half), range(half, end)]
+            parents = []
+            for group in groups:
+                node = cls.node_type(min_nodes, max_nodes, is_leaf=False)
+                node.children = level[group.start:group.stop]
+                node.keys = firsts[group.start + 1:group.stop]
+                parents.append(node)
+            level, firsts = parents, [firsts[group.start] for group in groups]
+        tree.root = level[0]
+        return tree
+
+    @classmethod
+    def bulk_load_unsorted(cls, items, fill_factor=1.0, min_nodes=2, max_nodes=4, run_size=1_000_000):
+        """
+        bulk_load (key, value) pairs in any order, sorting them with external_sort first.
+        """
+        return cls.bulk_load(external_sort(items, key=lambda item: item[0], run_size=run_size), fill_factor, min_nodes, max_nodes)
+
     def insert(self, key, value):
         ret = self.root.insert(key, value)
         if isinstance(ret, tuple):
-            # handle the case where we need to create a new root node
+            # the root split (leaf or internal), so grow the tree by one level
             median_key, left_node = ret
-            if not self.root.children:
-                new_root = B_plus_Tree_Node(is_leaf=False)
-                new_root.keys = [ median_key]
-                new_root.children = [left_node, self.root]
-                self.root = new_root
-                return self.root
-            else:
-                print("this is weird.")
-                raise Exception("this is weird.")
+            new_root = self.node_type(self.min_nodes, self.max_nodes, is_leaf=False)
+            new_root.keys = [median_key]
+            new_root.children = [left_node, self.root]
+            self.root = new_root
+            return self.root
         return ret
+
+    def delete(self, key) -> bool:
+        """
+        Remove one entry for key, returning whether there was one. If the root is left with a
+        single child, that child becomes the root and the tree is one level shorter.
+        """
+        deleted = self.root.delete(key)
+        if not self.root.is_leaf and not self.root.keys:
+            self.root = self.root.children[0]
+        return deleted
+
+    def search(self, key):
+        """
+        Return the value stored for key, or None if it isn't in the tree.
+        """
+        node = self.root
+        while not node.is_leaf:
+            # same routing as insert: keys >= a separator live to its right
+            node = node.children[bisect_right(node.keys, key)]
+        i = bisect_left(node.keys, key)
+        if i < len(node.keys) and node.keys[i] == key:
+            return node.vals[i]
+        return None
+
+    def seek(self, key, strict=False):
+        """
+        (leaf, index) of the first entry with a key >= key (> key if strict), or (None, 0)
+        if there isn't one. None seeks to the first entry.
+        """
+        bound = bisect_right if strict else bisect_left
+        node = self.root
+        while not node.is_leaf:
+            # equal keys can be either side of a separator after a split, so for >= go left
+            node = node.children[0 if key is None else bound(node.keys, key)]
+        i = 0 if key is None else bound(node.keys, key)
+        while node is not None and i == len(node.keys):
+            node = node.next_leaf
+            i = 0 if node is None or key is None else bound(node.keys, key)
+        return node, i
+
+    def lower_bound(self, key):
+        """
+        The first (key, value) with a key >= key, or None.
+        """
+        node, i = self.seek(key)
+        return None if node is None else (node.keys[i], node.vals[i])
+
+    def upper_bound(self, key):
+        """
+        The first (key, value) with a key > key, or None.
+        """
+        node, i = self.seek(key, strict=True)
+        return None if node is None else (node.keys[i], node.vals[i])
+
+    def range(self, lo=None, hi=None, inclusive=True):
+        """
+        Generator of the (key, value) pairs between lo and hi in key order. It finds lo from
+        the root once and then walks the chain of leaves. None leaves that end open, and
+        inclusive is a bool for both ends or a (lo, hi) pair of them.
+        """
+        lo_inclusive, hi_inclusive = inclusive if isinstance(inclusive, tuple) else (inclusive, inclusive)
+        node, i = self.seek(lo, strict=not lo_inclusive)
+        while node is not None:
+            keys = node.keys
+            if hi is None:
+                end = len(keys)
+            else:
+                end = bisect_right(keys, hi, i) if hi_inclusive else bisect_left(keys, hi, i)
+            yield from zip(keys[i:end], node.vals[i:end])
+            if end < len(keys):
+                return
+            node, i = node.next_leaf, 0
+
+    def items(self, lo=None, hi=None):
+        """
+        (key, value) pairs with lo <= key <= hi, in key order. None leaves that end open.
+        """
+        return self.range(lo, hi)
+
+    def __iter__(self):
+        return self.range()
     
     def pprint(self):
         self.root.pprint()
 
 
+class RWLatch(object):
+    """
+    A reader/writer latch: any number of readers or one writer. Waiting writers hold off new
+    readers, so a stream of readers can't starve them.
+    """
+    def __init__(self):
+        # the uncontended paths only take the mutex, and only wait or notify when they have to
+        self.mutex = threading.Lock()
+        self.cond = threading.Condition(self.mutex)
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        with self.mutex:
+            while self.writer or self.waiting_writers:
+                self.waiting += 1
+                self.cond.wait()
+                self.waiting -= 1
+            self.readers += 1
+
+    def release_read(self):
+        with self.mutex:
+            self.readers -= 1
+            if not self.readers and self.waiting:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.mutex:
+            while self.writer or self.readers:
+                self.waiting += 1
+                self.waiting_writers += 1
+                self.cond.wait()
+                self.waiting -= 1
+                self.waiting_writers -= 1
+            self.writer = True
+
+    def release_write(self):
+        with self.mutex:
+            self.writer = False
+            if self.waiting:
+                self.cond.notify_all()
+
+
+class Latched_B_plus_Tree_Node(B_plus_Tree_Node):
+    def __init__(self, min_nodes = 2, max_nodes = 4, is_leaf = True):
+        super().__init__(min_nodes, max_nodes, is_leaf)
+        self.latch = RWLatch()
+
+
+class Concurrent_B_plus_Tree(B_plus_Tree):
+    """
+    A B_plus_Tree that many threads can search, scan, insert into and delete from at once.
+
+    Every node has a reader/writer latch, and operations crab down the tree: latch the child,
+    then let go of the parent. Readers only ever hold read latches. An insert first goes down
+    optimistically with read latches and write latches just the leaf, which is enough unless
+    the leaf is full; then it starts over holding write latches on the path, letting go of
+    everything above a node that has room, since a split can't go past it. A split is only
+    visible once it's done, because anything that can reach the nodes involved has to get
+    past a latch the insert holds.
+
+    Unlike B_plus_Tree, nodes split to the right, so a key never moves to a node to the left
+    of where it was. A range scan can then let go of a leaf before latching the next one
+    without missing anything, and doesn't hold a latch while the caller has its rows.
+
+    Deletes don't crab: borrowing and merging change siblings that scans on the leaf chain
+    latch in the other direction. Instead every other operation holds a tree wide latch in
+    read mode, and a delete takes it in write mode and runs B_plus_Tree.delete alone. A range
+    scan only holds it while it reads a leaf, and if a delete ran while it was between leaves,
+    it finds its place again from the root. That place is the last key it yielded and how many
+    entries with that key, so deleting entries equal to that key can make it skip or repeat
+    one of them.
+    """
+    node_type = Latched_B_plus_Tree_Node
+
+    def __init__(self, min_nodes = 2, max_nodes = 4):
+        super().__init__(min_nodes, max_nodes)
+        # guards the root pointer, which changes when the root splits
+        self.root_latch = RWLatch()
+        # shared by everything but deletes, which have the tree to themselves
+        self.tree_latch = RWLatch()
+        self.deletes = 0
+        self.restarts = 0
+
+    def descend(self, key, bound):
+        """
+        The read latched leaf where key would be, routing with bound (bisect_left or
+        bisect_right) at each level. None goes to the first leaf.
+        """
+        self.root_latch.acquire_read()
+        node = self.root
+        node.latch.acquire_read()
+        self.root_latch.release_read()
+        while not node.is_leaf:
+            child = node.children[0 if key is None else bound(node.keys, key)]
+            child.latch.acquire_read()
+            node.latch.release_read()
+            node = child
+        return node
+
+    def search(self, key):
+        """
+        Return the value stored for key, or None if it isn't in the tree.
+        """
+        self.tree_latch.acquire_read()
+        node = self.descend(key, bisect_right)
+        try:
+            i = bisect_left(node.keys, key)
+            return node.vals[i] if i < len(node.keys) and node.keys[i] == key else None
+        finally:
+            node.latch.release_read()
+            self.tree_latch.release_read()
+
+    def range(self, lo=None, hi=None, inclusive=True):
+        """
+        Generator of the (key, value) pairs between lo and hi in key order, like
+        B_plus_Tree.range. Each leaf's matches are copied under its read latch, so this sees
+        every key that was in the range for the whole scan, plus maybe some inserted or deleted
+        during it.
+        """
+        lo_inclusive, hi_inclusive = inclusive if isinstance(inclusive, tuple) else (inclusive, inclusive)
+        start = bisect_left if lo_inclusive else bisect_right
+        node, deletes = None, None
+        # the last key yielded, and how many entries with it, to start over from after a delete
+        last, seen = None, 0
+        while True:
+            self.tree_latch.acquire_read()
+            if node is None or self.deletes != deletes:
+                if node is not None and seen:
+                    lo, start = last, bisect_left
+                node, deletes, skip = self.descend(lo, start), self.deletes, seen
+            else:
+                node.latch.acquire_read()
+            keys = node.keys
+            i = 0 if lo is None else start(keys, lo)
+            if hi is None:
+                end = len(keys)
+            else:
+                end = max(i, bisect_right(keys, hi) if hi_inclusive else bisect_left(keys, hi))
+            items = list(zip(keys[i:end], node.vals[i:end]))
+            next_leaf = node.next_leaf if end == len(keys) else None
+            node.latch.release_read()
+            self.tree_latch.release_read()
+            if skip:
+                # entries equal to last were already yielded before starting over
+                n = 0
+                while n < min(skip, len(items)) and items[n][0] == last:
+                    n += 1
+                items, skip = items[n:], skip - n if n == len(items) else 0
+            yield from items
+            if items:
+                n = 1
+                while n < len(items) and items[-n - 1][0] == items[-1][0]:
+                    n += 1
+                seen = n + seen if n == len(items) and items[-1][0] == last else n
+                last = items[-1][0]
+            if next_leaf is None:
+                return
+            node = next_leaf
+
+    def lower_bound(self, key):
+        return next(self.range(key), None)
+
+    def upper_bound(self, key):
+        return next(self.range(key, inclusive=(False, True)), None)
+
+    def delete(self, key) -> bool:
+        """
+        Remove one entry for key, returning whether there was one, with every other operation
+        shut out while it does.
+        """
+        self.tree_latch.acquire_write()
+        try:
+            deleted = super().delete(key)
+            if deleted:
+                self.deletes += 1
+            return deleted
+        finally:
+            self.tree_latch.release_write()
+
+    def insert(self, key, value):
+        self.tree_latch.acquire_read()
+        try:
+            if not self.insert_optimistic(key, value):
+                self.restarts += 1
+                self.insert_pessimistic(key, value)
+        finally:
+            self.tree_latch.release_read()
+
+    def insert_optimistic(self, key, value) -> bool:
+        """
+        Read latch down to the leaf and write latch only that. Returns False, having changed
+        nothing, if the leaf is full and would split.
+        """
+        self.root_latch.acquire_read()
+        node = self.root
+        node.latch.acquire_write() if node.is_leaf else node.latch.acquire_read()
+        self.root_latch.release_read()
+        while not node.is_leaf:
+            # a node never stops being a leaf or becomes one, so is_leaf is safe to read unlatched
+            child = node.children[bisect_right(node.keys, key)]
+            child.latch.acquire_write() if child.is_leaf else child.latch.acquire_read()
+            node.latch.release_read()
+            node = child
+        try:
+            if len(node.keys) >= self.max_nodes:
+                return False
+            i = bisect_right(node.keys, key)
+            node.keys.insert(i, key)
+            node.vals.insert(i, value)
+            return True
+        finally:
+            node.latch.release_write()
+
+    def insert_pessimistic(self, key, value):
+        """
+        Write latch the path down to the leaf, keeping latches only from the lowest node with
+        room for another key, then insert and split back up as far as needed.
+        """
+        self.root_latch.acquire_write()
+        holds_root = True
+        node = self.root
+        node.latch.acquire_write()
+        # the write latched nodes, and where each is among its parent's children
+        path, c_idxs = [node], [None]
+        while not node.is_leaf:
+            c_idx = bisect_right(node.keys, key)
+            child = node.children[c_idx]
+            child.latch.acquire_write()
+            if len(child.keys) < self.max_nodes:
+                # child won't split, so nothing above it will change
+                if holds_root:
+                    self.root_latch.release_write()
+                    holds_root = False
+                for held in path:
+                    held.latch.release_write()
+                path, c_idxs = [], []
+            path.append(child)
+            c_idxs.append(c_idx)
+            node = child
+        try:
+            i = bisect_right(node.keys, key)
+            node.keys.insert(i, key)
+            node.vals.insert(i, value)
+            for depth in range(len(path) - 1, -1, -1):
+                node = path[depth]
+                if len(node.keys) <= self.max_nodes:
+                    break
+                median_key, right = self.split_right(node)
+                if depth:
+                    # the parent has been latched all along, so node is still where it was
+                    parent, c_idx = path[depth - 1], c_idxs[depth]
+                    parent.keys.insert(c_idx, median_key)
+                    parent.children.insert(c_idx + 1, right)
+                else:
+                    # only possible if the root was never let go of
+                    new_root = self.node_type(self.min_nodes, self.max_nodes, is_leaf=False)
+                    new_root.keys = [median_key]
+                    new_root.children = [node, right]
+                    self.root = new_root
+        finally:
+            for held in path:
+                held.latch.release_write()
+            if holds_root:
+                self.root_latch.release_write()
+
+    def split_right(self, node) -> Tuple[int, B_plus_Tree_Node]:
+        """
+        Split node, keeping the lower half in it and moving the upper half to a new right
+        sibling. Returns the separator and the new node.
+        """
+        median_idx = len(node.keys) // 2
+        right = self.node_type(self.min_nodes, self.max_nodes, is_leaf=node.is_leaf)
+        if node.is_leaf:
+            median_key = node.keys[median_idx]
+            right.keys, right.vals = node.keys[median_idx:], node.vals[median_idx:]
+            node.keys, node.vals = node.keys[:median_idx], node.vals[:median_idx]
+            # right is complete before node links to it. the old next leaf's prev_leaf is only
+            # read by check_tree, so it doesn't need that leaf's latch
+            right.prev_leaf, right.next_leaf = node, node.next_leaf
+            if node.next_leaf is not None:
+                node.next_leaf.prev_leaf = right
+            node.next_leaf = right
+        else:
+            median_key = node.keys[median_idx]
+            right.keys, right.children = node.keys[median_idx + 1:], node.children[median_idx + 1:]
+            node.keys, node.children = node.keys[:median_idx], node.children[:median_idx + 1]
+        return median_key, right
+
+
+def external_sort(items, key=None, run_size=1_000_000):
+    """
+    Sort a stream that might not fit in memory: sort it run_size items at a time, spill each
+    sorted run to a temporary file, and merge the runs. Stable, like sorted(). A stream that
+    fits in one run never touches the disk.
+    """
+    it = iter(items)
+    runs = []
+    try:
+        while True:
+            run = sorted(itertools.islice(it, run_size), key=key)
+            if not runs and len(run) < run_size:
+                yield from run
+                return
+            if not run:
+                break
+            f = tempfile.TemporaryFile()
+            for i in range(0, len(run), 10_000):
+                pickle.dump(run[i:i + 10_000], f, pickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+            runs.append(f)
+            del run
+        # merge prefers earlier runs on ties, which keeps it stable
+        yield from heapq.merge(*map(read_run, runs), key=key)
+    finally:
+        for f in runs:
+            f.close()
+
+
+def read_run(f):
+    while True:
+        try:
+            yield from pickle.load(f)
+        except EOFError:
+            return
+
+
+# a disk resident B+ tree: every node is a PAGE_SIZE page of an index file, read through a
+# heap-db.py BufferPool only when a search or insert gets to it, so opening an index just
+# reads its header and the tree can be far bigger than memory.
+#
+#   header page 0   magic, root page, height, number of entries, key type ('q' int or 's' str)
+#   node pages      is_leaf u8, unused u8, num_keys u16, next leaf page u32 (0 for none),
+#                   then the keys (int64s, or a length byte + UTF-8 each), then for a leaf one
+#                   (page_idx, row_idx) RID per key, for an internal node num_keys + 1 child pages
+#
+# a node splits when it no longer fits in its page, so the fanout follows from the page size
+# (511 RIDs per leaf and 682 children per internal node with int keys).
+
+DISK_HEADER = struct.Struct("<8sIIQc")
+DISK_MAGIC = b"BPTREE01"
+NODE_HEADER = struct.Struct("<BxHI")
+KEY_TYPES = {int: b"q", str: b"s"}
+
+
+class DiskNode(object):
+    def __init__(self, page_idx, is_leaf, keys=None, vals=None, children=None, next_leaf=0):
+        self.page_idx = page_idx
+        self.is_leaf = is_leaf
+        self.keys = keys if keys is not None else []
+        # a leaf's RIDs, flattened to page_idx, row_idx, page_idx, ... so they pack in one go
+        self.vals = vals if vals is not None else []
+        self.children = children if children is not None else []
+        self.next_leaf = next_leaf
+
+
+class DiskBPlusTree(object):
+    """
+    A B+ tree of key -> (page_idx, row_idx) RIDs kept in an index file, for int or str keys
+    (strings up to 255 bytes). A key can have any number of RIDs.
+
+    Nodes are decoded from the pool's page frames on every visit rather than kept as objects,
+    so memory use is just the pool's. Leaves are chained left to right for range scans.
+    search and items have the same shape as build_index's in-memory trees in db-query.py
+    (a list of RIDs per key), so either works with IndexScan and IndexNestedLoopJoin.
+
+    Changes reach the file when their pages are evicted from the pool, or on flush()/close().
+    An existing index file is opened as it is, unless create starts it over empty.
+    """
+    def __init__(self, path, key_type=int, pool=None, create=False):
+        self.path = path
+        self.own_pool = pool is None
+        self.pool = pool or heapdb.BufferPool(256)
+        if create or not os.path.exists(path) or os.path.getsize(path) == 0:
+            heapdb.invalidate_pools(path)
+            with open(path, "wb") as f:
+                f.write(DISK_HEADER.pack(DISK_MAGIC, 1, 1, 0, KEY_TYPES[key_type]).ljust(PAGE_SIZE, b"\0"))
+                f.write(NODE_HEADER.pack(1, 0, 0).ljust(PAGE_SIZE, b"\0"))
+        with self.pool.page(path, 0) as data:
+            magic, self.root, self.height, self.num_entries, code = DISK_HEADER.unpack_from(data)
+        if magic != DISK_MAGIC:
+            raise ValueError(f"{path} isn't a B+ tree index")
+        self.key_type = str if code == b"s" else int
+
+    def __len__(self):
+        return self.num_entries
+
+    def read_node(self, page_idx) -> DiskNode:
+        with self.pool.page(self.path, page_idx) as data:
+            is_leaf, n, next_leaf = NODE_HEADER.unpack_from(data)
+            pos = NODE_HEADER.size
+            if self.key_type is int:
+                keys = list(struct.unpack_from(f"<{n}q", data, pos))
+                pos += 8 * n
+            else:
+                keys = []
+                for _ in range(n):
+                    length = data[pos]
+                    keys.append(bytes(data[pos + 1:pos + 1 + length]).decode("utf-8"))
+                    pos += 1 + length
+            if is_leaf:
+                vals = list(struct.unpack_from(f"<{2 * n}I", data, pos))
+                return DiskNode(page_idx, True, keys, vals, next_leaf=next_leaf)
+            children = list(struct.unpack_from(f"<{n + 1}I", data, pos))
+            return DiskNode(page_idx, False, keys, children=children)
+
+    def encode_node(self, node) -> bytes:
+        parts = [NODE_HEADER.pack(node.is_leaf, len(node.keys), node.next_leaf)]
+        if self.key_type is int:
+            parts.append(struct.pack(f"<{len(node.keys)}q", *node.keys))
+        else:
+            for key in node.keys:
+                b = key.encode("utf-8")
+                if len(b) > 255:
+                    raise ValueError(f"Key too long to index: {key!r}")
+                parts += (bytes((len(b),)), b)
+        if node.is_leaf:
+            parts.append(struct.pack(f"<{len(node.vals)}I", *node.vals))
+        else:
+            parts.append(struct.pack(f"<{len(node.children)}I", *node.children))
+        return b"".join(parts)
+
+    def write_node(self, node, data=None):
+        data = data if data is not None else self.encode_node(node)
+        buf = self.pool.fetch(self.path, node.page_idx)
+        buf[:len(data)] = data
+        buf[len(data):] = bytes(PAGE_SIZE - len(data))
+        self.pool.unpin(self.path, node.page_idx, dirty=True)
+
+    def new_node(self, is_leaf) -> DiskNode:
+        page_idx, _ = self.pool.new_page(self.path)
+        self.pool.unpin(self.path, page_idx)
+        return DiskNode(page_idx, is_leaf)
+
+    def write_header(self):
+        data = self.pool.fetch(self.path, 0)
+        DISK_HEADER.pack_into(data, 0, DISK_MAGIC, self.root, self.height, self.num_entries, KEY_TYPES[self.key_type])
+        self.pool.unpin(self.path, 0, dirty=True)
+
+    def find_leaf(self, key) -> DiskNode:
+        """
+        The leftmost leaf that could hold key (or, for None, the leftmost leaf).
+        """
+        node = self.read_node(self.root)
+        while not node.is_leaf:
+            # equal keys can be left of a separator after a split, so go left of it
+            node = self.read_node(node.children[0 if key is None else bisect_left(node.keys, key)])
+        return node
+
+    def search(self, key):
+        """
+        The list of RIDs stored under key, or None if it isn't in the tree.
+        """
+        for _, rids in self.items(key, key):
+            return rids
+        return None
+
+    def items(self, lo=None, hi=None):
+        """
+        (key, [RIDs]) for each key with lo <= key <= hi, in key order, walking the chain of
+        leaves from the first one in range. None leaves that end open.
+        """
+        node = self.find_leaf(lo)
+        i = 0 if lo is None else bisect_left(node.keys, lo)
+        key, rids = None, []
+        while True:
+            while i < len(node.keys):
+                k = node.keys[i]
+                if hi is not None and k > hi:
+                    if rids:
+                        yield key, rids
+                    return
+                if rids and k != key:
+                    yield key, rids
+                    rids = []
+                key = k
+                rids.append((node.vals[2 * i], node.vals[2 * i + 1]))
+                i += 1
+            if not node.next_leaf:
+                break
+            node, i = self.read_node(node.next_leaf), 0
+        if rids:
+            yield key, rids
+
+    def insert(self, key, rid):
+        split = self.insert_into(self.root, key, tuple(rid))
+        if split is not None:
+            # the root split, so the tree grows a level
+            separator, right = split
+            root = self.new_node(is_leaf=False)
+            root.keys, root.children = [separator], [self.root, right]
+            self.write_node(root)
+            self.root = root.page_idx
+            self.height += 1
+        self.num_entries += 1
+
+    def insert_into(self, page_idx, key, rid):
+        """
+        Insert below the node at page_idx. Returns (separator, right page) if it split.
+        """
+        node = self.read_node(page_idx)
+        i = bisect_right(node.keys, key)
+        if node.is_leaf:
+            node.keys.insert(i, key)
+            node.vals[2 * i:2 * i] = rid
+        else:
+            split = self.insert_into(node.children[i], key, rid)
+            if split is None:
+                return None
+            node.keys.insert(i, split[0])
+            node.children.insert(i + 1, split[1])
+        data = self.encode_node(node)
+        if len(data) <= PAGE_SIZE:
+            self.write_node(node, data)
+            return None
+        return self.split(node)
+
+    def split(self, node):
+        """
+        Move the upper half of an overfull node into a new right sibling.
+        """
+        right = self.new_node(node.is_leaf)
+        mid = len(node.keys) // 2
+        if node.is_leaf:
+            # the separator is copied up, and stays in the right leaf
+            separator = node.keys[mid]
+            right.keys, right.vals = node.keys[mid:], node.vals[2 * mid:]
+            node.keys, node.vals = node.keys[:mid], node.vals[:2 * mid]
+            right.next_leaf, node.next_leaf = node.next_leaf, right.page_idx
+        else:
+            # the separator moves up
+            separator = node.keys[mid]
+            right.keys, right.children = node.keys[mid + 1:], node.children[mid + 1:]
+            node.keys, node.children = node.keys[:mid], node.children[:mid + 1]
+        self.write_node(node)
+        self.write_node(right)
+        return separator, right.page_idx
+
+    def flush(self):
+        self.write_header()
+        self.pool.flush(self.path)
+
+    def close(self):
+        self.flush()
+        if self.own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def check_tree(tree) -> int:
+    """
+    Assert the B+ tree invariants: keys in order and within their separators, every leaf at
+    the same depth, every node but the root between min_nodes and max_nodes keys, and the
+    leaves chained in order.
+    Returns the height.
+    """
+    depths = set()
+
+    def walk(node, lo, hi, depth):
+        assert node.keys == sorted(node.keys)
+        assert all((lo is None or lo <= k) and (hi is None or k <= hi) for k in node.keys)
+        if node is not tree.root:
+            assert tree.min_nodes <= len(node.keys) <= tree.max_nodes, (len(node.keys), node.keys)
+        elif not node.is_leaf:
+            # deletes shrink a root down to one child into that child
+            assert 1 <= len(node.keys) <= tree.max_nodes
+        if node.is_leaf:
+            assert len(node.vals) == len(node.keys)
+            depths.add(depth)
+            leaves.append(node)
+            return
+        assert len(node.children) == len(node.keys) + 1
+        bounds = [lo] + node.keys + [hi]
+        for i, child in enumerate(node.children):
+            walk(child, bounds[i], bounds[i + 1], depth + 1)
+    leaves = []
+    walk(tree.root, None, None, 1)
+    assert len(depths) == 1
+    # the leaf chain links the leaves in order, both ways
+    assert leaves[0].prev_leaf is None and leaves[-1].next_leaf is None
+    assert all(a.next_leaf is b and b.prev_leaf is a for a, b in zip(leaves, leaves[1:]))
+    return depths.pop()
+
+
 def __main__():
     tree = B_plus_Tree()
     print("Initial tree state:")
@@ -179,5 +985,243 @@ def __main__():
         print("Tree state after inserting test data:")
         tree.pprint()
 
+    for age, rid in test_data.items():
+        assert tree.search(age) == rid, (age, tree.search(age), rid)
+    assert tree.search(19) is None
+
+    # enough keys to split internal nodes a few levels up
+    import random
+    keys = list(range(1000))
+    random.shuffle(keys)
+    big = B_plus_Tree()
+    for k in keys:
+        big.insert(k, (k // 100, k % 100))
+    for k in keys:
+        assert big.search(k) == (k // 100, k % 100), k
+    assert big.search(1000) is None
+    assert [k for k, _ in big.items()] == list(range(1000))
+    assert [k for k, _ in big.items(250, 260)] == list(range(250, 261))
+    assert [k for k, _ in big.items(hi=3)] == [0, 1, 2, 3]
+    assert [k for k, _ in big.items(995.5)] == [996, 997, 998, 999]
+    assert list(big.items(2000)) == []
+
+    # range scans walk the leaf chain, which splits have to keep in order
+    check_tree(big)
+    assert [k for k, _ in big] == list(range(1000))
+    assert big.lower_bound(250) == (250, (2, 50)) and big.upper_bound(250) == (251, (2, 51))
+    assert big.lower_bound(250.5)[0] == 251 and big.lower_bound(-1)[0] == 0
+    assert big.lower_bound(1000) is None and big.upper_bound(999) is None
+    assert [k for k, _ in big.range(250, 253, inclusive=False)] == [251, 252]
+    assert [k for k, _ in big.range(250, 253, inclusive=(True, False))] == [250, 251, 252]
+    assert [k for k, _ in big.range(250, 253, inclusive=(False, True))] == [251, 252, 253]
+    assert [k for k, _ in big.range(250, 250)] == [250] and list(big.range(250, 250, False)) == []
+    assert list(big.range(300, 200)) == [] and [k for k, _ in big.range(lo=998)] == [998, 999]
+    # many equal keys end up spread over several leaves
+    dups = B_plus_Tree()
+    for i, k in enumerate([5] * 20 + list(range(10)) + [5] * 20):
+        dups.insert(k, i)
+    check_tree(dups)
+    assert [v for _, v in dups.range(5, 5)] == list(range(20)) + [25] + list(range(30, 50))
+    assert dups.upper_bound(5)[0] == 6 and [k for k, _ in dups.range(4, 6, False)] == [5] * 41
+    for lo, hi in ((k, k + random.randrange(50)) for k in random.sample(range(-10, 1000), 200)):
+        assert [k for k, _ in big.range(lo, hi, (False, False))] == list(range(max(lo + 1, 0), min(hi, 1000)))
+
+    # bulk loading: the same tree contents as inserting, with every node full enough
+    for n in (0, 1, 3, 4, 5, 17, 100, 1_001):
+        for fill_factor in (0.5, 0.75, 1.0):
+            for min_nodes, max_nodes in ((2, 4), (2, 5), (32, 64)):
+                items = [(k, (k // 100, k % 100)) for k in range(n)]
+                loaded = B_plus_Tree.bulk_load(items, fill_factor, min_nodes, max_nodes)
+                check_tree(loaded)
+                assert list(loaded.items()) == items, (n, fill_factor, min_nodes, max_nodes)
+                assert all(loaded.search(k) == v for k, v in items[::7])
+    loaded = B_plus_Tree.bulk_load(((k, k) for k in range(0, 2_000, 2)), 0.5)
+    inserted = list(range(1, 2_000, 2))
+    random.shuffle(inserted)
+    for k in inserted:
+        loaded.insert(k, k)
+    check_tree(loaded)
+    assert [k for k, _ in loaded.items()] == list(range(2_000))
+    # packed leaves, where inserting random keys leaves them about 3/4 full
+    def count_leaves(node):
+        return 1 if node.is_leaf else sum(map(count_leaves, node.children))
+    assert count_leaves(B_plus_Tree.bulk_load(((k, k) for k in range(1_000))).root) == 250 < count_leaves(big.root)
+    # unsorted input gets sorted on disk first, keeping duplicates in their input order
+    pairs = [(random.randrange(500), i) for i in range(5_000)]
+    assert list(external_sort(pairs, key=lambda x: x[0], run_size=300)) == sorted(pairs, key=lambda x: x[0])
+    assert list(external_sort(pairs, run_size=10_000)) == sorted(pairs)
+    unsorted = B_plus_Tree.bulk_load_unsorted(((k, str(k)) for k in keys), 0.75, run_size=100)
+    check_tree(unsorted)
+    assert list(unsorted.items()) == [(k, str(k)) for k in range(1_000)]
+
+    # deletes: random inserts and deletes against a dict, with the tree balanced, its nodes
+    # within bounds and its height what that occupancy allows the whole way through
+    import math
+    rng = random.Random(0)
+    for min_nodes, max_nodes in ((2, 4), (2, 5), (3, 6), (8, 16)):
+        tree, oracle = B_plus_Tree(min_nodes, max_nodes), {}
+        for step in range(6_000):
+            # grow for a while, then shrink back to empty
+            if rng.random() < (0.7 if step < 3_000 else 0.25) or not oracle:
+                k = rng.randrange(2_000)
+                if k not in oracle:
+                    oracle[k] = step
+                    tree.insert(k, step)
+            else:
+                k = rng.choice(list(oracle)) if rng.random() < 0.9 else rng.randrange(2_000, 3_000)
+                assert tree.delete(k) == (k in oracle), k
+                oracle.pop(k, None)
+            if step % 97 == 0 or len(oracle) < 3:
+                height = check_tree(tree)
+                n = len(oracle)
+                # a root with 2 children, min_nodes + 1 below that, and min_nodes keys per leaf
+                assert n < 2 * min_nodes or height <= 2 + math.log(n / (2 * min_nodes), min_nodes + 1), (n, height)
+                assert list(tree) == sorted(oracle.items())
+        assert not oracle or list(tree) == sorted(oracle.items())
+        while oracle:
+            k = oracle.popitem()[0]
+            assert tree.delete(k) and tree.search(k) is None
+        assert check_tree(tree) == 1 and list(tree) == [] and not tree.delete(0)
+    # deleting equal keys spread over several leaves
+    for k in [5] * 41:
+        assert dups.delete(5)
+        check_tree(dups)
+    assert not dups.delete(5) and [k for k, _ in dups] == [k for k in range(10) if k != 5]
+    # and a bulk loaded tree, which starts out packed
+    packed = B_plus_Tree.bulk_load(((k, k) for k in range(1_000)))
+    for k in range(0, 1_000, 3):
+        assert packed.delete(k)
+    check_tree(packed)
+    assert [k for k, _ in packed] == [k for k in range(1_000) if k % 3]
+
+    # a range scan that a delete gets in the middle of finds its place again, without
+    # repeating or missing anything that's still there
+    chained = Concurrent_B_plus_Tree(2, 4)
+    for i, k in enumerate([1] * 10 + [2] * 10 + [3] * 10):
+        chained.insert(k, i)
+    scan = chained.range(1, 3)
+    got = [next(scan) for _ in range(13)]
+    for k in (1, 1, 3):
+        assert chained.delete(k)
+    got += list(scan)
+    assert [v for _, v in got] == list(range(20)) + list(range(21, 30)) and chained.deletes == 3
+    rng = random.Random(1)
+    for _ in range(100):
+        chained = Concurrent_B_plus_Tree(2, 4)
+        for k in sorted(rng.sample(range(100), 60)):
+            chained.insert(k, -k)
+        scan = chained.range(10, 80)
+        got = [next(scan) for _ in range(rng.randrange(1, 30))]
+        deleted = {k for k in rng.sample(range(100), 30) if chained.delete(k)}
+        rest = [k for k, _ in scan]
+        # what's left of the leaf the scan was reading had already been copied, so deleted
+        # keys can still turn up, but everything else has to, once
+        remaining = [k for k, _ in chained.range(got[-1][0], 80, inclusive=(False, True))]
+        assert rest == sorted(set(rest)) and [k for k in rest if k not in deleted] == remaining
+        check_tree(chained)
+
+    # the concurrent tree: writers insert odd keys and delete the even keys that aren't
+    # multiples of 4, while readers check that the multiples of 4 loaded up front are all
+    # there, in order, every time they look
+    import sys
+    switch_interval = sys.getswitchinterval()
+    # switch threads far more often than usual, so splits get interrupted part way
+    sys.setswitchinterval(1e-6)
+    shared = Concurrent_B_plus_Tree(2, 4)
+    evens = list(range(0, 8_000, 2))
+    for k in evens:
+        shared.insert(k, -k)
+    kept = list(range(0, 8_000, 4))
+    errors, writing = [], threading.Event()
+
+    def write(t):
+        odds = list(range(2 * t + 1, 8_000, 10))
+        random.Random(t).shuffle(odds)
+        for k in odds:
+            shared.insert(k, -k)
+
+    def delete():
+        doomed = list(range(2, 8_000, 4))
+        random.Random(-1).shuffle(doomed)
+        for k in doomed:
+            assert shared.delete(k)
+
+    def read(t):
+        rng = random.Random(100 + t)
+        try:
+            # keep reading for as long as the writers are splitting nodes
+            while writing.is_set():
+                lo = rng.randrange(8_000)
+                hi = lo + rng.randrange(200)
+                got = [k for k, _ in shared.range(lo, hi)]
+                assert got == sorted(set(got)), got
+                assert [k for k in got if k % 4 == 0] == list(range(lo + -lo % 4, min(hi + 1, 8_000), 4)), (lo, hi)
+                k = rng.choice(kept)
+                assert shared.search(k) == -k and shared.lower_bound(k) == (k, -k)
+        except AssertionError as e:
+            errors.append(e)
+
+    def hammer(writers):
+        readers = [threading.Thread(target=read, args=(t,)) for t in range(4)]
+        writing.set()
+        for t in readers + writers:
+            t.start()
+        for t in writers:
+            t.join()
+        writing.clear()
+        for t in readers:
+            t.join()
+    # inserts alone first, since deletes hold everything else up and readers get fewer looks
+    # at splits in progress, then deletes with the last of the inserts
+    hammer([threading.Thread(target=write, args=(t,)) for t in range(4)])
+    hammer([threading.Thread(target=write, args=(4,)), threading.Thread(target=delete)])
+    sys.setswitchinterval(switch_interval)
+    assert not errors, errors[0]
+    check_tree(shared)
+    assert list(shared) == [(k, -k) for k in range(8_000) if k % 4 != 2] and shared.restarts > 0 and shared.deletes == 2_000
+
+    # the disk resident tree: same answers as a dict, nodes only read when needed, and
+    # reopening it is just reading the header
+    import tempfile
+    import time
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "ids.idx")
+        keys = list(range(30_000))
+        random.shuffle(keys)
+        with DiskBPlusTree(path, pool=heapdb.BufferPool(64)) as disk:
+            for k in keys:
+                disk.insert(k, (k // 100, k % 100))
+            # duplicate keys keep every RID, in insertion order
+            disk.insert(500, (7, 7))
+            disk.insert(500, (8, 8))
+            assert disk.search(500) == [(5, 0), (7, 7), (8, 8)]
+            assert disk.height == 2
+        start = time.perf_counter()
+        disk = DiskBPlusTree(path)
+        opened = time.perf_counter() - start
+        # one page read, the header, however big the tree is
+        assert disk.pool.misses == 1 and len(disk) == 30_002
+        assert disk.search(4_321) == [(43, 21)] and disk.pool.misses == 1 + disk.height
+        for k in keys[:2_000]:
+            assert disk.search(k) == ([(k // 100, k % 100)] if k != 500 else [(5, 0), (7, 7), (8, 8)]), k
+        assert disk.search(-1) is None and disk.search(30_000) is None
+        assert [k for k, _ in disk.items(29_990)] == list(range(29_990, 30_000))
+        assert [k for k, _ in disk.items(hi=2)] == [0, 1, 2]
+        assert [k for k, _ in disk.items()] == list(range(30_000))
+        disk.close()
+        print(f"disk tree: {os.path.getsize(path) // PAGE_SIZE} pages, opened in {opened * 1e3:.2f} ms")
+
+        names = DiskBPlusTree(os.path.join(d, "names.idx"), key_type=str)
+        titles = [f"Movie {i}" for i in range(5_000)]
+        random.shuffle(titles)
+        for i, title in enumerate(titles):
+            names.insert(title, (i, 0))
+        names.close()
+        names = DiskBPlusTree(os.path.join(d, "names.idx"))
+        assert names.key_type is str and [k for k, _ in names.items()] == sorted(titles)
+        assert names.search(titles[123]) == [(123, 0)] and names.search("Movie") is None
+        names.close()
+    print("ok")
+
 if __name__ == "__main__":
     __main__()
@@ -0,0 +1,756 @@
+# benchmarks for the little database in db-query.py / heap-db.py
+# run one with e.g. `python db-bench.py batch --rows 200000`
+# movies.csv isn't checked in, so we generate a movies-shaped CSV (movieId,title,genres) to
+# whatever size we need and ingest it into a heap file in a temp directory.
+
+import argparse
+import bisect
+import csv
+import importlib
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+btree = importlib.import_module("b-tree-index")
+dbq = importlib.import_module("db-query")
+heapdb = importlib.import_module("heap-db")
+heapseg = importlib.import_module("heap-segments")
+heapwal = importlib.import_module("heap-wal")
+
+MOVIE_SCHEMA = (
+    ('movieId', int),
+    ('title', str),
+    ('genres', str),
+)
+GENRES = (
+    "Adventure|Animation|Children|Comedy|Fantasy",
+    "Adventure|Children|Fantasy",
+    "Comedy|Romance",
+    "Comedy|Drama|Romance",
+    "Comedy",
+    "Action|Crime|Thriller",
+    "Drama",
+    "Documentary",
+    "Horror|Thriller",
+    "(no genres listed)",
+)
+
+
+def make_movies_csv(path, n_rows, seed=0):
+    rng = random.Random(seed)
+    with open(path, "w", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(("movieId", "title", "genres"))
+        for i in range(1, n_rows + 1):
+            w.writerow((i, f"Movie number {i} ({rng.randint(1920, 2024)})", rng.choice(GENRES)))
+    return path
+
+
+def make_movies_hf(dir_path, n_rows):
+    csv_path = make_movies_csv(os.path.join(dir_path, "movies.csv"), n_rows)
+    hf_path = os.path.join(dir_path, "movies.hf")
+    hf = heapdb.HeapFile(csv_path, dict(MOVIE_SCHEMA))
+    hf.ingest_from_csv()
+    hf.write_to_disk(hf_path)
+    return hf_path
+
+
+def timed(fn, repeat=1):
+    """
+    Run fn repeat times, returning its result and the best wall clock time.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ret = fn()
+        best = min(best, time.perf_counter() - start)
+    return ret, best
+
+
+def report(label, n_rows, secs):
+    print(f"{label:<40} {n_rows:>10} rows {secs:8.3f}s {n_rows / secs:>14,.0f} rows/s")
+
+
+def bench_batch(args):
+    """
+    Row-at-a-time vs. batch-at-a-time execution of the same plans.
+    """
+    rows = [(i, f"Movie number {i}", GENRES[i % len(GENRES)]) for i in range(args.rows)]
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        plans = {
+            "memory scan": lambda: dbq.Q(dbq.MemoryScan(rows)),
+            "memory select+project": lambda: dbq.Q(
+                dbq.Projection(lambda x: (x[0], x[1])),
+                dbq.Selection(lambda x: x[2] == "Comedy"),
+                dbq.MemoryScan(rows),
+            ),
+            "file scan": lambda: dbq.Q(dbq.FileScanner(hf_path, MOVIE_SCHEMA)),
+            "file select+project": lambda: dbq.Q(
+                dbq.Projection(lambda x: (x[0], x[1])),
+                dbq.Selection(lambda x: x[2] == "Comedy"),
+                dbq.FileScanner(hf_path, MOVIE_SCHEMA),
+            ),
+        }
+        for name, plan in plans.items():
+            out, secs = timed(lambda: sum(1 for _ in dbq.run(plan())))
+            report(f"{name} (row)", args.rows, secs)
+            out_b, secs = timed(lambda: sum(1 for _ in dbq.run(plan(), batch_size=args.batch_size)))
+            assert out == out_b
+            report(f"{name} (batch={args.batch_size})", args.rows, secs)
+
+
+def bench_parallel(args):
+    """
+    Serial FileScanner vs. ParallelScan + Gather with the selection/projection pushed down.
+    """
+    select, proj = (lambda x: "Comedy" in x[2]), (lambda x: (x[0], x[1]))
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        serial, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(
+            dbq.Projection(proj), dbq.Selection(select), dbq.FileScanner(hf_path, MOVIE_SCHEMA),
+        ))))
+        report("serial scan", args.rows, secs)
+        for workers in args.workers:
+            for ordered in (False, True):
+                out, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(
+                    dbq.Gather(ordered=ordered),
+                    dbq.ParallelScan(hf_path, MOVIE_SCHEMA, workers=workers, predicate=select, proj=proj),
+                ))))
+                assert out == serial
+                report(f"parallel scan workers={workers}{' ordered' if ordered else ''}", args.rows, secs)
+
+
+def bench_mmap(args):
+    """
+    read() based FileScanner vs. the mmap/memoryview one over a large heap file.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        print(f"heap file: {os.path.getsize(hf_path) / 1e6:.0f} MB")
+        for name, scanner in (("read", dbq.FileScanner), ("mmap", dbq.MmapFileScanner)):
+            for batch_size in (None, dbq.BATCH_SIZE):
+                n, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(scanner(hf_path, MOVIE_SCHEMA)), batch_size=batch_size)), args.repeat)
+                assert n == args.rows
+                report(f"{name} scan{' (batched)' if batch_size else ''}", n, secs)
+
+
+def interpreted_encode(schema, record):
+    """
+    The per-column loop RecordWrapper.encode used before the schema compiled RecordCodec.
+    """
+    data = b""
+    for (_, type), value in zip(schema, record):
+        if type == int:
+            data += type(value).to_bytes(4, "little")
+        elif type == str:
+            bs = value.encode("utf-8")
+            data += len(bs).to_bytes(1, "little") + bs
+    return data
+
+
+def interpreted_decode(schema, data):
+    record = []
+    idx = 0
+    for _, type in schema:
+        if type == int:
+            value = int.from_bytes(data[idx:idx+4], "little")
+            idx += 4
+        elif type == str:
+            length = int.from_bytes(data[idx:idx+1], "little")
+            value = data[idx+1:idx+length+1].decode("utf-8")
+            idx += length + 1
+        record.append(value)
+    return tuple(record)
+
+
+def bench_codec(args):
+    """
+    Interpreted vs. schema compiled record encode/decode, then end to end ingest and scan.
+    """
+    rows = [(str(i), f"Movie number {i} (1995)", GENRES[i % len(GENRES)]) for i in range(args.rows)]
+    codec = heapdb.RecordCodec(MOVIE_SCHEMA)
+    encoded, secs = timed(lambda: [interpreted_encode(MOVIE_SCHEMA, r) for r in rows], args.repeat)
+    report("encode (interpreted)", args.rows, secs)
+    encoded_c, secs = timed(lambda: [codec.encode(r) for r in rows], args.repeat)
+    report("encode (compiled)", args.rows, secs)
+    assert encoded == encoded_c
+    decoded, secs = timed(lambda: [interpreted_decode(MOVIE_SCHEMA, e) for e in encoded], args.repeat)
+    report("decode (interpreted)", args.rows, secs)
+    decoded_c, secs = timed(lambda: [codec.decode(e) for e in encoded], args.repeat)
+    report("decode (compiled)", args.rows, secs)
+    assert decoded == decoded_c
+
+    with tempfile.TemporaryDirectory() as d:
+        csv_path = make_movies_csv(os.path.join(d, "movies.csv"), args.rows)
+        hf_path = os.path.join(d, "movies.hf")
+
+        def ingest():
+            hf = heapdb.HeapFile(csv_path, dict(MOVIE_SCHEMA))
+            hf.ingest_from_csv()
+            hf.write_to_disk(hf_path)
+        _, secs = timed(ingest, args.repeat)
+        report("movies.csv ingest", args.rows, secs)
+        _, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(dbq.FileScanner(hf_path, MOVIE_SCHEMA)))), args.repeat)
+        report("movies.hf scan", args.rows, secs)
+
+
+def bench_columnar(args):
+    """
+    A selective filter on movieId over the row heap file vs. vectorized over the PAX file.
+    """
+    lo, hi = args.rows // 2, args.rows // 2 + args.rows // 100
+    select = dbq.And(dbq.Compare(0, ">=", lo), dbq.Compare(0, "<", hi))
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        pax_path = os.path.join(d, "movies.pax")
+        heapdb.row_to_columnar(hf_path, pax_path, MOVIE_SCHEMA)
+        print(f"row file {os.path.getsize(hf_path) / 1e6:.1f} MB, pax file {os.path.getsize(pax_path) / 1e6:.1f} MB")
+        n, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(
+            dbq.Selection(select), dbq.FileScanner(hf_path, MOVIE_SCHEMA),
+        ))), args.repeat)
+        report("row scan + Selection", args.rows, secs)
+        n_vec, secs = timed(lambda: sum(map(dbq.vector_len, dbq.run_vectors(dbq.Q(
+            dbq.Selection(select), dbq.ColumnarScanner(pax_path, MOVIE_SCHEMA, columns={0}),
+        )))), args.repeat)
+        assert n == n_vec == hi - lo
+        report("pax scan + vectorized Selection", args.rows, secs)
+
+
+def peak_rss(fn):
+    """
+    Run fn in a forked child and return its peak RSS in MB, so each run is measured on its
+    own rather than against the high water mark of everything before it.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            fn()
+        finally:
+            os._exit(0)
+    _, status, usage = os.wait4(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    # ru_maxrss is in KB on Linux
+    return usage.ru_maxrss / 1024
+
+
+def bench_ingest(args):
+    """
+    In memory ingest + write_to_disk vs. the streaming bulk load, at movies.csv's size (9742
+    rows in MovieLens' small dataset) and bigger.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = os.path.join(d, "movies.hf")
+
+        def in_memory(csv_path):
+            hf = heapdb.HeapFile(csv_path, dict(MOVIE_SCHEMA))
+            hf.ingest_from_csv()
+            hf.write_to_disk(hf_path)
+
+        def streaming(csv_path):
+            heapdb.HeapFile(csv_path, dict(MOVIE_SCHEMA)).ingest_from_csv(hf_path)
+
+        runs = []
+        for n_rows in args.rows:
+            csv_path = make_movies_csv(os.path.join(d, f"movies-{n_rows}.csv"), n_rows)
+            for name, fn in (("in memory", in_memory), ("streaming", streaming)):
+                runs.append((name, n_rows, csv_path, fn))
+        # measure every RSS before timing anything, since freed memory stays in this process
+        # and a forked child starts out with all of it
+        print(f"baseline peak RSS {peak_rss(lambda: None):.1f} MB")
+        rss = [peak_rss(lambda: fn(csv_path)) for _, _, csv_path, fn in runs]
+        for (name, n_rows, csv_path, fn), mb_rss in zip(runs, rss):
+            mb = os.path.getsize(csv_path) / 1e6
+            _, secs = timed(lambda: fn(csv_path), args.repeat)
+            print(f"{name:<10} {n_rows:>10} rows {mb:8.1f} MB csv {secs:8.3f}s {mb / secs:8.1f} MB/s  peak RSS {mb_rss:8.1f} MB")
+
+
+def bench_update(args):
+    """
+    Changing records by rebuilding the heap file in memory and rewriting it vs. in place
+    through a HeapTable.
+    """
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        rids = [rid for rid, _ in dbq.FileScanner(hf_path, MOVIE_SCHEMA).iter_rids()]
+        print(f"heap file: {os.path.getsize(hf_path) // heapdb.PAGE_SIZE} pages")
+
+        def rewrite():
+            hf = heapdb.HeapFile(hf_path, dict(MOVIE_SCHEMA))
+            hf.read_from_disk(hf_path)
+            page_idx, row_idx = rng.choice(rids)
+            hf.pages[page_idx].delete_record(row_idx)
+            hf.append((0, "Updated", "Drama"))
+            hf.write_to_disk(hf_path)
+        _, secs = timed(rewrite, args.repeat)
+        print(f"{'rewrite the file':<40} {secs * 1e3:10.2f} ms/update")
+
+        pool = heapdb.BufferPool(256)
+        with heapdb.HeapTable(hf_path, MOVIE_SCHEMA, pool=pool) as table:
+            writes = pool.writes
+            start = time.perf_counter()
+            for _ in range(args.updates):
+                table.update(rng.choice(rids), (0, "Updated", "Drama"))
+                table.flush()
+            secs = time.perf_counter() - start
+            print(f"{'HeapTable.update + flush':<40} {secs / args.updates * 1e3:10.2f} ms/update"
+                  f" {(pool.writes - writes) / args.updates:6.2f} pages written/update")
+
+
+def bench_wal(args):
+    """
+    Commits/sec of single row inserts from several threads, each waiting for its commit to be
+    durable, with group commit on and off. Runs in --dir, since a tmpfs fsync costs nothing.
+    """
+    for threads in args.threads:
+        for group_commit in (False, True):
+            with tempfile.TemporaryDirectory(dir=args.dir) as d:
+                pool = heapdb.BufferPool(256)
+                wal = heapwal.WriteAheadLog(os.path.join(d, "movies.wal"), pool, group_commit=group_commit)
+                table = heapdb.HeapTable(os.path.join(d, "movies.hf"), MOVIE_SCHEMA, wal=wal)
+                per_thread = args.commits // threads
+
+                def worker(t):
+                    for i in range(per_thread):
+                        table.insert((t * per_thread + i, f"Movie number {i}", GENRES[i % len(GENRES)]))
+                workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+                start = time.perf_counter()
+                for w in workers:
+                    w.start()
+                for w in workers:
+                    w.join()
+                secs = time.perf_counter() - start
+                label = f"threads={threads} group commit {'on' if group_commit else 'off'}"
+                print(f"{label:<40} {wal.commits:>8} commits {wal.fsyncs:>8} fsyncs {wal.commits / secs:>10,.0f} commits/s")
+                table.close()
+                wal.close()
+                pool.close()
+
+
+def bench_zonemap(args):
+    """
+    Point lookups on movieId (min/max) and title (Bloom filter), pushed into the scan with and
+    without a zone map.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        key = args.rows // 2
+        scanner = dbq.FileScanner(hf_path, MOVIE_SCHEMA)
+        title = scanner.fetch((os.path.getsize(hf_path) // heapdb.PAGE_SIZE // 2, 0))[1]
+        scanner.close()
+        preds = (
+            ("movieId ==", dbq.Compare(0, "==", key)),
+            ("movieId range 1%", dbq.And(dbq.Compare(0, ">=", key), dbq.Compare(0, "<", key + args.rows // 100))),
+            ("title == (bloom)", dbq.Compare(1, "==", title)),
+        )
+        for with_zone_map in (False, True):
+            if with_zone_map:
+                heapdb.build_zone_map(hf_path, MOVIE_SCHEMA, bloom_columns=(1,))
+            else:
+                heapdb.remove_zone_map(hf_path)
+            for name, pred in preds:
+                def scan():
+                    node = dbq.FileScanner(hf_path, MOVIE_SCHEMA, predicate=pred)
+                    n = sum(1 for _ in dbq.run(dbq.Q(node), batch_size=dbq.BATCH_SIZE))
+                    return n, node.pages_read, node.pages_skipped
+                (n, read, skipped), secs = timed(scan, args.repeat)
+                label = f"{name} {'zone map' if with_zone_map else 'full scan'}"
+                print(f"{label:<40} {n:>8} rows {read:>8} pages read {skipped:>8} skipped {secs * 1e3:10.2f} ms")
+
+
+def bench_indexscan(args):
+    """
+    Range queries answered by an IndexScan over a B+ tree vs. a full scan and a Selection,
+    on movieId (rows are in key order, so matches share pages) and on the release year in
+    the title (matches are spread over the whole file).
+    """
+    year = lambda x: int(x[1][-5:-1])
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        scanner = dbq.FileScanner(hf_path, MOVIE_SCHEMA)
+        indexes, build_secs = timed(lambda: {
+            "movieId": dbq.build_index(scanner, lambda x: x[0]),
+            "year": dbq.build_index(scanner, year),
+        })
+        scanner.close()
+        print(f"built both indexes in {build_secs:.2f}s")
+        key = args.rows // 2
+        queries = (
+            ("movieId", lambda x: x[0], key, key + args.rows // 1000),
+            ("movieId", lambda x: x[0], key, key + args.rows // 100),
+            ("year", year, 2000, 2000),
+            ("year", year, 2000, 2009),
+        )
+        for column, key_fn, lo, hi in queries:
+            def full_scan():
+                plan = dbq.Q(dbq.Selection(lambda x: lo <= key_fn(x) <= hi), dbq.FileScanner(hf_path, MOVIE_SCHEMA))
+                return sum(1 for _ in dbq.run(plan, batch_size=dbq.BATCH_SIZE))
+
+            def index_scan():
+                plan = dbq.IndexScan(indexes[column], (lo, hi), dbq.FileScanner(hf_path, MOVIE_SCHEMA))
+                return sum(1 for _ in dbq.run(plan, batch_size=dbq.BATCH_SIZE))
+            for name, scan in (("full scan", full_scan), ("index scan", index_scan)):
+                n, secs = timed(scan, args.repeat)
+                label = f"{column} in [{lo}, {hi}] {name}"
+                print(f"{label:<40} {n:>8} rows {n / args.rows:8.2%} {secs * 1e3:10.2f} ms")
+
+
+def bench_segments(args):
+    """
+    Appending to a segmented table from 1..N writer processes at once, then scanning it
+    serially and with a ParallelScan per segment.
+    """
+    rng = random.Random(0)
+    rows = [(i, f"Movie number {i} ({rng.randint(1920, 2024)})", rng.choice(GENRES)) for i in range(args.rows)]
+    ctx = multiprocessing.get_context("fork")
+    for writers in args.writers:
+        with tempfile.TemporaryDirectory() as d:
+            table = heapseg.SegmentedTable(d, MOVIE_SCHEMA, segment_pages=args.segment_pages)
+
+            def ingest():
+                procs = [ctx.Process(target=table.append_many, args=(rows[w::writers],)) for w in range(writers)]
+                for p in procs:
+                    p.start()
+                for p in procs:
+                    p.join()
+            _, secs = timed(ingest)
+            report(f"ingest, {writers} writers", args.rows, secs)
+            with table.snapshot() as snapshot:
+                assert snapshot.num_rows() == args.rows
+                n, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(dbq.SegmentScan(snapshot)), batch_size=dbq.BATCH_SIZE)))
+                report(f"scan {len(snapshot.paths)} segments", n, secs)
+                plan = lambda: dbq.Q(dbq.Gather(), dbq.ParallelScan(snapshot.paths, MOVIE_SCHEMA, workers=writers))
+                n, secs = timed(lambda: sum(1 for _ in dbq.run(plan(), batch_size=dbq.BATCH_SIZE)))
+                report(f"parallel scan, {writers} workers", n, secs)
+    print(f"({os.cpu_count()} CPUs)")
+
+
+def bench_analyze(args):
+    """
+    analyze() over the whole file vs. a sample of its pages, and how far off the selectivity
+    estimates come out for a few predicates.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        hf_path = make_movies_hf(d, args.rows)
+        rows = list(heapdb.iter_heap_records(hf_path, MOVIE_SCHEMA))
+        num_pages = os.path.getsize(hf_path) // heapdb.PAGE_SIZE
+        preds = (
+            dbq.Compare(0, "<", args.rows // 10),
+            dbq.And(dbq.Compare(0, ">=", args.rows // 2), dbq.Compare(0, "<", args.rows // 2 + args.rows // 100)),
+            dbq.Compare(2, "==", "Drama"),
+            dbq.Compare(2, "!=", "Comedy"),
+            dbq.Compare(1, "<", "Movie number 5"),
+        )
+        actual = [sum(map(pred, rows)) / len(rows) for pred in preds]
+        for sample_pages in (None, num_pages // 10, num_pages // 100):
+            stats, secs = timed(lambda: heapdb.analyze(hf_path, MOVIE_SCHEMA, sample_pages=sample_pages))
+            label = f"analyze {sample_pages or num_pages} of {num_pages} pages"
+            print(f"{label:<40} {secs:8.3f}s  rows {stats.row_count:>10}  distinct {[c['distinct'] for c in stats.columns]}")
+            for pred, sel in zip(preds, actual):
+                est = dbq.selectivity(pred, stats)
+                print(f"    {repr(pred):<50} actual {sel:8.4f} estimate {est:8.4f}")
+
+
+def drop_cache(path):
+    """
+    Evict a file from the OS page cache (it must be clean), so the next read hits the disk.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def bench_readahead(args):
+    """
+    Cold cache scans, with the file evicted from the page cache before every run, with and
+    without a read-ahead thread, for a few queue depths and read sizes.
+    """
+    with tempfile.TemporaryDirectory(dir=args.dir) as d:
+        hf_path = make_movies_hf(d, args.rows)
+        print(f"heap file: {os.path.getsize(hf_path) / 1e6:.1f} MB")
+        configs = [(0, 1)] + [(depth, chunk) for depth in args.depth for chunk in args.chunk if chunk <= depth]
+        for depth, chunk in configs:
+            def scan():
+                drop_cache(hf_path)
+                node = dbq.FileScanner(hf_path, MOVIE_SCHEMA, read_ahead=depth, read_chunk=chunk)
+                return sum(1 for _ in dbq.run(dbq.Q(node), batch_size=dbq.BATCH_SIZE))
+            n, secs = timed(scan, args.repeat)
+            report(f"read_ahead={depth} read_chunk={chunk}" if depth else "no read-ahead", n, secs)
+
+
+def bench_diskindex(args):
+    """
+    Build a disk resident B+ tree of random keys, then time reopening it and cold point
+    lookups, for a few index sizes.
+    """
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as d:
+        for n in args.keys:
+            path = os.path.join(d, f"{n}.idx")
+            keys = rng.sample(range(n * 10), n)
+
+            def build():
+                with btree.DiskBPlusTree(path, pool=heapdb.BufferPool(args.pool_pages)) as index:
+                    for i, k in enumerate(keys):
+                        index.insert(k, (i // 100, i % 100))
+            _, build_secs = timed(build)
+            drop_cache(path)
+            index, open_secs = timed(lambda: btree.DiskBPlusTree(path, pool=heapdb.BufferPool(args.pool_pages)))
+            probes = rng.sample(keys, 1_000)
+            _, lookup_secs = timed(lambda: [index.search(k) for k in probes])
+            print(f"{n:>10} keys {os.path.getsize(path) / 1e6:8.1f} MB height {index.height}  build {build_secs:7.2f}s"
+                  f"  open {open_secs * 1e3:7.3f} ms  lookup {lookup_secs * 1e6 / len(probes):8.1f} us")
+            index.close()
+
+
+def bench_bulkload(args):
+    """
+    Building an in-memory B+ tree by repeated insert vs. bulk_load from sorted keys vs.
+    bulk_load_unsorted (external sort first), with random keys.
+    """
+    rng = random.Random(0)
+    for n in args.keys:
+        keys = list(range(n))
+        rng.shuffle(keys)
+        builds = (
+            ("insert", lambda: insert_all(keys, args.max_nodes)),
+            ("bulk_load (sorted input)", lambda: btree.B_plus_Tree.bulk_load(((k, k) for k in range(n)), 1.0, args.max_nodes // 2, args.max_nodes)),
+            ("bulk_load_unsorted", lambda: btree.B_plus_Tree.bulk_load_unsorted(((k, k) for k in keys), 1.0, args.max_nodes // 2, args.max_nodes, run_size=args.run_size)),
+        )
+        for name, build in builds:
+            if name == "insert" and n > args.max_insert:
+                print(f"{name:<28} {n:>10} keys  skipped (over --max-insert)")
+                continue
+            tree, secs = timed(build)
+            print(f"{name:<28} {n:>10} keys {secs:8.2f}s {n / secs:>12,.0f} keys/s  height {btree.check_tree(tree)}")
+            del tree
+
+
+def bench_btreerange(args):
+    """
+    B+ tree range scans, from single key lookups up to the whole tree, against iterating a
+    slice of a sorted list found with bisect. Each range finds its start from the root once and then walks
+    the leaf chain, so the cost should be one descent plus the keys returned.
+    """
+    rng = random.Random(0)
+    n = args.keys
+    tree = btree.B_plus_Tree.bulk_load(((k, k) for k in range(n)), 0.75, args.max_nodes // 2, args.max_nodes)
+    keys = list(range(n))
+    for fraction in args.fractions:
+        width = max(1, int(n * fraction))
+        queries = max(1, min(args.queries, args.max_keys // width))
+        starts = [rng.randrange(n - width + 1) for _ in range(queries)]
+        got, secs = timed(lambda: sum(1 for lo in starts for _ in tree.range(lo, lo + width, inclusive=(True, False))))
+        assert got == width * queries
+        def scan_list(lo):
+            i, j = bisect.bisect_left(keys, lo), bisect.bisect_left(keys, lo + width)
+            yield from zip(keys[i:j], keys[i:j])
+        _, list_secs = timed(lambda: sum(1 for lo in starts for _ in scan_list(lo)))
+        print(f"{fraction:>9.4%} ({width:>9,} keys) x {queries:>6}  range {secs * 1e6 / queries:10.1f} us/query"
+              f" {got / secs:>12,.0f} keys/s   sorted list {list_secs * 1e6 / queries:10.1f} us/query")
+
+
+def bench_btreeconcurrent(args):
+    """
+    Mixed searches and inserts from several threads on one tree: Concurrent_B_plus_Tree with
+    per-node latches vs. a B_plus_Tree behind one lock. With the GIL only one thread runs
+    Python at a time, so this measures the latching overhead and whether threads get stuck
+    behind each other, not parallel speedup.
+    """
+    for read_ratio in args.read_ratios:
+        for name in ("one lock", "latch crabbing"):
+            # start from a loaded tree, and insert keys between the loaded ones
+            items = ((k, k) for k in range(0, 2 * args.keys, 2))
+            if name == "one lock":
+                tree = btree.B_plus_Tree.bulk_load(items, 0.75, args.max_nodes // 2, args.max_nodes)
+                lock = threading.Lock()
+
+                def search(k):
+                    with lock:
+                        return tree.search(k)
+
+                def insert(k):
+                    with lock:
+                        tree.insert(k, k)
+            else:
+                tree = btree.Concurrent_B_plus_Tree.bulk_load(items, 0.75, args.max_nodes // 2, args.max_nodes)
+                search, insert = tree.search, lambda k: tree.insert(k, k)
+
+            def work(t):
+                rng = random.Random(t)
+                for _ in range(args.ops):
+                    if rng.random() < read_ratio:
+                        search(2 * rng.randrange(args.keys))
+                    else:
+                        insert(2 * rng.randrange(args.keys) + 1)
+
+            def run_threads():
+                threads = [threading.Thread(target=work, args=(t,)) for t in range(args.threads)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+            _, secs = timed(run_threads)
+            btree.check_tree(tree)
+            ops = args.threads * args.ops
+            restarts = f"  {tree.restarts / max(1, ops * (1 - read_ratio)):6.1%} of inserts restarted" if name != "one lock" else ""
+            print(f"{read_ratio:>6.0%} reads  {name:<16} {args.threads} threads {secs:7.2f}s {ops / secs:>12,.0f} ops/s{restarts}")
+
+
+def insert_all(keys, max_nodes):
+    tree = btree.B_plus_Tree(max_nodes // 2, max_nodes)
+    for k in keys:
+        tree.insert(k, k)
+    return tree
+
+
+def bench_compress(args):
+    """
+    File size and scan throughput of plain vs. compressed heap files, with and without
+    dictionary encoding genres.
+    """
+    with tempfile.TemporaryDirectory() as d:
+        rows = list(heapdb.iter_heap_records(make_movies_hf(d, args.rows), MOVIE_SCHEMA))
+        formats = (
+            ("plain", lambda path: heapdb.HeapFileWriter(path, MOVIE_SCHEMA)),
+            ("zlib", lambda path: heapdb.CompressedHeapFileWriter(path, MOVIE_SCHEMA)),
+            ("dict(genres) + zlib", lambda path: heapdb.CompressedHeapFileWriter(path, MOVIE_SCHEMA, (2,))),
+            ("dict(genres) + zlib level 1", lambda path: heapdb.CompressedHeapFileWriter(path, MOVIE_SCHEMA, (2,), level=1)),
+        )
+        plain_size = None
+        for i, (name, writer) in enumerate(formats):
+            path = os.path.join(d, f"movies-{i}.hf")
+
+            def write():
+                with writer(path) as w:
+                    for row in rows:
+                        w.append(row)
+            _, write_secs = timed(write)
+            size = os.path.getsize(path)
+            plain_size = plain_size or size
+            n, secs = timed(lambda: sum(1 for _ in dbq.run(dbq.Q(dbq.FileScanner(path, MOVIE_SCHEMA)), batch_size=dbq.BATCH_SIZE)), args.repeat)
+            assert n == args.rows
+            print(f"{name:<28} {size / 1e6:8.1f} MB  ratio {plain_size / size:5.2f}x  write {write_secs:6.2f}s"
+                  f"  scan {secs:6.3f}s {n / secs:>12,.0f} rows/s {size / 1e6 / secs:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="db-query.py / heap-db.py benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("batch", help="row vs. batch execution")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--batch-size", type=int, default=dbq.BATCH_SIZE)
+    p.set_defaults(fn=bench_batch)
+
+    p = sub.add_parser("parallel", help="serial vs. parallel heap file scan")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--workers", type=int, nargs="+", default=[2, 4, os.cpu_count()])
+    p.set_defaults(fn=bench_parallel)
+
+    p = sub.add_parser("mmap", help="read() vs. mmap heap file scan")
+    p.add_argument("--rows", type=int, default=5_000_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_mmap)
+
+    p = sub.add_parser("codec", help="interpreted vs. compiled record codecs")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_codec)
+
+    p = sub.add_parser("columnar", help="row vs. PAX heap file filtering")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_columnar)
+
+    p = sub.add_parser("ingest", help="in memory vs. streaming CSV ingest")
+    p.add_argument("--rows", type=int, nargs="+", default=[9_742, 974_200])
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_ingest)
+
+    p = sub.add_parser("update", help="rewriting vs. in place record updates")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--updates", type=int, default=1_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_update)
+
+    p = sub.add_parser("wal", help="commits/sec with and without group commit")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 4, 16])
+    p.add_argument("--commits", type=int, default=4_000)
+    p.add_argument("--dir", default=".")
+    p.set_defaults(fn=bench_wal)
+
+    p = sub.add_parser("zonemap", help="scans with and without zone maps")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_zonemap)
+
+    p = sub.add_parser("indexscan", help="B+ tree index scans vs. full scans")
+    p.add_argument("--rows", type=int, default=200_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_indexscan)
+
+    p = sub.add_parser("segments", help="concurrent writers into a segmented table")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--writers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--segment-pages", type=int, default=1024)
+    p.set_defaults(fn=bench_segments)
+
+    p = sub.add_parser("analyze", help="full vs. sampled table statistics")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.set_defaults(fn=bench_analyze)
+
+    p = sub.add_parser("readahead", help="cold cache scans with and without read-ahead")
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--depth", type=int, nargs="+", default=[4, 32])
+    p.add_argument("--chunk", type=int, nargs="+", default=[1, 8])
+    p.add_argument("--dir", help="where to put the heap file, e.g. on a network mount")
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_readahead)
+
+    p = sub.add_parser("diskindex", help="disk resident B+ tree build, open and lookups")
+    p.add_argument("--keys", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    p.add_argument("--pool-pages", type=int, default=256)
+    p.set_defaults(fn=bench_diskindex)
+
+    p = sub.add_parser("bulkload", help="B+ tree repeated insert vs. bulk loading")
+    p.add_argument("--keys", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    p.add_argument("--max-nodes", type=int, default=64)
+    p.add_argument("--run-size", type=int, default=1_000_000)
+    p.add_argument("--max-insert", type=int, default=10_000_000, help="skip repeated insert above this many keys")
+    p.set_defaults(fn=bench_bulkload)
+
+    p = sub.add_parser("btreerange", help="B+ tree range scans, selective to wide")
+    p.add_argument("--keys", type=int, default=1_000_000)
+    p.add_argument("--max-nodes", type=int, default=64)
+    p.add_argument("--fractions", type=float, nargs="+", default=[0, 0.0001, 0.01, 0.5, 1.0])
+    p.add_argument("--queries", type=int, default=10_000)
+    p.add_argument("--max-keys", type=int, default=5_000_000, help="cap on keys returned per fraction")
+    p.set_defaults(fn=bench_btreerange)
+
+    p = sub.add_parser("btreeconcurrent", help="B+ tree mixed reads and writes from several threads")
+    p.add_argument("--keys", type=int, default=200_000)
+    p.add_argument("--max-nodes", type=int, default=64)
+    p.add_argument("--threads", type=int, default=8)
+    p.add_argument("--ops", type=int, default=50_000, help="operations per thread")
+    p.add_argument("--read-ratios", type=float, nargs="+", default=[0.5, 0.9, 0.99])
+    p.set_defaults(fn=bench_btreeconcurrent)
+
+    p = sub.add_parser("compress", help="plain vs. compressed heap files")
+    p.add_argument("--rows", type=int, default=500_000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(fn=bench_compress)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+
+if __name__ == "__main__":
+    main()
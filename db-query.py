@@ -1,4 +1,24 @@
+import collections
+import concurrent.futures
+import contextlib
 import csv
+import heapq
+import importlib
+import itertools
+import mmap
+import multiprocessing
+import operator
+import os
+import pickle
+import random
+import struct
+import sys
+import tempfile
+
+import numpy as np
+
+btree = importlib.import_module("b-tree-index")
+heapdb = importlib.import_module("heap-db")
 # let's implement a simple, mock relational DB
 # need to support
 # projection (subset of columns)
@@ -12,6 +32,15 @@ import csv
 # the next method will yield the next row of the query one by one.
 # importantly, you can assume that queries are already parsed.
 
+# nodes can also be driven a batch at a time with next_batch(), which returns a list of
+# up to BATCH_SIZE rows (or None when exhausted). this amortizes the per-row method call
+# overhead over the whole batch.
+BATCH_SIZE = 1024
+PAGE_SIZE = 8192
+# heap file pages start with a (page_num, num_records) header, then (start, end) slots
+PAGE_HEADER = struct.Struct("II")
+SLOT = struct.Struct("II")
+
 class QueryNode(object):
     """"
     We can define a custom parent class for all the nodes, and then inherit from it.
@@ -26,6 +55,43 @@ class QueryNode(object):
             return None
         return next(self.child)
 
+    def next_batch(self, n=BATCH_SIZE):
+        """
+        Return a list of up to n rows, or None once the node is exhausted.
+
+        The default just calls __next__ repeatedly, so any node works in a batched plan.
+        Nodes that can do better (scans, projection, selection...) override this.
+        """
+        batch = []
+        while len(batch) < n:
+            x = next(self)
+            if x is None:
+                break
+            batch.append(x)
+        return batch or None
+
+    def next_vector(self):
+        """
+        Return the next chunk of rows as a list of column arrays, or None when exhausted.
+        Only columnar scans and the nodes that can pass vectors through support this.
+        """
+        raise TypeError(f"{type(self).__name__} can't produce column vectors")
+
+    def iter_rows(self, batched=False):
+        """
+        Generator over every row this node produces, pulled a row or a batch at a time.
+        """
+        if batched:
+            batch = self.next_batch()
+            while batch is not None:
+                yield from batch
+                batch = self.next_batch()
+            return
+        x = next(self)
+        while x:
+            yield x
+            x = next(self)
+
     def close(self):
         if self.child is not None:
             self.child.close()
@@ -49,6 +115,25 @@ class MemoryScan(QueryNode):
         self.idx += 1
         return x
 
+    def next_batch(self, n=BATCH_SIZE):
+        if self.idx >= len(self.table):
+            return None
+        batch = list(self.table[self.idx:self.idx + n])
+        self.idx += len(batch)
+        return batch
+
+    def iter_rids(self):
+        """
+        (rid, row) for every row, where the rid is just the row's position in the table.
+        """
+        return enumerate(self.table)
+
+    def fetch(self, rid):
+        return self.table[rid]
+
+    def fetch_many(self, rids) -> list:
+        return [self.table[rid] for rid in rids]
+
 
 class Projection(QueryNode):
     """
@@ -67,6 +152,24 @@ class Projection(QueryNode):
             return self.proj(x)
         return None
 
+    def next_batch(self, n=BATCH_SIZE):
+        if self.child is None:
+            return None
+        batch = self.child.next_batch(n)
+        if batch is None:
+            return None
+        return list(map(self.proj, batch))
+
+    def next_vector(self):
+        if not isinstance(self.proj, Columns):
+            raise TypeError("Only a Columns projection can run on column vectors")
+        if self.child is None:
+            return None
+        cols = self.child.next_vector()
+        if cols is None:
+            return None
+        return Vector([cols[c] for c in self.proj.cols], vector_len(cols))
+
 class Selection(QueryNode):
     """
     Filter the child records using the given predicate function.
@@ -88,6 +191,30 @@ class Selection(QueryNode):
             x = next(self.child)
         return None
 
+    def next_batch(self, n=BATCH_SIZE):
+        if self.child is None:
+            return None
+        # keep pulling until at least one row survives, so an empty list never
+        # looks like the end of the input to the parent
+        batch = self.child.next_batch(n)
+        while batch is not None:
+            out = list(filter(self.predicate, batch))
+            if out:
+                return out
+            batch = self.child.next_batch(n)
+        return None
+
+    def next_vector(self):
+        if self.child is None:
+            return None
+        cols = self.child.next_vector()
+        while cols is not None:
+            mask = vector_mask(self.predicate, cols)
+            if mask.any():
+                return Vector([c[mask] if c is not None else None for c in cols], int(mask.sum()))
+            cols = self.child.next_vector()
+        return None
+
 class Limit(QueryNode):
     """
     Return only as many as the limit, then stop
@@ -107,27 +234,162 @@ class Limit(QueryNode):
                 return x
         return None
 
+    def next_batch(self, n=BATCH_SIZE):
+        if self.child is None or self.curr >= self.n:
+            return None
+        batch = self.child.next_batch(min(n, self.n - self.curr))
+        if batch is None:
+            return None
+        batch = batch[:self.n - self.curr]
+        self.curr += len(batch)
+        return batch
+
+    def next_vector(self):
+        if self.child is None or self.curr >= self.n:
+            return None
+        cols = self.child.next_vector()
+        if cols is None:
+            return None
+        n = min(vector_len(cols), self.n - self.curr)
+        self.curr += n
+        return Vector([c[:n] if c is not None else None for c in cols], n)
+
+class SpillFile(object):
+    """
+    A temporary file of rows laid out in heap-file pages (see heap-db.py): an 8 byte
+    (page_num, num_records) header, then (start, end) slots, then the record data, padded
+    out to PAGE_SIZE.
+
+    Operators don't know the schema of the rows they spill, so each record is pickled.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.page_num = 0
+        self.slots = []
+        self.data = bytearray()
+        self.num_rows = 0
+
+    def append(self, row):
+        record = pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL)
+        if 16 + len(record) > PAGE_SIZE:
+            raise ValueError(f"Record of {len(record)} bytes is too large to spill")
+        if 8 + (len(self.slots) + 1) * 8 + len(self.data) + len(record) > PAGE_SIZE:
+            self.flush_page()
+        self.slots.append((len(self.data), len(self.data) + len(record)))
+        self.data += record
+        self.num_rows += 1
+
+    def flush_page(self):
+        if not self.slots:
+            return
+        page = bytearray(PAGE_SIZE)
+        struct.pack_into("II", page, 0, self.page_num, len(self.slots))
+        struct.pack_into(f"{2 * len(self.slots)}I", page, 8, *itertools.chain.from_iterable(self.slots))
+        data_start = 8 + len(self.slots) * 8
+        page[data_start:data_start + len(self.data)] = self.data
+        self.file.write(page)
+        self.page_num += 1
+        self.slots = []
+        self.data = bytearray()
+
+    def __iter__(self):
+        self.flush_page()
+        self.file.seek(0)
+        while True:
+            page = self.file.read(PAGE_SIZE)
+            if len(page) < PAGE_SIZE:
+                return
+            num_records = int.from_bytes(page[4:8], "little")
+            slots = struct.unpack_from(f"{2 * num_records}I", page, 8)
+            data_start = 8 + num_records * 8
+            for i in range(0, 2 * num_records, 2):
+                yield pickle.loads(page[data_start + slots[i]:data_start + slots[i + 1]])
+
+    def close(self):
+        self.file.close()
+
+
+def row_size(row) -> int:
+    """
+    Rough in-memory size of a row in bytes, used to keep operators inside their memory budget.
+    """
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+
 class Sort(QueryNode):
     """
     Sort based on the given key function
+
+    With a memory_limit (in bytes), this becomes an external merge sort: sorted runs that
+    fit in memory are spilled to temporary files, then k-way merged back together.
+    spilled_runs and merge_passes count how much work that took.
     """
-    def __init__(self, key, desc=False):
+    # max number of runs we merge at once, each one holds a page in memory
+    MERGE_FAN_IN = 64
+
+    def __init__(self, key, desc=False, memory_limit=None):
         self.key = key
         self.desc = desc
+        self.memory_limit = memory_limit
         self.child = None
         self.it = None
+        self.runs = []
+        self.spilled_runs = 0
+        self.merge_passes = 0
     
-    def construct_iter(self):
+    def construct_iter(self, batched=False):
         if self.child is None:
             return None
-        res = []
-        x = next(self.child)
-        while x:
-            res.append(x)
-            x = next(self.child)
+        rows = self.child.iter_rows(batched)
+        if self.memory_limit is not None:
+            return self.external_sort(rows)
+        res = list(rows)
         if not res:
-            return None
+            return iter(())
         return iter(sorted(res, key=self.key, reverse = self.desc))
+
+    def spill_run(self, run):
+        run.sort(key=self.key, reverse=self.desc)
+        spill = SpillFile()
+        for x in run:
+            spill.append(x)
+        self.runs.append(spill)
+        self.spilled_runs += 1
+
+    def merge(self, runs):
+        return heapq.merge(*runs, key=self.key, reverse=self.desc)
+
+    def external_sort(self, rows):
+        run, run_bytes = [], 0
+        for x in rows:
+            run.append(x)
+            run_bytes += row_size(x)
+            if run_bytes >= self.memory_limit:
+                self.spill_run(run)
+                run, run_bytes = [], 0
+        if not self.runs:
+            # everything fit, no need to touch the disk
+            return iter(sorted(run, key=self.key, reverse=self.desc))
+        if run:
+            self.spill_run(run)
+
+        # merge groups of runs into longer runs until we can merge them all in one go.
+        # runs stay in input order and heapq.merge prefers earlier runs on ties, so this is stable
+        fan_in = max(2, min(self.MERGE_FAN_IN, self.memory_limit // PAGE_SIZE))
+        while len(self.runs) > fan_in:
+            self.merge_passes += 1
+            merged = []
+            for i in range(0, len(self.runs), fan_in):
+                group = self.runs[i:i + fan_in]
+                out = SpillFile()
+                for x in self.merge(group):
+                    out.append(x)
+                for r in group:
+                    r.close()
+                merged.append(out)
+            self.runs = merged
+        self.merge_passes += 1
+        return self.merge(self.runs)
         
     def __next__(self):
         if not self.it:
@@ -137,19 +399,463 @@ class Sort(QueryNode):
         except StopIteration:
             return None
         return x
+
+    def next_batch(self, n=BATCH_SIZE):
+        if not self.it:
+            self.it = self.construct_iter(batched=True)
+            if self.it is None:
+                return None
+        return list(itertools.islice(self.it, n)) or None
+
+    def close(self):
+        for r in self.runs:
+            r.close()
+        self.runs = []
+        super().close()
+
+
+class TopN(Sort):
+    """
+    Sort + Limit in one node: only the best n rows are kept in a heap as the child streams
+    past, so memory is O(n) rather than the whole input.
+
+    Ties come out in input order, exactly like Limit(n) over Sort(key, desc).
+    """
+    def __init__(self, n, key, desc=False):
+        super().__init__(key, desc)
+        self.n = n
+
+    def construct_iter(self, batched=False):
+        if self.child is None:
+            return None
+        # nsmallest/nlargest are documented as equivalent to sorted(...)[:n], ties included
+        pick = heapq.nlargest if self.desc else heapq.nsmallest
+        return iter(pick(self.n, self.child.iter_rows(batched), key=self.key))
+
+
+class Count(object):
+    """
+    COUNT(*), or COUNT(fn) to only count rows where fn(row) isn't None.
+    """
+    def __init__(self, fn=None):
+        self.fn = fn
+
+    def initial(self):
+        return 0
+
+    def update(self, state, row):
+        if self.fn is None or self.fn(row) is not None:
+            return state + 1
+        return state
+
+    def result(self, state):
+        return state
+
+
+class Sum(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def initial(self):
+        return 0
+
+    def update(self, state, row):
+        return state + self.fn(row)
+
+    def result(self, state):
+        return state
+
+
+class Min(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def initial(self):
+        return None
+
+    def update(self, state, row):
+        x = self.fn(row)
+        return x if state is None or x < state else state
+
+    def result(self, state):
+        return state
+
+
+class Max(Min):
+    def update(self, state, row):
+        x = self.fn(row)
+        return x if state is None or x > state else state
+
+
+class Avg(object):
+    def __init__(self, fn):
+        self.fn = fn
+
+    def initial(self):
+        return (0, 0)
+
+    def update(self, state, row):
+        return (state[0] + self.fn(row), state[1] + 1)
+
+    def result(self, state):
+        return state[0] / state[1] if state[1] else None
+
+
+class Aggregate(QueryNode):
+    """
+    GROUP BY: yield (group, agg1, agg2, ...) for every distinct group_key(row), where the
+    aggregates are Count/Sum/Min/Max/Avg objects, e.g.
+
+        Aggregate(lambda x: x[2], (Count(), Avg(lambda x: x[0])))
+
+    Groups are aggregated in a hash table. With max_groups set, once the table is full, rows
+    for groups that aren't already in it are hash partitioned into spill files, and each
+    partition is aggregated afterwards on its own (partitioning again if needed).
+    """
+    NUM_PARTITIONS = 16
+    MAX_DEPTH = 4
+
+    def __init__(self, group_key, aggregates, max_groups=None):
+        self.group_key = group_key
+        self.aggregates = tuple(aggregates)
+        self.max_groups = max_groups
+        self.child = None
+        self.it = None
+        self.spills = []
+        self.spilled_partitions = 0
+
+    def construct_iter(self, batched=False):
+        if self.child is None:
+            return None
+        return self.aggregate(self.child.iter_rows(batched), 0)
+
+    def aggregate(self, rows, depth):
+        aggs = self.aggregates
+        table = {}
+        parts = None
+        for row in rows:
+            k = self.group_key(row)
+            states = table.get(k)
+            if states is None:
+                if self.max_groups is not None and len(table) >= self.max_groups and depth < self.MAX_DEPTH:
+                    if parts is None:
+                        parts = [SpillFile() for _ in range(self.NUM_PARTITIONS)]
+                        self.spills.extend(parts)
+                        self.spilled_partitions += self.NUM_PARTITIONS
+                    parts[hash((depth, k)) % self.NUM_PARTITIONS].append(row)
+                    continue
+                states = table[k] = [agg.initial() for agg in aggs]
+            for i, agg in enumerate(aggs):
+                states[i] = agg.update(states[i], row)
+        for k, states in table.items():
+            yield (k,) + tuple(agg.result(s) for agg, s in zip(aggs, states))
+        if parts is None:
+            return
+        table = None
+        for part in parts:
+            if part.num_rows:
+                yield from self.aggregate(part, depth + 1)
+            part.close()
+
+    def __next__(self):
+        if not self.it:
+            self.it = self.construct_iter()
+        try:
+            x = next(self.it)
+        except StopIteration:
+            return None
+        return x
+
+    def next_batch(self, n=BATCH_SIZE):
+        if not self.it:
+            self.it = self.construct_iter(batched=True)
+            if self.it is None:
+                return None
+        return list(itertools.islice(self.it, n)) or None
+
+    def close(self):
+        for spill in self.spills:
+            spill.close()
+        self.spills = []
+        super().close()
+
+
+class StreamAggregate(Aggregate):
+    """
+    Aggregate for input that's already sorted (or at least grouped) on group_key: each group
+    is finished as soon as the key changes, so memory is O(1) and groups come out in input order.
+    """
+    def __init__(self, group_key, aggregates):
+        super().__init__(group_key, aggregates)
+
+    def aggregate(self, rows, depth):
+        aggs = self.aggregates
+        for k, group in itertools.groupby(rows, key=self.group_key):
+            states = [agg.initial() for agg in aggs]
+            for row in group:
+                for i, agg in enumerate(aggs):
+                    states[i] = agg.update(states[i], row)
+            yield (k,) + tuple(agg.result(s) for agg, s in zip(aggs, states))
+
+
+class JoinNode(QueryNode):
+    """
+    Parent class for nodes with two inputs, e.g. joins.
+
+    Q(...) only builds chains, so the two inputs are passed in when the node is created
+    (each can be its own Q(...) plan). close cascades down both of them. Subclasses
+    provide construct_iter(batched), a generator of output rows.
+    """
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.child = None
+        self.it = None
+
+    def __next__(self):
+        if not self.it:
+            self.it = self.construct_iter()
+        try:
+            x = next(self.it)
+        except StopIteration:
+            return None
+        return x
+
+    def next_batch(self, n=BATCH_SIZE):
+        if not self.it:
+            self.it = self.construct_iter(batched=True)
+        return list(itertools.islice(self.it, n)) or None
+
+    def close(self):
+        self.left.close()
+        self.right.close()
+
+
+class HashJoin(JoinNode):
+    """
+    Equi-join the left and right inputs on left_key(l) == right_key(r), yielding l + r.
+
+    Builds a hash table on the right input and streams the left input through it. If the
+    build side grows past memory_limit (bytes), both inputs are hash partitioned into spill
+    files and each pair of partitions is joined on its own (a grace hash join), partitioning
+    again if a partition is still too big.
+    """
+    NUM_PARTITIONS = 16
+    # give up re-partitioning after this many levels, e.g. when one key has too many rows
+    MAX_DEPTH = 4
+
+    def __init__(self, left, right, left_key, right_key, memory_limit=None):
+        super().__init__(left, right)
+        self.left_key = left_key
+        self.right_key = right_key
+        self.memory_limit = memory_limit
+        self.spills = []
+        self.spilled_partitions = 0
+
+    def construct_iter(self, batched=False):
+        return self.join(self.left.iter_rows(batched), self.right.iter_rows(batched), 0)
+
+    def join(self, left, right, depth):
+        table, used = {}, 0
+        right = iter(right)
+        for r in right:
+            table.setdefault(self.right_key(r), []).append(r)
+            if self.memory_limit is None or depth >= self.MAX_DEPTH:
+                continue
+            used += row_size(r)
+            if used > self.memory_limit:
+                rest = itertools.chain(itertools.chain.from_iterable(table.values()), right)
+                table = None
+                yield from self.join_partitioned(left, rest, depth)
+                return
+        for l in left:
+            for r in table.get(self.left_key(l), ()):
+                yield l + r
+
+    def partition(self, rows, key, depth):
+        parts = [SpillFile() for _ in range(self.NUM_PARTITIONS)]
+        self.spills.extend(parts)
+        for x in rows:
+            # salt with the depth so a partition that's re-split doesn't hash the same way again
+            parts[hash((depth, key(x))) % self.NUM_PARTITIONS].append(x)
+        return parts
+
+    def join_partitioned(self, left, right, depth):
+        right_parts = self.partition(right, self.right_key, depth)
+        left_parts = self.partition(left, self.left_key, depth)
+        self.spilled_partitions += self.NUM_PARTITIONS
+        for lp, rp in zip(left_parts, right_parts):
+            if lp.num_rows and rp.num_rows:
+                yield from self.join(lp, rp, depth + 1)
+            lp.close()
+            rp.close()
+
+    def close(self):
+        for spill in self.spills:
+            spill.close()
+        self.spills = []
+        super().close()
+
+
+class SortMergeJoin(JoinNode):
+    """
+    Equi-join by sorting both inputs on their keys (with Sort, so memory_limit gives an
+    external sort) and merging them. Output comes out ordered by the join key.
+    """
+    def __init__(self, left, right, left_key, right_key, memory_limit=None):
+        left_sort = Sort(left_key, memory_limit=memory_limit)
+        left_sort.child = left
+        right_sort = Sort(right_key, memory_limit=memory_limit)
+        right_sort.child = right
+        super().__init__(left_sort, right_sort)
+        self.left_key = left_key
+        self.right_key = right_key
+
+    def construct_iter(self, batched=False):
+        return self.merge(self.left.iter_rows(batched), self.right.iter_rows(batched))
+
+    def merge(self, left, right):
+        r = next(right, None)
+        # the run of right rows matching the current left key, reused for duplicate left keys
+        group, group_key = [], None
+        for l in left:
+            k = self.left_key(l)
+            if not group or group_key != k:
+                while r is not None and self.right_key(r) < k:
+                    r = next(right, None)
+                group, group_key = [], k
+                while r is not None and self.right_key(r) == k:
+                    group.append(r)
+                    r = next(right, None)
+                if not group and r is None:
+                    return
+            for g in group:
+                yield l + g
+
+
+class IndexNestedLoopJoin(JoinNode):
+    """
+    For each left row, probe a B+ tree (b-tree-index.py) for left_key(row) and fetch the
+    matching rows from the right input by record ID, yielding l + r.
+
+    The right input must support fetch(rid), e.g. a FileScanner or MemoryScan, and the index
+    maps keys to lists of RIDs (see build_index) or to single RIDs (see IndexScan).
+    """
+    def __init__(self, left, right, index, left_key):
+        super().__init__(left, right)
+        self.index = index
+        self.left_key = left_key
+
+    def construct_iter(self, batched=False):
+        for l in self.left.iter_rows(batched):
+            rids = self.index.search(self.left_key(l))
+            if rids is None:
+                continue
+            for rid in [rids] if is_rid(rids) else rids:
+                yield l + self.right.fetch(rid)
+
+
+class IndexScan(QueryNode):
+    """
+    Yield the rows of table whose key falls in key_range, in key order, by walking a B+ tree
+    index (see build_index) instead of scanning the whole table.
+
+    key_range is a (lo, hi) pair, both inclusive, where None leaves that end open. The table
+    must support fetch_many(rids), e.g. a FileScanner or MemoryScan. The index can map each
+    key to a list of RIDs, like build_index's, or to a single (page_idx, row_idx) RID, like a
+    B_plus_Tree filled with insert(key, rid). RIDs are fetched
+    BATCH_SIZE at a time, so each page is read once per batch however many matches it holds.
+    """
+    def __init__(self, index, key_range, table):
+        self.index = index
+        self.key_range = key_range
+        self.table = table
+        self.child = None
+        self.it = None
+
+    def construct_iter(self):
+        lo, hi = self.key_range
+        rids = itertools.chain.from_iterable(
+            [rids] if is_rid(rids) else rids for _, rids in self.index.items(lo, hi))
+        while True:
+            batch = list(itertools.islice(rids, BATCH_SIZE))
+            if not batch:
+                return
+            yield self.table.fetch_many(batch)
+
+    def __next__(self):
+        if self.it is None:
+            self.it = itertools.chain.from_iterable(self.construct_iter())
+        return next(self.it, None)
+
+    def next_batch(self, n=BATCH_SIZE):
+        if self.it is None:
+            self.it = itertools.chain.from_iterable(self.construct_iter())
+        return list(itertools.islice(self.it, n)) or None
+
+    def close(self):
+        self.table.close()
+
+
+def is_rid(value):
+    """
+    Whether an index value is one (page_idx, row_idx) RID rather than a list of them.
+    """
+    return isinstance(value, tuple) and len(value) == 2 and all(isinstance(x, int) for x in value)
+
+
+def build_index(node, key, max_nodes=64, path=None, key_type=int):
+    """
+    Build a B+ tree over a scan node mapping key(row) -> list of the RIDs holding that key.
+
+    With path, the tree is a disk resident btree.DiskBPlusTree in that file instead, for
+    key_type keys and a heap file's (page_idx, row_idx) RIDs. Any index already there is
+    replaced.
+    """
+    if path is not None:
+        index = btree.DiskBPlusTree(path, key_type, create=True)
+        for rid, row in node.iter_rids():
+            index.insert(key(row), rid)
+        index.flush()
+        return index
+    # sort (key, rid) pairs by key (on disk if there are lots) and bulk load the tree
+    pairs = btree.external_sort(((key(row), rid) for rid, row in node.iter_rids()), key=operator.itemgetter(0))
+    grouped = ((k, [rid for _, rid in group]) for k, group in itertools.groupby(pairs, key=operator.itemgetter(0)))
+    return btree.B_plus_Tree.bulk_load(grouped, 1.0, max_nodes // 2, max_nodes)
+
+
+def fuse_top_n(root):
+    """
+    Replace every Limit that sits directly above a Sort with an equivalent TopN.
+    Returns the root of the rewritten plan, which is new if the root itself was fused.
+    """
+    parent, node = None, root
+    while node is not None:
+        if isinstance(node, Limit) and type(node.child) is Sort:
+            top = TopN(node.n, node.child.key, node.child.desc)
+            top.child = node.child.child
+            if parent is None:
+                root = top
+            else:
+                parent.child = top
+            node = top
+        parent, node = node, node.child
+    return root
+
 def Q(*nodes):
     """
     Construct a linked list of executor nodes from the given arguments,
     starting with a root node, and adding references to each child
+
+    Limit directly above Sort is swapped for a TopN on the way out.
     """
     ns = iter(nodes)
     parent = root = next(ns)
     for n in ns:
         parent.child = n
         parent = n
-    return root
-import struct
-class CSVScanner:
+    return fuse_top_n(root)
+class CSVScanner(QueryNode):
     def __init__(self, file_path, schema):
         self.file_path = file_path
         self.file = open(file_path, 'r')
@@ -176,67 +882,927 @@ class CSVScanner:
         except ValueError as e:
             print("ValueError, probably a schema validation error", e)
             raise e
+
+    def next_batch(self, n=BATCH_SIZE):
+        if self.file.closed:
+            return None
+        batch = []
+        types = [t for _, t in self.schema]
+        for row in itertools.islice(self.reader, n):
+            if len(row) != len(types):
+                raise ValueError("Schema validation error, number of columns in row does not match schema")
+            batch.append(tuple(t(v) for t, v in zip(types, row)))
+        if len(batch) < n:
+            self.file.close()
+        return batch or None
         
     def close(self):
         if self.file:
             print('run the close on the file')
             self.file.close()
 
-PAGE_SIZE = 8192
 class FileScanner(QueryNode):
     """
     Class to work with heap files specified in heap-db.py
+
+    The planner can push work into the scan (see optimize): with columns set, only those
+    columns are decoded and the rest come back as None, and with a predicate set, rows that
+    don't match are dropped, decoding just the predicate's columns first when it's declarative.
+
+    With a heap-db.py BufferPool, pages are fetched through the pool (as a scan, so a big
+    scan doesn't evict the pool's hot pages) instead of read from the file.
+
+    If the file has a zone map (see heap-db.py's ZoneMap) and the predicate is declarative,
+    pages the zone map rules out are skipped without being read. pages_read and
+    pages_skipped count them.
+
+    Compressed heap files (see heap-db.py's CompressedHeapFileWriter) are read the same way,
+    each page being decompressed as it's loaded.
+
+    With read_ahead set (and no pool), a heap-db.py ReadAhead thread reads up to read_ahead
+    pages ahead of the scan, read_chunk pages per read, so waiting for the disk overlaps with
+    decoding instead of stalling it every page.
     """
-    def __init__(self, file_path, schema):
+    def __init__(self, file_path, schema, columns=None, predicate=None, pool=None, read_ahead=0, read_chunk=1):
+        self.file_path = file_path
+        self.read_ahead = read_ahead
+        self.read_chunk = read_chunk
+        self.prefetch = None
         self.schema = schema
+        self.columns = columns
+        self.predicate = predicate
+        self.pool = pool
         self.child = None
         self.record_idx = 0
         self.file = open(file_path, 'rb')
+        self.codec = heapdb.file_codec(self.file.fileno(), schema)
         self.page_buff = None
         self.num_records = 0
-    
-    def __next__(self):
-        if self.page_buff is None:
+        # next page to load, and the page we have pinned in the pool
+        self.page_idx = 0
+        self.pinned = None
+        # pages that might match the predicate, worked out on the first load_page
+        self.page_mask = None
+        self.pages_read = 0
+        self.pages_skipped = 0
+
+    def load_page(self) -> bool:
+        """
+        Read the next page into page_buff. Returns False once we hit the end of the file.
+        """
+        skipped = self.skip_pages()
+        if self.pool is not None:
+            self.unpin()
+            if self.page_idx >= self.pool.page_count(self.file_path):
+                self.page_buff = None
+                return False
+            self.page_buff = self.pool.fetch(self.file_path, self.page_idx, scan=True)
+            self.pinned = self.page_idx
+        elif self.read_ahead:
+            if self.prefetch is None:
+                num_pages = os.fstat(self.file.fileno()).st_size // PAGE_SIZE
+                mask = self.page_mask
+                pages = [i for i in range(self.page_idx, num_pages) if i >= len(mask) or mask[i]]
+                self.prefetch = heapdb.ReadAhead(self.file.fileno(), pages, self.read_ahead, self.read_chunk)
+            item = self.prefetch.next()
+            if item is None:
+                self.page_buff = None
+                return False
+            # the reader skips the same pages skip_pages does
+            self.page_idx, self.page_buff = item
+        else:
+            if skipped:
+                self.file.seek(self.page_idx * PAGE_SIZE)
             self.page_buff = self.file.read(PAGE_SIZE)
             if len(self.page_buff) < PAGE_SIZE:
-                return None
-            self.record_idx = 0
-            self.num_records = int.from_bytes(self.page_buff[4:8], "little")
-        record_start = 8 + self.record_idx * 8
-        record_end = record_start + 8
-        start, end = struct.unpack("II", self.page_buff[record_start:record_end])
-        data_start = 8 + self.num_records * 8 + start
-        record = self.decode_record(self.page_buff[data_start:data_start+end-start])
-        self.record_idx += 1
-        if self.record_idx >= self.num_records:
-            self.page_buff = None
+                self.page_buff = None
+                return False
+        self.page_buff = heapdb.logical_page(self.page_buff)
+        self.page_idx += 1
+        self.pages_read += 1
+        self.record_idx = 0
+        self.num_records = int.from_bytes(self.page_buff[4:8], "little")
+        # records are decoded from record_buff at record_base + their offset in the page
+        self.record_buff, self.record_base = self.page_buff, 0
+        return True
+    
+    def __next__(self):
+        record = None
+        while record is None:
+            if self.page_buff is None:
+                if not self.load_page():
+                    return None
+                if self.num_records == 0:
+                    self.page_buff = None
+                    continue
+            start, end = SLOT.unpack_from(self.page_buff, 8 + self.record_idx * 8)
+            # an empty slot is a deleted record
+            if start != end:
+                record = self.read_record(self.record_buff, self.record_base + 8 + self.num_records * 8 + start)
+            self.record_idx += 1
+            if self.record_idx >= self.num_records:
+                self.page_buff = None
         return record
 
-    def decode_record(self, data) -> tuple:
-        record = []
-        idx = 0
-        for col, type in self.schema:
-            if type == int or type == float:
-                value = int.from_bytes(data[idx:idx+4], "little")
-                idx += 4
-            elif type == str:
-                length = int.from_bytes(data[idx:idx+1], "little")
-                value = data[idx+1:idx+length+1].decode("utf-8")
-                idx += length + 1
-            else:
-                raise ValueError(f"Invalid type: {type}")
-            record.append(value)
-        return tuple(record)
+    def next_batch(self, n=BATCH_SIZE):
+        """
+        Decode up to n records, unpacking all the slots we need from a page in one go.
+        """
+        batch = []
+        while len(batch) < n:
+            if self.page_buff is None:
+                if not self.load_page():
+                    break
+            take = min(n - len(batch), self.num_records - self.record_idx)
+            slots = struct.unpack_from(f"{2 * take}I", self.page_buff, 8 + self.record_idx * 8)
+            data_start = self.record_base + 8 + self.num_records * 8
+            page, read = self.record_buff, self.read_record
+            for i in range(0, 2 * take, 2):
+                if slots[i] == slots[i + 1]:
+                    continue
+                record = read(page, data_start + slots[i])
+                if record is not None:
+                    batch.append(record)
+            self.record_idx += take
+            if self.record_idx >= self.num_records:
+                self.page_buff = None
+        return batch or None
+
+    def zone_mask(self):
+        """
+        Mask of the pages that could match the predicate, or () if we can't tell.
+        """
+        if not hasattr(self.predicate, "page_mask"):
+            return ()
+        zone_map = heapdb.ZoneMap.load(self.file_path, self.schema)
+        if zone_map is None:
+            return ()
+        return self.predicate.page_mask(zone_map)
+
+    def skip_pages(self) -> int:
+        """
+        Move page_idx past any pages the zone map rules out. Returns how many it skipped.
+        """
+        if self.page_mask is None:
+            self.page_mask = self.zone_mask()
+        start = self.page_idx
+        while self.page_idx < len(self.page_mask) and not self.page_mask[self.page_idx]:
+            self.page_idx += 1
+        self.pages_skipped += self.page_idx - start
+        return self.page_idx - start
+
+    def decode_slots(self, page) -> list:
+        """
+        (row_idx, record) for every record on the page that hasn't been deleted.
+        """
+        num_records = int.from_bytes(page[4:8], "little")
+        slots = struct.unpack_from(f"{2 * num_records}I", page, 8)
+        data_start = 8 + num_records * 8
+        return [
+            (i // 2, self.decode_record(page, data_start + slots[i]))
+            for i in range(0, 2 * num_records, 2) if slots[i] != slots[i + 1]
+        ]
+
+    def decode_page(self, page) -> list:
+        return [record for _, record in self.decode_slots(page)]
+
+    def unpin(self):
+        if self.pinned is not None:
+            self.pool.unpin(self.file_path, self.pinned)
+            self.pinned = None
+
+    @contextlib.contextmanager
+    def read_page(self, page_idx, scan=False):
+        """
+        Positioned read of one page, through the pool if there is one, so it doesn't disturb
+        a scan in progress. Yields None past the end of the file.
+        """
+        if self.pool is None:
+            page = os.pread(self.file.fileno(), PAGE_SIZE, page_idx * PAGE_SIZE)
+            yield heapdb.logical_page(page) if len(page) == PAGE_SIZE else None
+        elif page_idx >= self.pool.page_count(self.file_path):
+            yield None
+        else:
+            with self.pool.page(self.file_path, page_idx, scan) as page:
+                yield heapdb.logical_page(page)
+
+    def iter_rids(self):
+        """
+        ((page_idx, row_idx), record) for every record in the file.
+        """
+        page_idx = 0
+        while True:
+            with self.read_page(page_idx, scan=True) as page:
+                if page is None:
+                    return
+                records = self.decode_slots(page)
+            for row_idx, record in records:
+                yield (page_idx, row_idx), record
+            page_idx += 1
+
+    def fetch(self, rid) -> tuple:
+        """
+        Read the record with the given (page_idx, row_idx) record ID.
+        """
+        page_idx, row_idx = rid
+        with self.read_page(page_idx) as page:
+            num_records = int.from_bytes(page[4:8], "little") if page is not None else 0
+            if row_idx >= num_records:
+                raise IndexError(f"No record at {rid}")
+            start, end = SLOT.unpack_from(page, 8 + row_idx * 8)
+            if start == end:
+                raise IndexError(f"Record {rid} was deleted")
+            return self.decode_record(page, 8 + num_records * 8 + start)
+
+    def fetch_many(self, rids) -> list:
+        """
+        Records for a batch of RIDs, in the same order, reading each page they touch once
+        and in file order.
+        """
+        def read(page_idx):
+            with self.read_page(page_idx) as page:
+                if page is None:
+                    raise IndexError(f"Page {page_idx} is past the end of {self.file_path}")
+                # copy, the pool can reuse the frame once it's unpinned
+                return bytes(page)
+        return heapdb.fetch_rids(rids, read, self.codec)
+
+    def decode_record(self, data, idx=0) -> tuple:
+        """
+        Decode the record starting at data[idx].
+        """
+        return self.codec.decode(data, idx)
+
+    def decode_columns(self, data, columns, idx=0) -> tuple:
+        """
+        Like decode_record, but only decode the given column indexes and leave the rest None.
+        Skipped strings are stepped over by their length, without any UTF-8 decoding.
+        """
+        return self.codec.decoder(columns)(data, idx)
+
+    def read_record(self, data, idx=0):
+        """
+        Decode the record at data[idx] for the scan, applying any pushed down columns and
+        predicate. Returns None if the predicate filters it out.
+        """
+        codec = self.codec
+        if self.predicate is None:
+            if self.columns is None:
+                return codec.decode(data, idx)
+            return codec.decoder(self.columns)(data, idx)
+        pred_columns = getattr(self.predicate, "columns", None)
+        if pred_columns is not None:
+            # check the predicate before paying to decode the rest of the row
+            if not self.predicate(codec.decoder(pred_columns)(data, idx)):
+                return None
+            record = None
+        else:
+            record = codec.decode(data, idx)
+            if not self.predicate(record):
+                return None
+        if self.columns is not None:
+            return codec.decoder(self.columns)(data, idx)
+        return record if record is not None else codec.decode(data, idx)
     
     def close(self):
         print("closing file in file scanner")
+        if self.pool is not None:
+            self.unpin()
+            self.page_buff = self.record_buff = None
+        if self.prefetch is not None:
+            self.prefetch.close()
+            self.prefetch = None
         if self.file:
             self.file.close()
     
-def run(q):
+class MmapFileScanner(FileScanner):
+    """
+    FileScanner that memory maps the heap file and walks its pages through a memoryview,
+    instead of read()ing a copy of every page and slicing bytes for every slot and field.
+    Nothing is copied out of the mapping until a string is finally decoded.
+    """
+    def __init__(self, file_path, schema, columns=None, predicate=None):
+        super().__init__(file_path, schema, columns, predicate)
+        size = os.fstat(self.file.fileno()).st_size
+        # mmap can't map an empty file
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self.view = memoryview(self.map) if size else memoryview(b"")
+
+    def load_page(self) -> bool:
+        self.skip_pages()
+        offset = self.page_idx * PAGE_SIZE
+        if offset + PAGE_SIZE > len(self.view):
+            self.page_buff = None
+            return False
+        self.page_buff = self.view[offset:offset + PAGE_SIZE]
+        self.record_idx = 0
+        self.num_records = PAGE_HEADER.unpack_from(self.page_buff)[1]
+        # decode straight out of the mapping: ints are unpacked in place and strings are
+        # only copied when they're sliced out to be decoded
+        self.record_buff, self.record_base = self.map, offset
+        if self.num_records & (heapdb.COMPRESSED_PAGE | heapdb.FOOTER_PAGE):
+            self.page_buff = self.record_buff = heapdb.logical_page(self.page_buff)
+            self.record_base = 0
+            self.num_records = PAGE_HEADER.unpack_from(self.page_buff)[1]
+        self.page_idx += 1
+        self.pages_read += 1
+        return True
+
+    def close(self):
+        self.page_buff = None
+        self.record_buff = None
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                # something still holds a view into the mapping, it goes when that does
+                pass
+        super().close()
+
+class SegmentScan(QueryNode):
+    """
+    Scan every segment of a heap-segments.py snapshot as one table, one FileScanner after
+    another. columns, predicate and pool are passed on to each of them.
+
+    To scan the segments in parallel instead, give snapshot.paths to a ParallelScan.
+    """
+    def __init__(self, snapshot, columns=None, predicate=None, pool=None):
+        self.snapshot = snapshot
+        self.columns = columns
+        self.predicate = predicate
+        self.pool = pool
+        self.child = None
+        self.segment_idx = 0
+        self.scanner = None
+
+    def next_scanner(self) -> bool:
+        """
+        Move on to the next segment. Returns False once there are none left.
+        """
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
+        if self.segment_idx >= len(self.snapshot.paths):
+            return False
+        path = self.snapshot.paths[self.segment_idx]
+        self.scanner = FileScanner(path, self.snapshot.schema, self.columns, self.predicate, self.pool)
+        self.segment_idx += 1
+        return True
+
+    def __next__(self):
+        while self.scanner is not None or self.next_scanner():
+            x = next(self.scanner)
+            if x is not None:
+                return x
+            self.next_scanner()
+        return None
+
+    def next_batch(self, n=BATCH_SIZE):
+        while self.scanner is not None or self.next_scanner():
+            batch = self.scanner.next_batch(n)
+            if batch is not None:
+                return batch
+            self.next_scanner()
+        return None
+
+    def close(self):
+        if self.scanner is not None:
+            self.scanner.close()
+            self.scanner = None
+
+
+class ColumnarScanner(QueryNode):
+    """
+    Scan a columnar (PAX) heap file written by heap-db.py's ColumnarWriter.
+
+    next_vector() returns a page at a time as a list of NumPy arrays, one per column (None
+    for columns left out of `columns`), which Selection, Projection and Limit can work on
+    directly, e.g. a Compare on a numeric column becomes a single vectorized mask. It also
+    works as an ordinary row (or batch) scan under any other node.
+    """
+    def __init__(self, file_path, schema, columns=None):
+        self.file_path = file_path
+        self.schema = schema
+        self.types = heapdb.schema_types(schema)
+        self.columns = columns
+        self.child = None
+        self.file = open(file_path, 'rb')
+        self.rows = []
+        self.pos = 0
+
+    def next_vector(self):
+        while True:
+            page = self.file.read(PAGE_SIZE)
+            if len(page) < PAGE_SIZE:
+                return None
+            # the row count comes from the page header, as there may be no columns to count
+            num_records = int.from_bytes(page[4:8], "little")
+            if num_records:
+                return Vector(heapdb.decode_pax_page(page, self.types, self.columns), num_records)
+
+    def next_batch(self, n=BATCH_SIZE):
+        if self.pos >= len(self.rows):
+            cols = self.next_vector()
+            if cols is None:
+                return None
+            self.rows, self.pos = vector_rows(cols), 0
+        batch = self.rows[self.pos:self.pos + n]
+        self.pos += len(batch)
+        return batch
+
+    def __next__(self):
+        batch = self.next_batch(1)
+        return batch[0] if batch else None
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class Vector(list):
+    """
+    The column arrays for a chunk of rows, plus the row count, which can't be taken from
+    the arrays when none of the columns were read (e.g. a count).
+    """
+    def __init__(self, cols, num_rows):
+        super().__init__(cols)
+        self.num_rows = num_rows
+
+
+def vector_len(cols) -> int:
+    if isinstance(cols, Vector):
+        return cols.num_rows
+    return next((len(c) for c in cols if c is not None), 0)
+
+
+def vector_rows(cols) -> list:
+    """
+    Turn column arrays back into a list of row tuples, with None for missing columns.
+    """
+    n = vector_len(cols)
+    return list(zip(*(c.tolist() if c is not None else [None] * n for c in cols)))
+
+
+def vector_mask(predicate, cols):
+    """
+    Boolean mask of the rows in cols matching predicate. Declarative predicates compare
+    whole columns at once, anything else gets called row by row.
+    """
+    if hasattr(predicate, "mask"):
+        return predicate.mask(cols)
+    return np.fromiter(map(predicate, vector_rows(cols)), dtype=bool, count=vector_len(cols))
+
+
+def run_vectors(q):
+    """
+    Like run, but pull column vectors (see ColumnarScanner) and yield them.
+    """
+    while True:
+        cols = q.next_vector()
+        if cols is None:
+            break
+        yield cols
+    q.close()
+
+
+# state for ParallelScan worker processes, set up once per process by init_scan_worker
+_scan_worker = None
+
+def init_scan_worker(file_paths, schema, predicate, proj):
+    global _scan_worker
+    # a FileScanner (and its zone mask) per file, opened the first time a task needs it
+    _scan_worker = (file_paths, schema, {}, predicate, proj)
+
+def scan_pages(page_range) -> list:
+    """
+    Runs in a worker: decode pages [start, end) of the file_idx'th file and apply the pushed
+    down selection/projection.
+    """
+    file_paths, schema, scanners, predicate, proj = _scan_worker
+    file_idx, start, end = page_range
+    if file_idx not in scanners:
+        scanner = FileScanner(file_paths[file_idx], schema, predicate=predicate)
+        scanners[file_idx] = (scanner, scanner.zone_mask())
+    scanner, page_mask = scanners[file_idx]
+    fd = scanner.file.fileno()
+    out = []
+    for page_idx in range(start, end):
+        if page_idx < len(page_mask) and not page_mask[page_idx]:
+            continue
+        rows = scanner.decode_page(heapdb.logical_page(os.pread(fd, PAGE_SIZE, page_idx * PAGE_SIZE)))
+        if predicate is not None:
+            rows = filter(predicate, rows)
+        if proj is not None:
+            rows = map(proj, rows)
+        out.extend(rows)
+    return out
+
+
+class ParallelScan(QueryNode):
+    """
+    Scan a heap file with a pool of worker processes. Pages are fixed size and independent,
+    so the file is cut into ranges of pages_per_task pages, and each worker decodes its
+    ranges and runs the pushed down predicate (a Selection) and proj (a Projection) on them.
+
+    This only produces lists of rows per page range; put a Gather above it to turn those back
+    into a normal stream of rows, e.g.
+
+        Q(Limit(10), Gather(), ParallelScan('movies.hf', schema, predicate=lambda x: x[0] > 10))
+
+    file_path can also be a list of heap files scanned as one table, e.g. the segments of a
+    heap-segments.py snapshot (snapshot.paths); each task then covers pages of one file.
+
+    Workers are forked so the predicate and proj can be plain lambdas.
+    """
+    def __init__(self, file_path, schema, workers=None, predicate=None, proj=None, pages_per_task=64):
+        self.file_path = file_path
+        self.file_paths = [file_path] if isinstance(file_path, (str, os.PathLike)) else list(file_path)
+        self.schema = schema
+        self.workers = workers or os.cpu_count()
+        self.predicate = predicate
+        self.proj = proj
+        self.pages_per_task = pages_per_task
+        self.child = None
+        self.pool = None
+
+    def __next__(self):
+        raise TypeError("ParallelScan has to run under a Gather")
+
+    def run_tasks(self, ordered=False):
+        """
+        Generator of per-task result lists, in page order if ordered, else as they finish.
+        Only a couple of tasks per worker are in flight, so a slow consumer doesn't pile up results.
+        """
+        num_pages = [os.path.getsize(path) // PAGE_SIZE for path in self.file_paths]
+        ranges = (
+            (file_idx, i, min(i + self.pages_per_task, n))
+            for file_idx, n in enumerate(num_pages)
+            for i in range(0, n, self.pages_per_task)
+        )
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=init_scan_worker,
+            initargs=(self.file_paths, self.schema, self.predicate, self.proj),
+        )
+        pending = collections.deque(self.pool.submit(scan_pages, r) for r in itertools.islice(ranges, 2 * self.workers))
+        while pending:
+            if ordered:
+                fut = pending.popleft()
+            else:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                fut = done.pop()
+                pending.remove(fut)
+            for r in itertools.islice(ranges, 1):
+                pending.append(self.pool.submit(scan_pages, r))
+            yield fut.result()
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+class Gather(QueryNode):
+    """
+    Collect the rows a ParallelScan's workers produce back into this process, so the rest
+    of the plan runs as usual. With ordered=True rows come out in the same order as a serial
+    FileScanner, otherwise in whatever order the workers finish.
+    """
+    def __init__(self, ordered=False):
+        self.ordered = ordered
+        self.child = None
+        self.it = None
+
+    def __next__(self):
+        if self.child is None:
+            return None
+        if not self.it:
+            self.it = itertools.chain.from_iterable(self.child.run_tasks(self.ordered))
+        return next(self.it, None)
+
+    def next_batch(self, n=BATCH_SIZE):
+        if self.child is None:
+            return None
+        if not self.it:
+            self.it = itertools.chain.from_iterable(self.child.run_tasks(self.ordered))
+        return list(itertools.islice(self.it, n)) or None
+
+
+# declarative predicates and projections. they're callable, so they work anywhere a lambda
+# does, but they also say which columns they read so the planner can reason about them.
+
+class Compare(object):
+    """
+    The predicate row[col] <op> value, e.g. Compare(0, '==', 5_000).
+    """
+    OPS = {
+        '==': operator.eq,
+        '!=': operator.ne,
+        '<': operator.lt,
+        '<=': operator.le,
+        '>': operator.gt,
+        '>=': operator.ge,
+    }
+
+    def __init__(self, col, op, value):
+        if op not in self.OPS:
+            raise ValueError(f"Invalid operator: {op}")
+        self.col = col
+        self.op = op
+        self.value = value
+        self.fn = self.OPS[op]
+        self.columns = frozenset((col,))
+
+    def __call__(self, row):
+        return self.fn(row[self.col], self.value)
+
+    def mask(self, cols):
+        """
+        Evaluate against a whole column array at once, see ColumnarScanner.
+        """
+        return np.asarray(self.fn(cols[self.col], self.value), dtype=bool)
+
+    def page_mask(self, zone_map):
+        """
+        Which pages of a heap file might have matching rows, going by its zone map.
+        """
+        return zone_map.may_match(self.col, self.op, self.value)
+
+    def selectivity(self, stats):
+        """
+        Estimated fraction of rows that match, going by heap-db.py TableStats.
+        """
+        return stats.selectivity(self.col, self.op, self.value)
+
+    def remap(self, cols):
+        """
+        The same predicate on the input of a Columns(*cols) projection.
+        """
+        return Compare(cols[self.col], self.op, self.value)
+
+    def __repr__(self):
+        return f"x[{self.col}] {self.op} {self.value!r}"
+
+
+class And(object):
+    """
+    All of the given predicates. It's only declarative if all of them are.
+    """
+    def __init__(self, *preds):
+        self.preds = preds
+        cols = [getattr(p, "columns", None) for p in preds]
+        self.columns = None if None in cols else frozenset().union(*cols)
+
+    def __call__(self, row):
+        return all(p(row) for p in self.preds)
+
+    def mask(self, cols):
+        return np.logical_and.reduce([vector_mask(p, cols) for p in self.preds])
+
+    def page_mask(self, zone_map):
+        masks = [p.page_mask(zone_map) for p in self.preds if hasattr(p, "page_mask")]
+        return np.logical_and.reduce(masks) if masks else np.ones(zone_map.num_pages, dtype=bool)
+
+    def selectivity(self, stats):
+        """
+        The product of the predicates' selectivities, taking them to be independent, except
+        that a lower and an upper bound on one column make a range: lo <= x < hi matches
+        P(x >= lo) + P(x < hi) - P(x isn't null) of the rows, not P(x >= lo) * P(x < hi).
+        """
+        lower, upper, sels = {}, {}, []
+        for p in self.preds:
+            if isinstance(p, Compare) and p.op in ('>', '>=') and p.col not in lower:
+                lower[p.col] = p
+            elif isinstance(p, Compare) and p.op in ('<', '<=') and p.col not in upper:
+                upper[p.col] = p
+            else:
+                sels.append(selectivity(p, stats))
+        for col, p in lower.items():
+            if col in upper:
+                non_null = 1 - stats.columns[col]["null_frac"]
+                sels.append(max(p.selectivity(stats) + upper.pop(col).selectivity(stats) - non_null, 0.0))
+            else:
+                sels.append(p.selectivity(stats))
+        sels.extend(p.selectivity(stats) for p in upper.values())
+        return float(np.prod(sels))
+
+    def remap(self, cols):
+        return And(*(p.remap(cols) for p in self.preds))
+
+    def __repr__(self):
+        return " and ".join(map(describe_fn, self.preds))
+
+
+class Columns(object):
+    """
+    The projection (row[c0], row[c1], ...). Also works as a Sort key.
+    """
+    def __init__(self, *cols):
+        self.cols = cols
+        self.columns = frozenset(cols)
+
+    def __call__(self, row):
+        return tuple(row[c] for c in self.cols)
+
+    def __repr__(self):
+        return "(" + ", ".join(f"x[{c}]" for c in self.cols) + ")"
+
+
+# the selectivity guessed for predicates we can't see into, as in System R
+DEFAULT_SELECTIVITY = 1 / 3
+
+
+def selectivity(predicate, stats) -> float:
+    """
+    Estimated fraction of rows matching predicate, from heap-db.py TableStats (see analyze).
+    """
+    if predicate is None:
+        return 1.0
+    if stats is not None and hasattr(predicate, "selectivity"):
+        return predicate.selectivity(stats)
+    return DEFAULT_SELECTIVITY
+
+
+def estimate_rows(node):
+    """
+    Estimated number of rows a Q(...) plan produces, or None if it doesn't bottom out in a
+    FileScanner or SegmentScan over analyzed heap files.
+    """
+    def walk(node):
+        # (estimated rows, stats the node's rows can be looked up in or None)
+        if isinstance(node, FileScanner):
+            stats = heapdb.TableStats.load(node.file_path)
+            if stats is None:
+                return None, None
+            return stats.row_count * selectivity(node.predicate, stats), stats
+        if isinstance(node, SegmentScan):
+            all_stats = [heapdb.TableStats.load(path) for path in node.snapshot.paths]
+            if None in all_stats:
+                return None, None
+            return sum(stats.row_count * selectivity(node.predicate, stats) for stats in all_stats), None
+        if node is None or isinstance(node, JoinNode) or type(node) not in (Selection, Projection, Sort, TopN, Limit):
+            return None, None
+        rows, stats = walk(node.child)
+        if rows is None:
+            return None, None
+        if type(node) is Selection:
+            return rows * selectivity(node.predicate, stats), stats
+        if type(node) is Projection:
+            # we'd have to follow the columns through, so stop using the stats above here
+            return rows, None
+        if isinstance(node, Limit) or type(node) is TopN:
+            return min(rows, node.n), stats
+        return rows, stats
+    return walk(node)[0]
+
+
+def describe_fn(fn) -> str:
+    if hasattr(fn, "columns"):
+        return repr(fn)
+    return getattr(fn, "__name__", repr(fn))
+
+
+def describe(node) -> str:
+    """
+    One line summary of a node for explain().
+    """
+    name = type(node).__name__
+    if isinstance(node, Projection):
+        return f"{name}({describe_fn(node.proj)})"
+    if isinstance(node, Selection):
+        return f"{name}({describe_fn(node.predicate)})"
+    if isinstance(node, TopN):
+        return f"{name}({node.n}, key={describe_fn(node.key)}, desc={node.desc})"
+    if isinstance(node, Limit):
+        return f"{name}({node.n})"
+    if isinstance(node, Sort):
+        return f"{name}(key={describe_fn(node.key)}, desc={node.desc})"
+    if isinstance(node, FileScanner):
+        args = [repr(node.file_path)]
+        if node.columns is not None:
+            args.append(f"columns={sorted(node.columns)}")
+        if node.predicate is not None:
+            args.append(f"predicate={describe_fn(node.predicate)}")
+        if node.read_ahead:
+            args.append(f"read_ahead={node.read_ahead}")
+        if node.pages_read or node.pages_skipped:
+            args.append(f"pages_read={node.pages_read}, pages_skipped={node.pages_skipped}")
+        return f"{name}({', '.join(args)})"
+    if isinstance(node, SegmentScan):
+        return f"{name}({len(node.snapshot.paths)} segments, version {node.snapshot.version})"
+    if isinstance(node, IndexScan):
+        lo, hi = node.key_range
+        return f"{name}({lo!r} <= key <= {hi!r}, {describe(node.table)})"
+    return name
+
+
+def plan_lines(node, depth=0) -> list:
+    lines = ["  " * depth + describe(node)]
+    children = (node.left, node.right) if isinstance(node, JoinNode) else (node.child,)
+    for child in children:
+        if child is not None:
+            lines.extend(plan_lines(child, depth + 1))
+    return lines
+
+
+def optimize(root):
+    """
+    Rule based rewrite of a Q(...) plan. Returns the new root; the nodes are reused.
+
+    1. Limits move below Projections (which map rows 1:1) and adjacent Limits merge.
+    2. Selections move below Sorts (filtering commutes with a stable sort), below declarative
+       Projections (by remapping a declarative predicate's columns), and into a FileScanner
+       or SegmentScan.
+    3. A Limit that ends up on top of a Sort becomes a TopN.
+    4. If every node between a declarative Projection and a FileScanner (or SegmentScan)
+       only reads known columns, the scanner only decodes those.
+    """
+    nodes = []
+    node = root
+    while node is not None:
+        nodes.append(node)
+        node = node.child
+
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(nodes) - 1):
+            node, below = nodes[i], nodes[i + 1]
+            if isinstance(node, Limit) and type(below) is Projection:
+                nodes[i], nodes[i + 1] = below, node
+                changed = True
+            elif isinstance(node, Limit) and type(below) is Limit:
+                below.n = min(node.n, below.n)
+                del nodes[i]
+                changed = True
+            elif isinstance(node, Selection) and type(below) is Sort:
+                nodes[i], nodes[i + 1] = below, node
+                changed = True
+            elif (isinstance(node, Selection) and type(below) is Projection and isinstance(below.proj, Columns)
+                  and getattr(node.predicate, "columns", None) is not None):
+                nodes[i], nodes[i + 1] = below, Selection(node.predicate.remap(below.proj.cols))
+                changed = True
+            elif isinstance(node, Selection) and isinstance(below, (FileScanner, SegmentScan)):
+                below.predicate = node.predicate if below.predicate is None else And(below.predicate, node.predicate)
+                del nodes[i]
+                changed = True
+            if changed:
+                break
+
+    for i in range(len(nodes) - 1):
+        nodes[i].child = nodes[i + 1]
+    root = fuse_top_n(nodes[0])
+
+    # walk down collecting the columns each node reads, None meaning we don't know
+    needed = None
+    node = root
+    while node is not None:
+        if isinstance(node, (FileScanner, SegmentScan)):
+            node.columns = needed
+            break
+        if type(node) is Projection:
+            needed = getattr(node.proj, "columns", None)
+        elif type(node) is Selection:
+            cols = getattr(node.predicate, "columns", None)
+            needed = None if needed is None or cols is None else needed | cols
+        elif type(node) in (Sort, TopN):
+            cols = getattr(node.key, "columns", None)
+            needed = None if needed is None or cols is None else needed | cols
+        elif type(node) is not Limit:
+            break
+        node = node.child
+    return root
+
+
+def explain(root):
+    """
+    Print the plan before and after optimize, and return the optimized plan.
+    """
+    print("before:")
+    print("\n".join(plan_lines(root, 1)))
+    root = optimize(root)
+    print("after:")
+    print("\n".join(plan_lines(root, 1)))
+    return root
+
+
+def run(q, batch_size=None):
     """
     Run the given query to completion by calling `next` on the (presumed) root
+
+    If batch_size is given, pull batches with `next_batch` instead and yield their rows.
     """
+    if batch_size is not None:
+        while True:
+            batch = q.next_batch(batch_size)
+            if batch is None:
+                break
+            yield from batch
+        q.close()
+        return
     while True:
         x = next(q)
         if x is None:
@@ -370,11 +1936,521 @@ if __name__ == '__main__':
         ('emppen1',),
     )
 
+    # every plan should give the same rows whether it's run a row or a batch at a time
+    plans = (
+        lambda: Q(Projection(lambda x: (x[0],)), Selection(lambda x: not x[3]), MemoryScan(birds)),
+        lambda: Q(Projection(lambda x: (x[0], x[2])), Limit(3), Sort(lambda x: x[2], desc=True), MemoryScan(birds)),
+        lambda: Q(Projection(lambda x: (x[1],)), Limit(2), Sort(lambda x: x[2]), Selection(lambda x: x[3]), MemoryScan(birds)),
+        lambda: Q(Limit(4), Selection(lambda x: x[2] < 1.0), MemoryScan(birds)),
+        lambda: Q(Selection(lambda x: x[2] > 1000), MemoryScan(birds)),
+    )
+    for plan in plans:
+        expected = tuple(run(plan()))
+        for batch_size in (1, 2, 3, BATCH_SIZE):
+            assert tuple(run(plan(), batch_size=batch_size)) == expected, (batch_size, expected)
+
+    # external sort: a tiny memory budget forces every few rows out to disk
+    sort = Sort(lambda x: x[2], desc=True, memory_limit=1)
+    assert tuple(run(Q(Projection(lambda x: (x[0],)), sort, MemoryScan(birds)))) == tuple(
+        (x[0],) for x in sorted(birds, key=lambda x: x[2], reverse=True)
+    )
+    assert sort.spilled_runs == len(birds) and sort.merge_passes > 1, (sort.spilled_runs, sort.merge_passes)
+    # ties have to come out in input order, same as sorted()
+    nums = tuple((i % 7, i) for i in range(5_000))
+    for desc in (False, True):
+        for batch_size in (None, 100):
+            sort = Sort(lambda x: x[0], desc=desc, memory_limit=64 * 1024)
+            assert tuple(run(Q(sort, MemoryScan(nums)), batch_size=batch_size)) == tuple(
+                sorted(nums, key=lambda x: x[0], reverse=desc)
+            )
+            assert sort.spilled_runs > 1 and sort.merge_passes >= 1, (sort.spilled_runs, sort.merge_passes)
+    # a budget that fits everything never spills
+    sort = Sort(lambda x: x[1], memory_limit=1 << 30)
+    assert tuple(run(Q(sort, MemoryScan(birds)))) == tuple(sorted(birds, key=lambda x: x[1]))
+    assert sort.spilled_runs == 0 and sort.merge_passes == 0
+
+    # Limit over Sort gets fused into a TopN, with identical results including ties
+    plan = Q(Projection(lambda x: (x[0], x[2])), Limit(3), Sort(lambda x: x[2], desc=True), MemoryScan(birds))
+    assert isinstance(plan.child, TopN) and isinstance(plan.child.child, MemoryScan)
+    assert isinstance(Q(Limit(3), Sort(lambda x: x[2]), MemoryScan(birds)), TopN)
+    for desc in (False, True):
+        for n in (0, 1, 5, 50, 5_000):
+            limit, sort = Limit(n), Sort(lambda x: x[0], desc=desc)
+            limit.child, sort.child = sort, MemoryScan(nums)  # built by hand, so not fused
+            expected = tuple(run(limit))
+            assert expected == tuple(sorted(nums, key=lambda x: x[0], reverse=desc)[:n])
+            for batch_size in (None, 64):
+                plan = Q(Limit(n), Sort(lambda x: x[0], desc=desc), MemoryScan(nums))
+                assert isinstance(plan, TopN)
+                assert tuple(run(plan, batch_size=batch_size)) == expected, (n, desc, batch_size)
+
+    # joins: every bird sighting joined to its bird, checked against a nested loop
+    sightings = tuple((i, ('amerob', 'baleag', 'ostric1', 'nobird', 'comrav')[i % 5]) for i in range(40))
+    expected = sorted(s + b for s in sightings for b in birds if s[1] == b[0])
+    joins = (
+        lambda m: HashJoin(MemoryScan(sightings), MemoryScan(birds), lambda x: x[1], lambda x: x[0], memory_limit=m),
+        lambda m: SortMergeJoin(MemoryScan(sightings), MemoryScan(birds), lambda x: x[1], lambda x: x[0], memory_limit=m),
+        lambda m: IndexNestedLoopJoin(MemoryScan(sightings), MemoryScan(birds), build_index(MemoryScan(birds), lambda x: x[0]), lambda x: x[1]),
+    )
+    for join in joins:
+        for memory_limit in (None, 1):
+            for batch_size in (None, 7):
+                assert sorted(run(join(memory_limit), batch_size=batch_size)) == expected
+    # and with the bird table as the probe side, so both sides have duplicates in the spill case
+    join = HashJoin(MemoryScan(birds), MemoryScan(sightings), lambda x: x[0], lambda x: x[1], memory_limit=1)
+    assert sorted(x[4:] + x[:4] for x in run(join)) == expected
+    assert join.spilled_partitions > 0
+    assert tuple(run(Q(
+        Projection(lambda x: (x[0], x[3])),
+        Limit(3),
+        SortMergeJoin(MemoryScan(sightings), MemoryScan(birds), lambda x: x[1], lambda x: x[0]),
+    ))) == ((0, 'American Robin'), (5, 'American Robin'), (10, 'American Robin'))
+
+    # aggregation: per in_us, count birds and their total/min/max/avg weight
+    aggs = lambda: (Count(), Sum(lambda x: x[2]), Min(lambda x: x[2]), Max(lambda x: x[2]), Avg(lambda x: x[2]))
+    expected = {}
+    for in_us in (True, False):
+        weights = [b[2] for b in birds if b[3] == in_us]
+        expected[in_us] = (in_us, len(weights), sum(weights), min(weights), max(weights), sum(weights) / len(weights))
+    assert tuple(run(Q(Aggregate(lambda x: x[3], aggs()), MemoryScan(birds)))) == (expected[True], expected[False])
+    assert tuple(run(Q(StreamAggregate(lambda x: x[3], aggs()), Sort(lambda x: x[3]), MemoryScan(birds)))) == (expected[False], expected[True])
+    # lots of groups with a tiny table, so most rows go through the spill partitions
+    nums = tuple((i % 97, i) for i in range(5_000))
+    expected = sorted((k, len(v), sum(v), min(v), max(v), sum(v) / len(v)) for k in range(97) for v in [[i for g, i in nums if g == k]])
+    for batch_size in (None, 100):
+        agg = Aggregate(lambda x: x[0], (Count(), Sum(lambda x: x[1]), Min(lambda x: x[1]), Max(lambda x: x[1]), Avg(lambda x: x[1])), max_groups=5)
+        assert sorted(run(Q(agg, MemoryScan(nums)), batch_size=batch_size)) == expected
+        assert agg.spilled_partitions > 0
+        stream = StreamAggregate(lambda x: x[0], (Count(), Sum(lambda x: x[1]), Min(lambda x: x[1]), Max(lambda x: x[1]), Avg(lambda x: x[1])))
+        assert tuple(run(Q(stream, Sort(lambda x: x[0]), MemoryScan(nums)), batch_size=batch_size)) == tuple(expected)
+    assert tuple(run(Q(Aggregate(lambda x: x[0], (Count(),)), MemoryScan(())))) == ()
+
     movie_schema = (
         ('movieId', int),
         ('title', str),
         ('genres', str)
     )
+
+    # joins over files: a heap file of movies against a CSV of ratings
+    with tempfile.TemporaryDirectory() as d:
+        movies = tuple((i, f"Movie {i}", ('Comedy', 'Drama', 'Horror|Thriller')[i % 3]) for i in range(1, 2_001))
+        ratings = tuple((i % 2_500 + 1, i % 5 + 1) for i in range(3_000))
+        for name, rows, header in (('movies.csv', movies, movie_schema), ('ratings.csv', ratings, (('movieId', int), ('rating', int)))):
+            with open(os.path.join(d, name), 'w', newline='') as f:
+                w = csv.writer(f)
+                w.writerow(col for col, _ in header)
+                w.writerows(rows)
+        hf = heapdb.HeapFile(os.path.join(d, 'movies.csv'), dict(movie_schema))
+        hf.ingest_from_csv()
+        hf.write_to_disk(os.path.join(d, 'movies.hf'))
+        hf_path, ratings_path = os.path.join(d, 'movies.hf'), os.path.join(d, 'ratings.csv')
+        # the streaming bulk load writes exactly the file ingest + write_to_disk does
+        heapdb.HeapFile(os.path.join(d, 'movies.csv'), dict(movie_schema)).ingest_from_csv(os.path.join(d, 'streamed.hf'))
+        with open(hf_path, 'rb') as f, open(os.path.join(d, 'streamed.hf'), 'rb') as g:
+            assert f.read() == g.read()
+        with heapdb.HeapFileWriter(os.path.join(d, 'streamed.hf'), movie_schema, buffer_pages=2) as writer:
+            for m in movies:
+                writer.append(m)
+        assert tuple(run(Q(FileScanner(os.path.join(d, 'streamed.hf'), movie_schema)))) == movies
+        rating_schema = (('movieId', int), ('rating', int))
+
+        expected = sorted(r + m for r in ratings for m in movies[r[0] - 1:r[0]])
+        index = build_index(FileScanner(hf_path, movie_schema), lambda x: x[0])
+        assert index.search(1_234) is not None and index.search(2_001) is None
+        joins = (
+            lambda: HashJoin(CSVScanner(ratings_path, rating_schema), FileScanner(hf_path, movie_schema), lambda x: x[0], lambda x: x[0], memory_limit=16 * 1024),
+            lambda: SortMergeJoin(CSVScanner(ratings_path, rating_schema), FileScanner(hf_path, movie_schema), lambda x: x[0], lambda x: x[0], memory_limit=16 * 1024),
+            lambda: IndexNestedLoopJoin(CSVScanner(ratings_path, rating_schema), FileScanner(hf_path, movie_schema), index, lambda x: x[0]),
+        )
+        for join in joins:
+            for batch_size in (None, 100):
+                assert sorted(run(join(), batch_size=batch_size)) == expected
+
+        # RID fetches: positioned reads, each page read once per batch, in file order
+        scanner = FileScanner(hf_path, movie_schema)
+        rid_list = [rid for rid, _ in scanner.iter_rids()]
+        picked = random.sample(range(len(movies)), 300)
+        heap = heapdb.HeapFile(hf_path, dict(movie_schema))
+        assert heap.fetch(rid_list[1_234]) == movies[1_234]
+        assert heap.fetch_many([rid_list[i] for i in picked]) == [movies[i] for i in picked]
+        assert scanner.fetch_many([rid_list[i] for i in picked]) == [movies[i] for i in picked]
+        pages_read = []
+        read = lambda page_idx: pages_read.append(page_idx) or heap.read_page_bytes(page_idx)
+        assert heapdb.fetch_rids([rid_list[i] for i in picked], read, heap.codec) == [movies[i] for i in picked]
+        assert pages_read == sorted({rid_list[i][0] for i in picked})
+        try:
+            heap.fetch((len(rid_list), 0))
+            raise AssertionError("fetched past the end of the file")
+        except IndexError:
+            pass
+        heap.close()
+        scanner.close()
+
+        # index scans: the same rows as a filtered scan, in key order, inside any plan
+        for lo, hi in ((1_000, 1_010), (None, 5), (1_995, None), (3_000, 4_000), (None, None)):
+            in_range = lambda x: (lo is None or x[0] >= lo) and (hi is None or x[0] <= hi)
+            expected = tuple(sorted(filter(in_range, movies)))
+            for batch_size in (None, 100):
+                assert tuple(run(IndexScan(index, (lo, hi), FileScanner(hf_path, movie_schema)), batch_size=batch_size)) == expected
+        plan = Q(Limit(3), Projection(lambda x: x[1]), Selection(lambda x: x[2] != 'Drama'), IndexScan(index, (1_500, None), FileScanner(hf_path, movie_schema)))
+        assert tuple(run(plan)) == tuple(m[1] for m in movies[1_499:] if m[2] != 'Drama')[:3]
+        # a tree holding one RID per key works too
+        single = btree.B_plus_Tree()
+        for rid, row in FileScanner(hf_path, movie_schema).iter_rids():
+            single.insert(row[0], rid)
+        assert tuple(run(IndexScan(single, (10, 12), FileScanner(hf_path, movie_schema)))) == movies[9:12]
+        # the same with disk resident indexes, opened again from their files
+        build_index(FileScanner(hf_path, movie_schema), lambda x: x[0], path=os.path.join(d, 'movies.idx')).close()
+        # building it again replaces it rather than adding to it
+        build_index(FileScanner(hf_path, movie_schema), lambda x: x[0], path=os.path.join(d, 'movies.idx')).close()
+        build_index(FileScanner(hf_path, movie_schema), lambda x: x[2], path=os.path.join(d, 'genres.idx'), key_type=str).close()
+        disk_index = btree.DiskBPlusTree(os.path.join(d, 'movies.idx'))
+        assert len(disk_index) == len(movies) and disk_index.search(5) == [(0, 4)]
+        assert tuple(run(IndexScan(disk_index, (1_000, 1_010), FileScanner(hf_path, movie_schema)))) == movies[999:1_010]
+        assert sorted(run(IndexNestedLoopJoin(CSVScanner(ratings_path, rating_schema), FileScanner(hf_path, movie_schema), disk_index, lambda x: x[0]))) == sorted(r + m for r in ratings for m in movies[r[0] - 1:r[0]])
+        disk_index.close()
+        with btree.DiskBPlusTree(os.path.join(d, 'genres.idx')) as genres:
+            assert tuple(run(IndexScan(genres, ('Drama', 'Drama'), FileScanner(hf_path, movie_schema)))) == tuple(m for m in movies if m[2] == 'Drama')
+
+        # statistics: analyze a heap file, then estimate selectivities and plan sizes from them
+        assert estimate_rows(Q(FileScanner(hf_path, movie_schema))) is None
+        stats = heapdb.analyze(hf_path, movie_schema)
+        assert heapdb.TableStats.load(hf_path).columns == stats.columns and stats.row_count == len(movies)
+        assert abs(stats.columns[0]['distinct'] - 2_000) < 60 and stats.columns[2]['distinct'] == 3
+        assert stats.columns[0]['mcv'] == [] and sorted(v for v, _ in stats.columns[2]['mcv']) == ['Comedy', 'Drama', 'Horror|Thriller']
+        assert stats.columns[0]['histogram'][0] == 1 and stats.columns[0]['histogram'][-1] == 2_000
+        def actual(pred):
+            return sum(map(pred, movies)) / len(movies)
+        preds = (
+            Compare(0, '==', 1_234), Compare(0, '==', 5_000), Compare(0, '!=', 7), Compare(0, '<', 500),
+            Compare(0, '<=', 500), Compare(0, '>', 1_900), Compare(0, '>=', 0), Compare(1, '<', 'Movie 5'),
+            Compare(2, '==', 'Drama'), Compare(2, '!=', 'Comedy'), Compare(2, '==', 'Western'),
+            And(Compare(0, '>=', 1_000), Compare(0, '<', 1_500)), And(Compare(0, '<', 1_000), Compare(2, '==', 'Drama')),
+        )
+        for pred in preds:
+            assert abs(selectivity(pred, stats) - actual(pred)) < 0.02, (pred, selectivity(pred, stats), actual(pred))
+        assert selectivity(lambda x: x[0] < 500, stats) == DEFAULT_SELECTIVITY and selectivity(None, stats) == 1
+        plan = Q(Limit(100), Selection(Compare(2, '==', 'Drama')), FileScanner(hf_path, movie_schema, predicate=Compare(0, '<', 1_000)))
+        assert 300 < estimate_rows(plan.child) < 370 and estimate_rows(plan) == 100
+        assert abs(estimate_rows(Q(Projection(Columns(0)), Selection(lambda x: x[2] == 'Drama'), FileScanner(hf_path, movie_schema))) - 2_000 / 3) < 1
+        sampled = heapdb.analyze(hf_path, movie_schema, sample_pages=8, sample_rows=500)
+        assert abs(sampled.row_count - len(movies)) < 200 and abs(selectivity(Compare(0, '<', 500), sampled) - 0.25) < 0.1
+        hf.write_to_disk(hf_path)
+        assert heapdb.TableStats.load(hf_path) is None
+
+        # parallel scan: same rows as a serial scan, in the same order when ordered
+        select, proj = lambda x: x[2] != 'Drama', lambda x: (x[0], x[1])
+        serial = tuple(run(Q(Projection(proj), Selection(select), FileScanner(hf_path, movie_schema))))
+        for batch_size in (None, 100):
+            plan = Q(Gather(ordered=True), ParallelScan(hf_path, movie_schema, workers=3, predicate=select, proj=proj, pages_per_task=2))
+            assert tuple(run(plan, batch_size=batch_size)) == serial
+            plan = Q(Gather(), ParallelScan(hf_path, movie_schema, workers=3, predicate=select, proj=proj, pages_per_task=2))
+            assert sorted(run(plan, batch_size=batch_size)) == sorted(serial)
+        assert tuple(run(Q(Limit(5), Gather(ordered=True), ParallelScan(hf_path, movie_schema, workers=2, pages_per_task=1)))) == movies[:5]
+
+        # segmented tables: segments from several writers scan as one table, serially or in
+        # parallel per segment, from a snapshot that later appends don't change
+        heapseg = importlib.import_module("heap-segments")
+        table = heapseg.SegmentedTable(os.path.join(d, 'movies.seg'), movie_schema, segment_pages=1)
+        writers = [table.writer() for _ in range(3)]
+        for i, m in enumerate(movies):
+            writers[i % 3].append(m)
+        for w in writers:
+            w.close()
+        snapshot = table.snapshot()
+        table.append_many(movies[:10])
+        assert len(snapshot.paths) > 3
+        for batch_size in (None, 100):
+            assert sorted(run(Q(SegmentScan(snapshot)), batch_size=batch_size)) == sorted(movies)
+        assert sorted(run(Q(Gather(), ParallelScan(snapshot.paths, movie_schema, workers=2, predicate=select, proj=proj)))) == sorted(serial)
+        assert tuple(run(Q(Gather(ordered=True), ParallelScan(snapshot.paths, movie_schema, workers=2)))) == tuple(run(Q(SegmentScan(snapshot))))
+        plan = optimize(Q(Projection(Columns(1)), Selection(Compare(0, '==', 1_234)), SegmentScan(snapshot)))
+        assert isinstance(plan.child, SegmentScan) and plan.child.columns == {1}
+        assert tuple(run(plan)) == tuple((m[1],) for m in movies if m[0] == 1_234)
+        snapshot.close()
+        with table.snapshot() as snapshot:
+            assert len(tuple(run(Q(SegmentScan(snapshot, predicate=Compare(0, '<=', 10)))))) == 20
+
+        # the mmap scanner decodes exactly what the read() based one does
+        assert tuple(run(Q(MmapFileScanner(hf_path, movie_schema)))) == movies
+        assert tuple(run(Q(MmapFileScanner(hf_path, movie_schema)), batch_size=100)) == movies
+        plan = lambda scan: Q(Projection(Columns(0)), Limit(3), Sort(Columns(1), desc=True), Selection(Compare(2, '==', 'Drama')), scan)
+        assert tuple(run(optimize(plan(MmapFileScanner(hf_path, movie_schema))))) == tuple(run(plan(FileScanner(hf_path, movie_schema))))
+
+        # columnar files: round trip through the PAX format, and vectorized selections give
+        # the same rows as the row scan
+        pax_path = os.path.join(d, 'movies.pax')
+        heapdb.row_to_columnar(hf_path, pax_path, movie_schema)
+        assert tuple(run(Q(ColumnarScanner(pax_path, movie_schema)))) == movies
+        assert tuple(run(Q(ColumnarScanner(pax_path, movie_schema)), batch_size=77)) == movies
+        heapdb.columnar_to_row(pax_path, os.path.join(d, 'movies2.hf'), movie_schema)
+        assert tuple(run(Q(FileScanner(os.path.join(d, 'movies2.hf'), movie_schema)))) == movies
+        select = And(Compare(0, '>', 500), Compare(0, '<=', 1_500), Compare(2, '!=', 'Drama'))
+        expected = tuple((m[1], m[0]) for m in movies if select(m))[:600]
+        plan = Q(Limit(600), Projection(Columns(1, 0)), Selection(select), ColumnarScanner(pax_path, movie_schema, columns={0, 1, 2}))
+        vectors = list(run_vectors(plan))
+        assert isinstance(vectors[0][1], np.ndarray) and sum(map(vector_len, vectors)) == 600
+        assert tuple(itertools.chain.from_iterable(map(vector_rows, vectors))) == expected
+        plan = Q(Limit(600), Projection(Columns(1, 0)), Selection(select), ColumnarScanner(pax_path, movie_schema))
+        assert tuple(run(plan)) == expected
+        # an opaque predicate still works on vectors, just row by row
+        plan = Q(Selection(lambda x: x[0] % 100 == 0), ColumnarScanner(pax_path, movie_schema, columns={0}))
+        rows = itertools.chain.from_iterable(map(vector_rows, run_vectors(plan)))
+        assert tuple(rows) == tuple((m[0], None, None) for m in movies if m[0] % 100 == 0)
+        # reading no columns at all still counts the rows
+        assert sum(map(vector_len, run_vectors(Q(ColumnarScanner(pax_path, movie_schema, columns=set()))))) == len(movies)
+        assert sum(map(vector_len, run_vectors(Q(Limit(1_234), ColumnarScanner(pax_path, movie_schema, columns=set()))))) == 1_234
+        assert sum(1 for _ in run(Q(ColumnarScanner(pax_path, movie_schema, columns=set())), batch_size=77)) == len(movies)
+        assert sum(1 for _ in run(Q(FileScanner(hf_path, movie_schema, columns=set())))) == len(movies)
+
+        # the optimizer pushes the selection below the sort and into the scan, turns the limit
+        # and sort into a TopN, and only decodes the columns the plan reads
+        plans = (
+            lambda scan: Q(Projection(Columns(0, 1)), Limit(10), Selection(Compare(2, '==', 'Comedy')), Sort(Columns(1), desc=True), scan()),
+            lambda scan: Q(Limit(5), Selection(Compare(0, '<', 'Movie 13')), Projection(Columns(1, 0)), Sort(Columns(1)), scan()),
+            lambda scan: Q(Projection(Columns(0)), Selection(And(Compare(0, '>', 100), Compare(0, '<=', 120))), scan()),
+            lambda scan: Q(Projection(lambda x: x[1]), Selection(lambda x: x[0] % 7 == 0), Sort(lambda x: x[2]), scan()),
+        )
+        for plan in plans:
+            expected = tuple(run(plan(lambda: FileScanner(hf_path, movie_schema))))
+            assert expected
+            for batch_size in (None, 100):
+                assert tuple(run(optimize(plan(lambda: FileScanner(hf_path, movie_schema))), batch_size=batch_size)) == expected
+        plan = optimize(plans[0](lambda: FileScanner(hf_path, movie_schema)))
+        assert [type(n).__name__ for n in (plan, plan.child, plan.child.child)] == ['Projection', 'TopN', 'FileScanner']
+        assert plan.child.child.columns == {0, 1} and isinstance(plan.child.child.predicate, Compare)
+        plan = optimize(plans[1](lambda: FileScanner(hf_path, movie_schema)))
+        assert [type(n).__name__ for n in (plan, plan.child, plan.child.child)] == ['Projection', 'TopN', 'FileScanner']
+        assert plan.child.child.columns == {0, 1} and plan.child.child.predicate.col == 1
+        plan = optimize(plans[2](lambda: FileScanner(hf_path, movie_schema)))
+        assert plan.child.columns == {0}
+        assert next(plan.child) == (101, None, None)
+        plan.close()
+        explain(plans[0](lambda: FileScanner(hf_path, movie_schema))).close()
+
+        # zone maps: pages whose min/max (or Bloom filter) rule out the predicate aren't read
+        num_pages = os.path.getsize(hf_path) // PAGE_SIZE
+        for scanner in (FileScanner, MmapFileScanner):
+            scan = scanner(hf_path, movie_schema, predicate=Compare(0, '==', 1_234))
+            assert tuple(run(Q(scan))) == movies[1_233:1_234]
+            assert (scan.pages_read, scan.pages_skipped) == (1, num_pages - 1)
+        plan = optimize(Q(Selection(And(Compare(0, '>', 500), Compare(0, '<=', 520), Compare(2, '==', 'Comedy'))), FileScanner(hf_path, movie_schema)))
+        assert tuple(run(plan, batch_size=100)) == tuple(m for m in movies if 500 < m[0] <= 520 and m[2] == 'Comedy')
+        assert plan.pages_read <= 2 and 'pages_skipped' in describe(plan)
+        # constants an int column can't hold exactly aren't cast, so pages that match aren't skipped
+        scan = FileScanner(hf_path, movie_schema, predicate=Compare(0, '<', 2.5))
+        assert tuple(run(Q(scan))) == movies[:2] and scan.pages_read == 1
+        assert tuple(run(optimize(Q(Selection(Compare(0, '>', 1_999.5)), FileScanner(hf_path, movie_schema))))) == movies[-1:]
+        assert tuple(run(Q(FileScanner(hf_path, movie_schema, predicate=Compare(0, '<', float('inf')))))) == movies
+        assert tuple(run(Q(FileScanner(hf_path, movie_schema, predicate=Compare(0, '==', float('nan')))))) == ()
+        assert tuple(run(Q(Gather(ordered=True), ParallelScan(hf_path, movie_schema, workers=2, predicate=Compare(0, '>=', 1_990), pages_per_task=4)))) == movies[1_989:]
+        hf.write_to_disk(os.path.join(d, 'bloom.hf'), bloom_columns=(1,))
+        scan = FileScanner(os.path.join(d, 'bloom.hf'), movie_schema, predicate=Compare(1, '==', 'Movie 777'))
+        assert tuple(run(Q(scan))) == movies[776:777] and scan.pages_read <= 2
+        scan = FileScanner(os.path.join(d, 'bloom.hf'), movie_schema, predicate=Compare(1, '==', 'Movie 0'))
+        assert tuple(run(Q(scan))) == () and scan.pages_read <= 1
+        zone_map = heapdb.build_zone_map(os.path.join(d, 'bloom.hf'), movie_schema, bloom_columns=(1,))
+        assert np.array_equal(zone_map.may_match(1, '==', 'Movie 777'), heapdb.ZoneMap.load(os.path.join(d, 'bloom.hf'), movie_schema).may_match(1, '==', 'Movie 777'))
+        # editing the file drops its zone map, so nothing is skipped on stale information
+        with heapdb.HeapTable(os.path.join(d, 'bloom.hf'), movie_schema) as table:
+            table.insert((5_000, 'Movie 5000', 'Drama'))
+        scan = FileScanner(os.path.join(d, 'bloom.hf'), movie_schema, predicate=Compare(0, '==', 5_000))
+        assert tuple(run(Q(scan))) == ((5_000, 'Movie 5000', 'Drama'),) and scan.pages_skipped == 0
+
+        # compressed heap files read back the same through every path, and are smaller
+        cmp_path = os.path.join(d, 'movies.cmp')
+        heapdb.HeapFile(os.path.join(d, 'movies.csv'), dict(movie_schema)).ingest_from_csv(cmp_path, compress=True, dict_columns=(2,))
+        assert os.path.getsize(cmp_path) < os.path.getsize(hf_path) / 2
+
+        # read-ahead: the same rows and the same pages skipped, with any queue depth and chunk
+        # size, from plain and compressed files, and stopping early doesn't leave it hanging
+        for path in (hf_path, cmp_path):
+            for read_ahead, read_chunk in ((1, 1), (4, 1), (16, 4), (3, 8)):
+                for batch_size in (None, 100):
+                    scan = FileScanner(path, movie_schema, read_ahead=read_ahead, read_chunk=read_chunk)
+                    assert tuple(run(Q(scan), batch_size=batch_size)) == movies
+        scan = FileScanner(hf_path, movie_schema, predicate=Compare(0, '>=', 1_990), read_ahead=4, read_chunk=2)
+        assert tuple(run(Q(scan))) == movies[1_989:] and (scan.pages_read, scan.pages_skipped) == (1, num_pages - 1)
+        plan = Q(Limit(3), FileScanner(hf_path, movie_schema, read_ahead=2))
+        assert tuple(run(plan)) == movies[:3]
+        assert 'read_ahead=2' in describe(plan.child)
+        reader = heapdb.ReadAhead(-1, [0, 1])
+        try:
+            reader.next()
+            raise AssertionError("read from a bad fd")
+        except OSError:
+            pass
+        reader.close()
+        # pages listed past the end, as if the file shrank after they were, just end it
+        with open(hf_path, 'rb') as f:
+            reader = heapdb.ReadAhead(f.fileno(), [num_pages - 1, num_pages, num_pages + 1], chunk_pages=1)
+            assert reader.next()[0] == num_pages - 1 and reader.next() is None and reader.next() is None
+            reader.close()
+        for batch_size in (None, 100):
+            assert tuple(run(Q(FileScanner(cmp_path, movie_schema)), batch_size=batch_size)) == movies
+            assert tuple(run(Q(MmapFileScanner(cmp_path, movie_schema)), batch_size=batch_size)) == movies
+        assert tuple(run(Q(Gather(ordered=True), ParallelScan(cmp_path, movie_schema, workers=2, pages_per_task=1)))) == movies
+        assert tuple(run(Q(FileScanner(cmp_path, movie_schema, columns={2}, predicate=Compare(2, '==', 'Drama'))))) == tuple((None, None, 'Drama') for m in movies if m[2] == 'Drama')
+        scanner = FileScanner(cmp_path, movie_schema)
+        rids = dict(scanner.iter_rids())
+        assert tuple(rids.values()) == movies and all(scanner.fetch(rid) == m for rid, m in list(rids.items())[::97])
+        with heapdb.HeapFile(cmp_path, dict(movie_schema)) as heap:
+            assert heap.fetch_many(list(rids)[::97]) == list(movies[::97])
+        assert heap.fd is None
+        assert scanner.fetch_many(list(rids)[::-97]) == list(movies[::-97])
+        scanner.close()
+        scan = FileScanner(cmp_path, movie_schema, predicate=Compare(0, '==', 1_500))
+        assert tuple(run(Q(scan))) == movies[1_499:1_500] and scan.pages_read == 1
+        from_disk = heapdb.HeapFile(cmp_path, dict(movie_schema))
+        from_disk.read_from_disk(cmp_path)
+        assert tuple(from_disk.record_wrapper.decode(p.get_record(i)) for p in from_disk.pages for i in range(p.num_records)) == movies
+        heapdb.compress_heap_file(hf_path, os.path.join(d, 'movies2.cmp'), movie_schema, dict_columns=(1, 2), level=9)
+        assert tuple(heapdb.iter_heap_records(os.path.join(d, 'movies2.cmp'), movie_schema)) == movies
+        try:
+            heapdb.HeapTable(cmp_path, movie_schema)
+            raise AssertionError("compressed files can't be edited")
+        except ValueError:
+            pass
+
+        # buffer pool: repeated queries hit memory, a big scan doesn't evict the hot pages,
+        # and dirty pages are written back
+        pool = heapdb.BufferPool(8, scan_limit=2)
+        num_pages = pool.page_count(hf_path)
+        assert num_pages > 8
+        for batch_size in (None, 100):
+            assert tuple(run(Q(FileScanner(hf_path, movie_schema, pool=pool)), batch_size=batch_size)) == movies
+        assert sorted(run(IndexNestedLoopJoin(CSVScanner(ratings_path, rating_schema), FileScanner(hf_path, movie_schema, pool=pool), index, lambda x: x[0]))) == sorted(r + m for r in ratings for m in movies[r[0] - 1:r[0]])
+        hot = heapdb.HeapFile(hf_path, dict(movie_schema), pool=pool)
+        for _ in range(3):
+            for page_idx in range(4):
+                hot.read_page(hf_path, page_idx)
+        evictions = pool.evictions
+        assert tuple(run(Q(FileScanner(hf_path, movie_schema, pool=pool)))) == movies
+        assert pool.evictions > evictions
+        hits, misses = pool.hits, pool.misses
+        for page_idx in range(4):
+            hot.read_page(hf_path, page_idx)
+        assert (pool.hits, pool.misses) == (hits + 4, misses)
+        assert all(f.pin_count == 0 for f in pool.frames)
+        data = pool.fetch(hf_path, num_pages - 1)
+        data[:] = bytes(PAGE_SIZE)
+        pool.unpin(hf_path, num_pages - 1, dirty=True)
+        pool.close()
+        assert pool.writes == 1
+        with open(hf_path, 'rb') as f:
+            assert f.read()[-PAGE_SIZE:] == bytes(PAGE_SIZE)
+        # rewriting a file drops it from pools that have it cached, and read_from_disk reads
+        # through the pool
+        pool, small_path = heapdb.BufferPool(8), os.path.join(d, 'small.hf')
+        for rows in (movies[:100], movies[:1_000]):
+            with heapdb.HeapFileWriter(small_path, movie_schema) as w:
+                for row in rows:
+                    w.append(row)
+            assert tuple(run(Q(FileScanner(small_path, movie_schema, pool=pool)))) == rows
+        fetches = pool.hits + pool.misses
+        loaded = heapdb.HeapFile(small_path, dict(movie_schema), pool=pool)
+        loaded.read_from_disk(small_path)
+        assert len(loaded.pages) == pool.page_count(small_path) == pool.hits + pool.misses - fetches
+        assert loaded.pages[-1].data == heapdb.HeapFile(small_path, dict(movie_schema)).read_page(small_path, len(loaded.pages) - 1).data
+        # ...even when the rewrite spells the path differently
+        scanner = FileScanner(small_path, movie_schema, pool=pool)
+        assert scanner.fetch((0, 0)) == movies[0]
+        with heapdb.HeapFileWriter(os.path.join(d, '.', 'small.hf'), movie_schema) as w:
+            for row in movies[1:10]:
+                w.append(row)
+        assert scanner.fetch((0, 0)) == movies[1]
+        scanner.close()
+        pool.close()
+
+        # in place edits: inserts, updates and deletes against a dict of what should be there,
+        # with slots reused, pages compacted, and only the changed page written back
+        table_path = os.path.join(d, 'table.hf')
+        heapdb.HeapFile(os.path.join(d, 'movies.csv'), dict(movie_schema)).ingest_from_csv(table_path)
+        pool = heapdb.BufferPool(16)
+        table = heapdb.HeapTable(table_path, movie_schema, pool=pool)
+        oracle = dict(FileScanner(table_path, movie_schema).iter_rids())
+        num_pages = len(table.fsm)
+        writes = pool.writes
+        rid = (num_pages // 2, 3)
+        assert table.update(rid, (1, 'Toy Story', 'Comedy')) == rid
+        table.flush()
+        assert pool.writes == writes + 1 and table.fetch(rid) == (1, 'Toy Story', 'Comedy')
+        oracle[rid] = (1, 'Toy Story', 'Comedy')
+        rng = random.Random(7)
+        for i in range(3_000):
+            op = rng.random()
+            row = (i, 'x' * rng.randint(0, 255), rng.choice(('Comedy', 'Drama')))
+            if op < 0.4 or not oracle:
+                rid = table.insert(row)
+                assert rid not in oracle
+                oracle[rid] = row
+                assert table.fetch(rid) == row
+            elif op < 0.7:
+                rid = rng.choice(list(oracle))
+                table.delete(rid)
+                del oracle[rid]
+                try:
+                    table.fetch(rid)
+                    raise AssertionError("deleted record still there")
+                except IndexError:
+                    pass
+            else:
+                rid = rng.choice(list(oracle))
+                del oracle[rid]
+                rid = table.update(rid, row)
+                oracle[rid] = row
+                assert table.fetch(rid) == row
+        table.close()
+        assert all(len(f.data) == PAGE_SIZE for f in pool.frames) and os.path.getsize(table_path) % PAGE_SIZE == 0
+        assert dict(FileScanner(table_path, movie_schema).iter_rids()) == oracle
+        with heapdb.HeapTable(table_path, movie_schema) as table:
+            assert dict(table.iter_rids()) == oracle
+        assert sorted(run(Q(FileScanner(table_path, movie_schema)), batch_size=100)) == sorted(oracle.values())
+        assert sorted(heapdb.iter_heap_records(table_path, movie_schema)) == sorted(oracle.values())
+        # deleted slots get reused, and the free-space map survives reopening
+        with heapdb.HeapTable(table_path, movie_schema) as table:
+            rid = next(iter(oracle))
+            table.delete(rid)
+            assert table.insert(oracle[rid]) == rid
+        with open(table_path, 'rb') as f:
+            pages = [heapdb.SlottedPage(bytearray(f.read(PAGE_SIZE))) for _ in range(len(table.fsm))]
+        assert all(p.data_end() - p.live_bytes() <= heapdb.SlottedPage.COMPACT_THRESHOLD for p in pages)
+        # a page full of holes is compacted to make room rather than the record going elsewhere
+        page = heapdb.SlottedPage(bytearray(PAGE_SIZE))
+        rids = [page.insert(bytes([i]) * 200) for i in range(39)]
+        assert page.insert(b'z' * 200) is None
+        for i in rids[0:10:2]:
+            page.delete(i)
+        assert page.data_end() - page.live_bytes() == 1_000 and page.insert(b'z' * 1_000) == rids[0]
+        assert page.data_end() == page.live_bytes()
+        assert all(page.buf[page.get(i)] == (ord('z') if i == 0 else i) for i in rids if page.is_live(i))
+        os.remove(table_path + '.fsm')
+        with heapdb.HeapTable(table_path, movie_schema) as table:
+            assert table.fetch(rid) == oracle[rid]
+        # a new slot on a page whose data runs to the end, with a few dead bytes, compacts
+        # first instead of growing the frame past PAGE_SIZE into the next page
+        full_path, codec = os.path.join(d, 'full.hf'), heapdb.RecordCodec(movie_schema)
+        with heapdb.HeapTable(full_path, movie_schema) as table:
+            rids = []
+            while not rids or rids[-1][0] == 0:
+                rids.append(table.insert((len(rids), 'x' * 200, 'Drama')))
+            page = heapdb.SlottedPage(table.pool.fetch(full_path, 0))
+            filler = codec.encode((0, '', 'Drama'))
+            filler = codec.encode((0, 'y' * (page.free_space() - 8 - len(filler)), 'Drama'))
+            assert page.insert(filler) is not None and page.data_start + page.data_end() == PAGE_SIZE
+            table.pool.unpin(full_path, 0, dirty=True)
+            table.update(rids[0], (0, 'x' * 100, 'Drama'))
+            table.flush()
+            with open(full_path, 'rb') as f:
+                next_page = f.read()[PAGE_SIZE:2 * PAGE_SIZE]
+            buf = table.pool.fetch(full_path, 0)
+            assert heapdb.SlottedPage(buf).insert(codec.encode((1, 'z', 'Drama'))) is not None
+            assert len(buf) == PAGE_SIZE
+            table.pool.unpin(full_path, 0, dirty=True)
+            table.flush()
+            with open(full_path, 'rb') as f:
+                assert f.read()[PAGE_SIZE:2 * PAGE_SIZE] == next_page
+
     # print(len(tuple(run(Q(CSVScanner('./movies.csv', movie_schema))))))
     # # top 10 movies, sorted by title
     # print("top 10 movies, sorted by title")
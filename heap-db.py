@@ -10,51 +10,430 @@
 # as a stretch, we can implement a B+ tree index on top of the heap file to speed up queries.
 
 PAGE_SIZE = 8192
+EMPTY_SLOT = bytes(8)
 
-import struct    
-import os
+import bisect
+import collections
+import contextlib
 import csv
-import pytest
+import hashlib
+import json
+import os
+import queue
+import random
+import struct
+import threading
+import weakref
+import zlib
+
+import numpy as np
+
+# fixed width fields and their struct codes. ints keep the original 4 byte unsigned format.
+# floats could never actually be encoded before (float has no to_bytes), so they get a
+# full 8 byte double rather than being squeezed into an int.
+FIXED_WIDTH = {int: "I", float: "d"}
+# the length prefix of a string, one byte
+STR_LEN = tuple(bytes((i,)) for i in range(256))
+# a dictionary encoded string is an index into its column's dictionary
+DICT_CODE = "H"
+DICT_MAX = 0xFFFE
+
+class RecordCodec(object):
+    """
+    Encode/decode records of one schema with functions compiled for that schema.
+
+    The old encode/decode looped over the schema and checked each column's type for every
+    record. Instead we generate straight line code once: each run of fixed width columns is
+    packed/unpacked with a single struct.Struct, and each string is a length byte plus its
+    UTF-8 bytes. heap-db.py and db-query.py both use this, so their formats can't drift.
+
+    The schema can be a dict of name -> type (heap-db.py) or (name, type) pairs (db-query.py).
+
+    dictionaries maps string columns to be dictionary encoded to their list of values; those
+    columns are stored as a uint16 index into it. Encoding a new value adds it to the list.
+    """
+    def __init__(self, schema, dictionaries=None):
+        items = schema.items() if isinstance(schema, dict) else schema
+        self.types = tuple(t for _, t in items)
+        for t in self.types:
+            if t not in FIXED_WIDTH and t != str:
+                raise ValueError(f"Invalid type: {t}")
+        self.dictionaries = dictionaries or {}
+        for i in self.dictionaries:
+            if self.types[i] != str:
+                raise ValueError(f"Only string columns can be dictionary encoded, not column {i}")
+        self.codes = {i: {v: c for c, v in enumerate(d)} for i, d in self.dictionaries.items()}
+        # consecutive columns grouped as (struct or None for a str, [column indexes])
+        self.runs = []
+        for i, t in enumerate(self.types):
+            if t == str and i not in self.dictionaries:
+                self.runs.append((None, [i]))
+            elif self.runs and self.runs[-1][0] is not None:
+                self.runs[-1][1].append(i)
+            else:
+                self.runs.append(("<", [i]))
+        self.runs = [
+            (None if fmt is None else struct.Struct(fmt + "".join(self.struct_code(i) for i in cols)), cols)
+            for fmt, cols in self.runs
+        ]
+        self.encode = self.compile_encode()
+        self.decoders = {}
+        self.decode = self.decoder(range(len(self.types)))
+
+    def struct_code(self, i) -> str:
+        return DICT_CODE if i in self.dictionaries else FIXED_WIDTH[self.types[i]]
+
+    def add_value(self, i, value) -> int:
+        values = self.dictionaries[i]
+        if len(values) > DICT_MAX:
+            raise ValueError(f"Too many distinct values to dictionary encode column {i}")
+        self.codes[i][value] = len(values)
+        values.append(value)
+        return len(values) - 1
+
+    def namespace(self) -> dict:
+        ns = {"STR_LEN": STR_LEN, "add_value": self.add_value}
+        for k, (s, _) in enumerate(self.runs):
+            ns[f"s{k}"] = s
+        for i, values in self.dictionaries.items():
+            ns[f"D{i}"], ns[f"C{i}"] = values, self.codes[i]
+        return ns
+
+    def compile_encode(self):
+        fields = [f"f{i}" for i in range(len(self.types))]
+        lines = [
+            "def encode(record):",
+            f"    {', '.join(fields)}, = record",
+        ]
+        parts = []
+        for k, (s, cols) in enumerate(self.runs):
+            if s is not None:
+                for i in cols:
+                    if i in self.dictionaries:
+                        lines.append(f"    c{i} = C{i}.get(f{i})")
+                        lines.append(f"    if c{i} is None:")
+                        lines.append(f"        c{i} = add_value({i}, f{i})")
+                args = ", ".join(f"c{i}" if i in self.dictionaries else f"{self.types[i].__name__}(f{i})" for i in cols)
+                parts.append(f"s{k}.pack({args})")
+                continue
+            i = cols[0]
+            lines.append(f"    b{i} = f{i}.encode('utf-8')")
+            lines.append(f"    if len(b{i}) > 255:")
+            lines.append(f"        raise ValueError('String too long to encode: ' + repr(f{i}))")
+            parts.extend((f"STR_LEN[len(b{i})]", f"b{i}"))
+        lines.append(f"    return b''.join(({', '.join(parts)},))")
+        ns = self.namespace()
+        exec("\n".join(lines), ns)
+        return ns["encode"]
+
+    def decoder(self, columns):
+        """
+        A function decode(data, idx=0) -> tuple for the record at data[idx], which only decodes
+        the given column indexes and leaves the rest None. Compiled once per set of columns.
+        """
+        columns = frozenset(columns)
+        fn = self.decoders.get(columns)
+        if fn is not None:
+            return fn
+        lines = ["def decode(data, idx=0):"]
+        # nothing after the last column we want needs to be walked over
+        last = max(columns, default=-1)
+        for k, (s, cols) in enumerate(self.runs):
+            if cols[0] > last:
+                break
+            if s is not None:
+                if columns.intersection(cols):
+                    targets = ", ".join(f"f{i}" if i in columns else "_" for i in cols)
+                    lines.append(f"    {targets}, = s{k}.unpack_from(data, idx)")
+                    for i in columns.intersection(self.dictionaries).intersection(cols):
+                        lines.append(f"    f{i} = D{i}[f{i}]")
+                lines.append(f"    idx += {s.size}")
+                continue
+            i = cols[0]
+            if i in columns:
+                lines.append("    n = data[idx]")
+                lines.append(f"    f{i} = data[idx + 1:idx + 1 + n].decode('utf-8')")
+                lines.append("    idx += 1 + n")
+            else:
+                lines.append("    idx += 1 + data[idx]")
+        values = [f"f{i}" if i in columns else "None" for i in range(len(self.types))]
+        lines.append(f"    return ({', '.join(values)},)")
+        ns = self.namespace()
+        exec("\n".join(lines), ns)
+        fn = self.decoders[columns] = ns["decode"]
+        return fn
+
+
 class RecordWrapper (object):
     def __init__(self, schema):
         self.schema = schema
+        self.codec = RecordCodec(schema)
 
     def encode(self, record: tuple) -> bytes:
-        data = b""
-        idx = 0
-        for _, type in self.schema.items():
-            value = record[idx]
-            idx += 1
-            if type == int or type == float:
-                data += type(value).to_bytes(4, "little")
-            elif type == str:
-                bs = value.encode("utf-8")
-                data += len(bs).to_bytes(1, "little") + bs
-            else:
-                raise ValueError(f"Invalid type: {type}")
-        return data
+        return self.codec.encode(record)
 
     def decode(self, data) -> tuple:
-        record = []
-        idx = 0
-        for _, type in self.schema.items():
-            if type == int or type == float:
-                value = int.from_bytes(data[idx:idx+4], "little")
-                idx += 4
-            elif type == str:
-                length = int.from_bytes(data[idx:idx+1], "little")
-                value = data[idx+1:idx+length+1].decode("utf-8")
-                idx += length + 1
-            else:
-                raise ValueError(f"Invalid type: {type}")
-            record.append(value)
-        return tuple(record)
+        return self.codec.decode(data)
+
+class Frame(object):
+    def __init__(self):
+        self.key = None
+        self.data = bytearray(PAGE_SIZE)
+        self.pin_count = 0
+        self.dirty = False
+        self.ref = False
+        self.scan = False
+        # log position of the last change to the page, which must be durable before it's written
+        self.lsn = 0
+
+
+# every BufferPool in this process, so a file that gets rewritten can be dropped from them all
+POOLS = weakref.WeakSet()
+
+
+def invalidate_pools(path):
+    """
+    Forget everything any buffer pool has cached about a file that's being rewritten.
+    """
+    for pool in list(POOLS):
+        pool.invalidate(path)
+
+
+class BufferPool(object):
+    """
+    A fixed number of PAGE_SIZE frames caching pages of any number of heap files, so
+    repeated reads of the same pages don't go back to disk.
+
+    fetch() pins a page in memory until the matching unpin(); pinned pages are never evicted.
+    Pages unpinned as dirty are written back when they're evicted or flushed. Eviction uses
+    the clock algorithm: each frame has a reference bit that's set on access, and the clock
+    hand clears bits as it sweeps until it finds an unpinned frame with a clear bit.
+
+    Sequential scans should fetch with scan=True. Those pages go into a small ring of at
+    most scan_limit frames which they recycle among themselves, so scanning a huge file
+    can't push the hot working set out of the pool. A scanned page that's later fetched
+    normally is promoted out of the ring.
+
+    With a write-ahead log (heap-wal.py) attached as pool.wal, a dirty page is only written
+    back once the log is durable up to the page's last change.
+
+    Files are known by their real path, so different spellings of one path share its frames.
+    A file's page count is read when the pool first opens it. HeapFileWriter and
+    write_to_disk call invalidate_pools when they rewrite a file, so no pool goes on serving
+    its old pages.
+    """
+    def __init__(self, capacity_pages, scan_limit=None):
+        if capacity_pages < 1:
+            raise ValueError("The buffer pool needs at least one frame")
+        self.capacity = capacity_pages
+        self.scan_limit = scan_limit or max(1, capacity_pages // 4)
+        self.frames = []
+        self.page_table = {}
+        self.hand = 0
+        self.scan_ring = collections.deque()
+        self.fds = {}
+        self.num_pages = {}
+        # path as given -> os.path.realpath(path), which is what frames are keyed by
+        self.real_paths = {}
+        self.wal = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writes = 0
+        POOLS.add(self)
+
+    def real_path(self, path):
+        real = self.real_paths.get(path)
+        if real is None:
+            real = self.real_paths[path] = os.path.realpath(path)
+        return real
+
+    def fd(self, path):
+        path = self.real_path(path)
+        fd = self.fds.get(path)
+        if fd is None:
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except PermissionError:
+                fd = os.open(path, os.O_RDONLY)
+            self.fds[path] = fd
+            self.num_pages[path] = os.fstat(fd).st_size // PAGE_SIZE
+        return fd
+
+    def page_count(self, path) -> int:
+        """
+        Number of pages in the file, including new pages that haven't been written back yet.
+        """
+        path = self.real_path(path)
+        self.fd(path)
+        return self.num_pages[path]
+
+    def fetch(self, path, page_idx, scan=False) -> bytearray:
+        """
+        Pin the page and return its frame's buffer. It must be handed back with unpin.
+        """
+        path = self.real_path(path)
+        key = (path, page_idx)
+        frame = self.page_table.get(key)
+        if frame is not None:
+            self.hits += 1
+            if frame.scan and not scan:
+                frame.scan = False
+            frame.ref = True
+            frame.pin_count += 1
+            return frame.data
+        if page_idx < 0 or page_idx >= self.page_count(path):
+            raise IndexError(f"Page {page_idx} is past the end of {path}")
+        self.misses += 1
+        frame = self.victim(scan)
+        n = os.preadv(self.fd(path), [frame.data], page_idx * PAGE_SIZE)
+        if n < PAGE_SIZE:
+            frame.data[n:] = bytes(PAGE_SIZE - n)
+        self.install(frame, key, scan)
+        return frame.data
+
+    def new_page(self, path):
+        """
+        Add an empty page to the end of the file. Returns (page_idx, buffer), pinned and dirty.
+        """
+        path = self.real_path(path)
+        page_idx = self.page_count(path)
+        frame = self.victim(False)
+        frame.data[:] = bytes(PAGE_SIZE)
+        self.install(frame, (path, page_idx), False)
+        frame.dirty = True
+        self.num_pages[path] = page_idx + 1
+        return page_idx, frame.data
+
+    def install(self, frame, key, scan):
+        frame.key = key
+        frame.pin_count = 1
+        frame.dirty = False
+        frame.lsn = 0
+        frame.ref = not scan
+        frame.scan = scan
+        self.page_table[key] = frame
+        if scan:
+            self.scan_ring.append(frame)
+
+    def unpin(self, path, page_idx, dirty=False, lsn=0):
+        frame = self.page_table[(self.real_path(path), page_idx)]
+        if frame.pin_count <= 0:
+            raise ValueError(f"Page {page_idx} of {path} isn't pinned")
+        frame.pin_count -= 1
+        frame.dirty = frame.dirty or dirty
+        frame.lsn = max(frame.lsn, lsn)
+
+    @contextlib.contextmanager
+    def page(self, path, page_idx, scan=False):
+        """
+        with pool.page(path, idx) as data: ... pins the page for the body of the with.
+        """
+        data = self.fetch(path, page_idx, scan)
+        try:
+            yield data
+        finally:
+            self.unpin(path, page_idx)
+
+    def victim(self, scan) -> Frame:
+        """
+        Find a frame to load a new page into, evicting (and writing back) a page if needed.
+        """
+        if scan:
+            # drop frames that were promoted or reused since they joined the ring
+            self.scan_ring = collections.deque(dict.fromkeys(f for f in self.scan_ring if f.scan and f.key is not None))
+            if len(self.scan_ring) >= self.scan_limit:
+                for frame in self.scan_ring:
+                    if frame.pin_count == 0:
+                        self.scan_ring.remove(frame)
+                        self.evict(frame)
+                        return frame
+        if len(self.frames) < self.capacity:
+            frame = Frame()
+            self.frames.append(frame)
+            return frame
+        for _ in range(2 * len(self.frames)):
+            frame = self.frames[self.hand]
+            self.hand = (self.hand + 1) % len(self.frames)
+            if frame.pin_count > 0:
+                continue
+            if frame.ref:
+                frame.ref = False
+                continue
+            self.evict(frame)
+            return frame
+        raise RuntimeError("Every page in the buffer pool is pinned")
+
+    def evict(self, frame):
+        if frame.key is None:
+            return
+        if frame.dirty:
+            self.write_back(frame)
+        del self.page_table[frame.key]
+        frame.key = None
+        frame.scan = False
+        self.evictions += 1
+
+    def write_back(self, frame):
+        path, page_idx = frame.key
+        if self.wal is not None and frame.lsn:
+            self.wal.flush(frame.lsn)
+        os.pwrite(self.fd(path), frame.data, page_idx * PAGE_SIZE)
+        frame.dirty = False
+        self.writes += 1
+
+    def flush(self, path=None):
+        """
+        Write back every dirty page (of one file, if path is given).
+        """
+        if path is not None:
+            path = self.real_path(path)
+        for frame in self.frames:
+            if frame.key is not None and frame.dirty and (path is None or frame.key[0] == path):
+                self.write_back(frame)
+
+    def sync(self):
+        """
+        fsync every file the pool has open.
+        """
+        for fd in self.fds.values():
+            os.fsync(fd)
+
+    def invalidate(self, path):
+        """
+        Drop the file's frames (without writing them back), its fd and its page count, for
+        when it's been rewritten behind the pool's back.
+        """
+        path = self.real_path(path)
+        for frame in self.frames:
+            if frame.key is not None and frame.key[0] == path:
+                if frame.pin_count > 0:
+                    raise ValueError(f"Page {frame.key[1]} of {path} is pinned")
+                del self.page_table[frame.key]
+                frame.key = None
+                frame.dirty = False
+                frame.scan = False
+        fd = self.fds.pop(path, None)
+        if fd is not None:
+            os.close(fd)
+        self.num_pages.pop(path, None)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "writes": self.writes}
+
+    def close(self):
+        self.flush()
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+        self.num_pages = {}
 
 class Page(object):
     def __init__(self, page_num):
         self.page_num = page_num
         self.records = []
-        self.data = b''
+        # a bytearray so add_record appends in place instead of copying the page every time
+        self.data = bytearray()
         self.free_ptr = 0
         self.fill_factor = 0.8
 
@@ -65,7 +444,8 @@ class Page(object):
     @property
     def free_space(self):
         "Stop filling when we are half full."
-        free_space = (PAGE_SIZE * self.fill_factor) - len(self.data)
+        # the 8 byte page header and an 8 byte slot per record (including the next one) live on the page too
+        free_space = (PAGE_SIZE * self.fill_factor) - 8 - 8 * (self.num_records + 1) - len(self.data)
         return free_space
 
     def add_record(self, record: bytes):
@@ -86,32 +466,574 @@ class Page(object):
     def delete_record(self, record_num):
         self.records[record_num] = (self.records[record_num][0], self.records[record_num][1], 0)
 
+    @classmethod
+    def from_bytes(cls, chunk):
+        """
+        Parse a page as written by HeapFile.write_to_disk.
+        """
+        page_num, num_records = struct.unpack_from("II", chunk)
+        page = cls(page_num)
+        slots = struct.unpack_from(f"{2 * num_records}I", chunk, 8)
+        # an empty slot is a deleted record
+        page.records = [(slots[i], slots[i + 1], int(slots[i] != slots[i + 1])) for i in range(0, 2 * num_records, 2)]
+        page.data = bytearray(chunk[8 + num_records * 8:])
+        page.free_ptr = len(page.data)
+        return page
+
+# zone maps: a side file <heap file>.zm with, for every page, the min and max of each numeric
+# column and optionally a Bloom filter of the values of chosen columns, so a scan with a
+# declarative predicate can skip pages that can't have a match without reading them.
+#
+#   magic, num_pages, num numeric columns, num bloom columns, bytes per filter
+#   numeric column indexes, bloom column indexes     uint16 each
+#   mins, then maxes                                 num_pages x num numeric float64
+#   filters                                          num_pages x num bloom x bytes per filter
+
+ZONE_MAP_HEADER = struct.Struct("<8sIHHH")
+ZONE_MAP_MAGIC = b"ZONEMAP1"
+BLOOM_HASHES = 3
+
+def bloom_key(value) -> bytes:
+    if isinstance(value, str):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return struct.pack("<d", value)
+    return value.to_bytes(8, "little", signed=True)
+
+
+def bloom_bits(value, num_bits) -> list:
+    """
+    The filter bits a value sets, by double hashing the two halves of a 64 bit hash of it.
+    """
+    h = int.from_bytes(hashlib.blake2b(bloom_key(value), digest_size=8).digest(), "little")
+    h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+    return [(h1 + i * h2) % num_bits for i in range(BLOOM_HASHES)]
+
+
+class ZoneMap(object):
+    """
+    Per page min/max of the numeric columns, and Bloom filters of bloom_columns.
+
+    Writers call add(row) for every row and end_page() after every page, then save(). Scans
+    load() it and ask may_match(col, op, value) for a mask of the pages that could have rows
+    matching `row[col] op value`.
+    """
+    def __init__(self, schema, bloom_columns=(), bloom_bytes=128):
+        self.types = schema_types(schema)
+        self.numeric = tuple(i for i, t in enumerate(self.types) if t in FIXED_WIDTH)
+        self.bloom_columns = tuple(bloom_columns)
+        self.bloom_bytes = bloom_bytes
+        self.mins, self.maxs, self.blooms = [], [], []
+        self.values = [[] for _ in self.types]
+        for i in self.bloom_columns:
+            if not 0 <= i < len(self.types):
+                raise ValueError(f"No column {i} to build a Bloom filter on")
+
+    @property
+    def num_pages(self) -> int:
+        return len(self.mins)
+
+    def add(self, row):
+        for i in self.numeric + self.bloom_columns:
+            self.values[i].append(row[i])
+
+    def end_page(self):
+        mins, maxs = [], []
+        for i in self.numeric:
+            values = list(map(self.types[i], self.values[i]))
+            # an empty page can't match anything
+            mins.append(min(values, default=float("inf")))
+            maxs.append(max(values, default=float("-inf")))
+        blooms = []
+        for i in self.bloom_columns:
+            bits = 0
+            for value in set(map(self.types[i], self.values[i])):
+                for bit in bloom_bits(value, 8 * self.bloom_bytes):
+                    bits |= 1 << bit
+            blooms.append(bits.to_bytes(self.bloom_bytes, "little"))
+        self.mins.append(mins)
+        self.maxs.append(maxs)
+        self.blooms.append(b"".join(blooms))
+        self.values = [[] for _ in self.types]
+
+    def save(self, heap_path):
+        with open(heap_path + ".zm", "wb") as f:
+            f.write(ZONE_MAP_HEADER.pack(ZONE_MAP_MAGIC, self.num_pages, len(self.numeric), len(self.bloom_columns), self.bloom_bytes))
+            f.write(struct.pack(f"<{len(self.numeric) + len(self.bloom_columns)}H", *self.numeric, *self.bloom_columns))
+            f.write(np.array(self.mins, dtype="<f8").tobytes())
+            f.write(np.array(self.maxs, dtype="<f8").tobytes())
+            f.write(b"".join(self.blooms))
+
+    @classmethod
+    def load(cls, heap_path, schema):
+        """
+        The heap file's zone map, or None if it hasn't got one or it's out of date.
+        """
+        try:
+            with open(heap_path + ".zm", "rb") as f:
+                data = f.read()
+            num_pages_on_disk = os.path.getsize(heap_path) // PAGE_SIZE
+        except FileNotFoundError:
+            return None
+        magic, num_pages, num_numeric, num_bloom, bloom_bytes = ZONE_MAP_HEADER.unpack_from(data)
+        if magic != ZONE_MAP_MAGIC or num_pages != num_pages_on_disk:
+            return None
+        cols = struct.unpack_from(f"<{num_numeric + num_bloom}H", data, ZONE_MAP_HEADER.size)
+        zone_map = cls(schema, cols[num_numeric:], bloom_bytes)
+        pos = ZONE_MAP_HEADER.size + 2 * len(cols)
+        size = num_pages * num_numeric
+        zone_map.mins = np.frombuffer(data, dtype="<f8", count=size, offset=pos).reshape(num_pages, num_numeric)
+        zone_map.maxs = np.frombuffer(data, dtype="<f8", count=size, offset=pos + 8 * size).reshape(num_pages, num_numeric)
+        zone_map.blooms = np.frombuffer(data, dtype=np.uint8, offset=pos + 16 * size).reshape(num_pages, num_bloom, bloom_bytes)
+        return zone_map
+
+    def may_match(self, col, op, value):
+        """
+        Boolean mask of the pages that might have a row with `row[col] op value`.
+        """
+        everything = np.ones(self.num_pages, dtype=bool)
+        mask = everything
+        if col in self.numeric:
+            j = self.numeric.index(col)
+            lo, hi = self.mins[:, j], self.maxs[:, j]
+            # against the constant as given: cast to the column's type, 2.5 would become 2
+            # and inf wouldn't convert at all
+            try:
+                mask = {
+                    "==": (lo <= value) & (value <= hi),
+                    "!=": ~((lo == value) & (hi == value)),
+                    "<": lo < value,
+                    "<=": lo <= value,
+                    ">": hi > value,
+                    ">=": hi >= value,
+                }[op]
+            except Exception:
+                return everything
+        if op == "==" and col in self.bloom_columns:
+            # the Bloom filters hash the column's values, so they need the constant as one,
+            # and one the column can't hold exactly can't be looked up
+            try:
+                key = self.types[col](value)
+                if key != value:
+                    return mask
+            except Exception:
+                return mask
+            j = self.bloom_columns.index(col)
+            for bit in bloom_bits(key, 8 * self.bloom_bytes):
+                mask = mask & (self.blooms[:, j, bit // 8] & (1 << (bit % 8)) != 0)
+        return mask
+
+
+def remove_zone_map(heap_path):
+    """
+    Drop a heap file's zone map when it's rewritten or edited, before it can be wrong.
+    """
+    try:
+        os.remove(heap_path + ".zm")
+    except FileNotFoundError:
+        pass
+
+
+def build_zone_map(in_file, schema, bloom_columns=()):
+    """
+    Build and save a zone map for an existing row format heap file.
+    """
+    zone_map = ZoneMap(schema, bloom_columns)
+    for records in iter_heap_pages(in_file, schema):
+        for record in records:
+            zone_map.add(record)
+        zone_map.end_page()
+    zone_map.save(in_file)
+    return ZoneMap.load(in_file, schema)
+
+
+class HeapFileWriter(object):
+    """
+    Stream records straight into a heap file, for bulk loads too big to keep every Page in
+    memory until write_to_disk.
+
+    Records are copied into one preallocated page sized bytearray. When the next record
+    wouldn't fit (by the same rule as Page.free_space, so the file comes out byte for byte
+    the same as write_to_disk's), the header, slots and data are laid out into a write buffer
+    of buffer_pages pages, which goes to the file in one large write when it fills up.
+    Memory use is the same however big the input is.
+
+    It also writes the file's ZoneMap, unless zone_map is False.
+    """
+    def __init__(self, out_file, schema, fill_factor=0.8, buffer_pages=64, zone_map=True, bloom_columns=()):
+        self.codec = RecordCodec(schema)
+        self.out_file = out_file
+        self.zone_map = ZoneMap(schema, bloom_columns) if zone_map else None
+        remove_zone_map(out_file)
+        remove_stats(out_file)
+        invalidate_pools(out_file)
+        self.file = open(out_file, "wb")
+        self.limit = PAGE_SIZE * fill_factor
+        self.data = bytearray(PAGE_SIZE)
+        self.free_ptr = 0
+        # (start, end) of each record on the current page, flattened
+        self.slots = []
+        self.buffer = bytearray(PAGE_SIZE * buffer_pages)
+        self.buffered = 0
+        self.page_num = 0
+        self.num_records = 0
+
+    def append(self, row):
+        record = self.codec.encode(row)
+        size = len(record)
+        if self.limit - 8 - 4 * (len(self.slots) + 2) - self.free_ptr < size:
+            if 16 + size > PAGE_SIZE:
+                raise ValueError("Record is too large for a page")
+            if self.slots:
+                self.flush_page()
+        self.data[self.free_ptr:self.free_ptr + size] = record
+        if self.zone_map is not None:
+            self.zone_map.add(row)
+        self.slots += (self.free_ptr, self.free_ptr + size)
+        self.free_ptr += size
+        self.num_records += 1
+
+    def flush_page(self):
+        num_records = len(self.slots) // 2
+        pos = self.buffered * PAGE_SIZE
+        struct.pack_into(f"II{len(self.slots)}I", self.buffer, pos, self.page_num, num_records, *self.slots)
+        data_start = pos + 8 + 8 * num_records
+        data_end = data_start + self.free_ptr
+        self.buffer[data_start:data_end] = memoryview(self.data)[:self.free_ptr]
+        self.buffer[data_end:pos + PAGE_SIZE] = bytes(pos + PAGE_SIZE - data_end)
+        self.page_written()
+        self.slots = []
+        self.free_ptr = 0
+
+    def page_written(self):
+        """
+        Account for the page just laid out in the write buffer, writing it out if it's full.
+        """
+        self.page_num += 1
+        self.buffered += 1
+        if self.zone_map is not None:
+            self.zone_map.end_page()
+        if self.buffered * PAGE_SIZE == len(self.buffer):
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        self.file.write(memoryview(self.buffer)[:self.buffered * PAGE_SIZE])
+        self.buffered = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.slots:
+            self.flush_page()
+        self.flush_buffer()
+        self.file.close()
+        if self.zone_map is not None:
+            self.zone_map.save(self.out_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# compressed heap files: the same 8192 byte pages, but each one holds a zlib compressed
+# "logical" page, laid out just like a plain page (header, slots, data) but as big as it
+# needs to be, so a physical page holds however many records compress into it. Chosen string
+# columns are dictionary encoded (see RecordCodec) with one dictionary for the whole file,
+# kept in footer pages at the end. Pages are told apart by flags in the num_records field:
+#
+#   plain       page_num, num_records, slots, data
+#   compressed  page_num, COMPRESSED_PAGE | payload length, zlib payload
+#   footer      page_num, FOOTER_PAGE | chunk length, footer page index, number of footer
+#               pages, then a chunk of the zlib compressed JSON of the dictionaries
+#
+# Readers see compressed pages through logical_page, and footer pages as empty pages.
+
+COMPRESSED_PAGE = 1 << 31
+FOOTER_PAGE = 1 << 30
+PAGE_LENGTH = FOOTER_PAGE - 1
+FOOTER_HEADER = struct.Struct("<IIII")
+EMPTY_PAGE = bytes(8)
+
+def logical_page(page):
+    """
+    The page in the plain layout: itself if it's plain, decompressed if it's compressed, and
+    an empty page if it's a footer page.
+    """
+    flags = int.from_bytes(page[4:8], "little")
+    if flags & COMPRESSED_PAGE:
+        return zlib.decompress(page[8:8 + (flags & PAGE_LENGTH)])
+    if flags & FOOTER_PAGE:
+        return EMPTY_PAGE
+    return page
+
+
+def read_dictionaries(fd):
+    """
+    The dictionaries from a compressed heap file's footer, or None for a plain heap file.
+    """
+    size = os.fstat(fd).st_size
+    if size < PAGE_SIZE:
+        return None
+    last = os.pread(fd, PAGE_SIZE, size - PAGE_SIZE)
+    _, flags, _, num_footer = FOOTER_HEADER.unpack_from(last)
+    if not flags & FOOTER_PAGE:
+        return None
+    chunks = []
+    for i in range(num_footer):
+        page = os.pread(fd, PAGE_SIZE, size - (num_footer - i) * PAGE_SIZE)
+        length = int.from_bytes(page[4:8], "little") & PAGE_LENGTH
+        chunks.append(page[FOOTER_HEADER.size:FOOTER_HEADER.size + length])
+    meta = json.loads(zlib.decompress(b"".join(chunks)))
+    return {int(i): values for i, values in meta["dictionaries"].items()}
+
+
+def file_codec(fd, schema) -> RecordCodec:
+    """
+    The codec for the records of a heap file, plain or compressed.
+    """
+    return RecordCodec(schema, read_dictionaries(fd))
+
+
+class CompressedHeapFileWriter(HeapFileWriter):
+    """
+    Write a compressed heap file, dictionary encoding the dict_columns.
+
+    Records are collected until, going by how well the last page compressed, they'd fill a
+    page compressed. If they don't fit after all, records come off the end (to start the
+    next page) until they do.
+    """
+    CAPACITY = PAGE_SIZE - 8
+
+    def __init__(self, out_file, schema, dict_columns=(), level=6, buffer_pages=64, zone_map=True, bloom_columns=()):
+        super().__init__(out_file, schema, buffer_pages=buffer_pages, zone_map=zone_map, bloom_columns=bloom_columns)
+        self.dictionaries = {i: [] for i in dict_columns}
+        self.codec = RecordCodec(schema, self.dictionaries)
+        self.level = level
+        self.records = []
+        self.rows = []
+        self.size = 8
+        # compressed size / uncompressed size of the last page
+        self.ratio = 0.5
+
+    def append(self, row):
+        record = self.codec.encode(row)
+        if 16 + len(record) > PAGE_SIZE:
+            raise ValueError("Record is too large for a page")
+        self.records.append(record)
+        if self.zone_map is not None:
+            self.rows.append(row)
+        self.size += 8 + len(record)
+        self.num_records += 1
+        if self.size * self.ratio >= self.CAPACITY:
+            self.flush_page()
+
+    def flush_page(self):
+        n = len(self.records)
+        while True:
+            logical = self.layout(self.records[:n])
+            payload = zlib.compress(logical, self.level)
+            if len(payload) <= self.CAPACITY:
+                break
+            if n == 1:
+                raise ValueError("Record is too large for a page")
+            n = max(1, min(n - 1, int(n * self.CAPACITY / len(payload) * 0.95)))
+        self.ratio = len(payload) / len(logical)
+        self.buffer_page(struct.pack("II", self.page_num, COMPRESSED_PAGE | len(payload)) + payload)
+        if self.zone_map is not None:
+            for row in self.rows[:n]:
+                self.zone_map.add(row)
+            self.rows = self.rows[n:]
+        self.page_written()
+        self.records = self.records[n:]
+        self.size = 8 + sum(8 + len(r) for r in self.records)
+
+    def layout(self, records) -> bytes:
+        slots, pos = [], 0
+        for record in records:
+            slots += (pos, pos + len(record))
+            pos += len(record)
+        return struct.pack(f"II{len(slots)}I", self.page_num, len(records), *slots) + b"".join(records)
+
+    def buffer_page(self, data):
+        pos = self.buffered * PAGE_SIZE
+        self.buffer[pos:pos + len(data)] = data
+        self.buffer[pos + len(data):pos + PAGE_SIZE] = bytes(PAGE_SIZE - len(data))
+
+    def write_footer(self):
+        meta = {"dictionaries": {str(i): values for i, values in self.dictionaries.items()}}
+        blob = zlib.compress(json.dumps(meta).encode("utf-8"), self.level)
+        size = PAGE_SIZE - FOOTER_HEADER.size
+        chunks = [blob[i:i + size] for i in range(0, len(blob), size)]
+        for i, chunk in enumerate(chunks):
+            self.buffer_page(FOOTER_HEADER.pack(self.page_num, FOOTER_PAGE | len(chunk), i, len(chunks)) + chunk)
+            self.page_written()
+
+    def close(self):
+        if self.file.closed:
+            return
+        while self.records:
+            self.flush_page()
+        self.write_footer()
+        super().close()
+
+
+def compress_heap_file(in_file, out_file, schema, dict_columns=(), level=6):
+    """
+    Rewrite a heap file (plain or compressed) as a compressed one.
+    """
+    with CompressedHeapFileWriter(out_file, schema, dict_columns, level) as writer:
+        for record in iter_heap_records(in_file, schema):
+            writer.append(record)
+
+
+def page_record(page, row_idx, codec) -> tuple:
+    """
+    Decode the record in a slot of a (logical) page.
+    """
+    num_records = int.from_bytes(page[4:8], "little")
+    if row_idx >= num_records:
+        raise IndexError(f"No record in slot {row_idx}")
+    start, end = struct.unpack_from("II", page, 8 + 8 * row_idx)
+    if start == end:
+        raise IndexError(f"The record in slot {row_idx} was deleted")
+    return codec.decode(page, 8 + 8 * num_records + start)
+
+
+def fetch_rids(rids, read_page, codec) -> list:
+    """
+    Records for (page_idx, row_idx) RIDs, in the order given, calling read_page(page_idx)
+    once per distinct page, in page order.
+    """
+    by_page = collections.defaultdict(list)
+    num_rids = 0
+    for i, (page_idx, row_idx) in enumerate(rids):
+        by_page[page_idx].append((i, row_idx))
+        num_rids += 1
+    out = [None] * num_rids
+    for page_idx in sorted(by_page):
+        page = read_page(page_idx)
+        for i, row_idx in by_page[page_idx]:
+            out[i] = page_record(page, row_idx, codec)
+    return out
+
+
+class ReadAhead(object):
+    """
+    Read the given pages of a file in a background thread, keeping up to depth of them
+    queued ahead of the consumer, so the I/O for later pages overlaps with decoding earlier
+    ones. Runs of consecutive pages are read up to chunk_pages at a time, with one pread.
+
+    next() returns (page_idx, page bytes) in the order given, or None after the last page
+    (or the end of the file). An error in the reader is raised from next().
+    """
+    def __init__(self, fd, pages, depth=8, chunk_pages=1):
+        self.pages = list(pages)
+        self.chunk_pages = max(chunk_pages, 1)
+        # the queue holds chunks, so depth pages is this many of them
+        self.queue = queue.Queue(max(depth // self.chunk_pages, 1))
+        self.stopped = threading.Event()
+        self.chunk = iter(())
+        self.done = False
+        self.thread = threading.Thread(target=self.run, args=(fd,), daemon=True)
+        self.thread.start()
+
+    def run(self, fd):
+        try:
+            pages, i = self.pages, 0
+            while i < len(pages) and not self.stopped.is_set():
+                j = i + 1
+                while j < len(pages) and j - i < self.chunk_pages and pages[j] == pages[j - 1] + 1:
+                    j += 1
+                data = os.pread(fd, (j - i) * PAGE_SIZE, pages[i] * PAGE_SIZE)
+                n = min(j - i, len(data) // PAGE_SIZE)
+                if n:
+                    self.put([(pages[i + k], data[k * PAGE_SIZE:(k + 1) * PAGE_SIZE]) for k in range(n)])
+                if n < j - i:
+                    # the file got shorter since the pages were listed
+                    break
+                i = j
+        except Exception as e:
+            self.put(e)
+        self.put(None)
+
+    def put(self, item):
+        # give up if the consumer has gone away, rather than block on a full queue forever
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next(self):
+        while True:
+            item = next(self.chunk, None)
+            if item is not None or self.done:
+                return item
+            chunk = self.queue.get()
+            if isinstance(chunk, Exception):
+                self.done = True
+                raise chunk
+            if chunk is None:
+                self.done = True
+                return None
+            self.chunk = iter(chunk)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+
+
 class HeapFile(object):
-    def __init__(self, file_path, schema):
+    def __init__(self, file_path, schema, pool=None):
         self.file_path = file_path
+        self.schema = schema
+        # optional BufferPool that read_page and fetch go through
+        self.pool = pool
         self.pages = []
         self.page_idx = 0
         self.record_idx = 0
         self.record_wrapper = RecordWrapper(schema)
+        # for fetch: the heap file opened for positioned reads, and the codec for its records
+        self.fd = None
+        self.codec = None
 
-    def ingest_from_csv(self):
-        with open(self.file_path, "r") as f:
+    def ingest_from_csv(self, out_file=None, bloom_columns=(), compress=False, dict_columns=()):
+        """
+        Load the CSV into pages in memory, or with out_file, stream it straight into a heap
+        file on disk with a HeapFileWriter (a CompressedHeapFileWriter with compress),
+        keeping no pages in memory.
+        """
+        with open(self.file_path, "r", newline="", buffering=1 << 20) as f:
             reader = csv.reader(f)
             # skip header
             next(reader)
+            if out_file is not None:
+                if compress:
+                    writer = CompressedHeapFileWriter(out_file, self.schema, dict_columns, bloom_columns=bloom_columns)
+                else:
+                    writer = HeapFileWriter(out_file, self.schema, bloom_columns=bloom_columns)
+                with writer:
+                    for row in reader:
+                        writer.append(row)
+                return
             for row in reader:
-                record = self.record_wrapper.encode(row)
-                if self.page_idx >= len(self.pages):
-                    self.pages.append(Page(self.page_idx))
-                curr_space = self.pages[self.page_idx].free_space
-                if curr_space < len(record):
-                    self.page_idx += 1
-                    self.pages.append(Page(self.page_idx))
-
-                self.pages[self.page_idx].add_record(record)
+                self.append(row)
 
         self.page_idx = 0
-    def write_to_disk(self, out_file):
+
+    def append(self, row):
+        """
+        Encode a record and add it to the last page, starting a new page if it's full.
+        """
+        record = self.record_wrapper.encode(row)
+        if not self.pages or self.pages[-1].free_space < len(record):
+            self.pages.append(Page(len(self.pages)))
+        self.pages[-1].add_record(record)
+
+    def write_to_disk(self, out_file, zone_map=True, bloom_columns=()):
         """
         Write it to a custom file format on disk.
         
@@ -124,37 +1046,104 @@ class HeapFile(object):
             3. write the actual data from the program..
             
         Since we made sure we left empty space, you should be able to add this and still stay under 8192 bytes for python's
-        standard buffer size. It's okay to write a few empty bytes, we'll fix it in the future."""
+        standard buffer size. It's okay to write a few empty bytes, we'll fix it in the future.
+
+        Unless zone_map is False, the file's ZoneMap is written alongside it."""
+        remove_zone_map(out_file)
+        remove_stats(out_file)
+        invalidate_pools(out_file)
+        zm = ZoneMap(self.schema, bloom_columns) if zone_map else None
         with open(out_file, "wb") as f:
             for page in self.pages:
+                if zm is not None:
+                    for i in range(page.num_records):
+                        if page.is_valid(i):
+                            zm.add(self.record_wrapper.decode(page.get_record(i)))
+                    zm.end_page()
                 page_num, num_records, slots, data = page.page_num, page.num_records, page.records, page.data
                 f.write(struct.pack("II", page_num, num_records))
-                for slot in slots:
-                    f.write(struct.pack("II", slot[0], slot[1]))
+                for start, end, valid in slots:
+                    # deleted records are written as empty slots
+                    f.write(struct.pack("II", start, end) if valid else EMPTY_SLOT)
                 f.write(data)
                 # calculate the amount of padding needed to make the page size 8192
                 padding = PAGE_SIZE - (8 + (num_records * 8) + len(data))
                 f.write(b'\x00' * padding)
+        if zm is not None:
+            zm.save(out_file)
 
 
     def read_from_disk(self, in_file):
         with open(in_file, "rb") as f:
+            if read_dictionaries(f.fileno()) is not None:
+                # a compressed file's pages hold more than a plain page can, so repaginate
+                for record in iter_heap_records(in_file, self.schema):
+                    self.append(record)
+                return
+            if self.pool is not None:
+                # as a scan, so loading a big file doesn't push everything else out of the pool
+                for page_idx in range(self.pool.page_count(in_file)):
+                    with self.pool.page(in_file, page_idx, scan=True) as data:
+                        self.pages.append(Page.from_bytes(data))
+                return
             chunk = f.read(PAGE_SIZE)
             while chunk:
-                page_num, num_records = struct.unpack("II", chunk[:8])
-                page = Page(page_num)
-                chunk_pos = 8
-                for _ in range(num_records):
-                    start, end = struct.unpack("II", chunk[chunk_pos:chunk_pos+8])
-                    chunk_pos += 8
-                    page.records.append((start, end, 1))
-                
-                page.data = chunk[chunk_pos:]
-                page.free_ptr = len(page.data)
-                self.pages.append(page)
+                self.pages.append(Page.from_bytes(chunk))
                 chunk = f.read(PAGE_SIZE)
 
-    
+    def read_page(self, in_file, page_idx) -> Page:
+        """
+        Read a single page, through the buffer pool if we have one, instead of loading the
+        whole file with read_from_disk.
+        """
+        if self.pool is None:
+            with open(in_file, "rb") as f:
+                chunk = os.pread(f.fileno(), PAGE_SIZE, page_idx * PAGE_SIZE)
+            if len(chunk) < PAGE_SIZE:
+                raise IndexError(f"Page {page_idx} is past the end of {in_file}")
+            return Page.from_bytes(chunk)
+        with self.pool.page(in_file, page_idx) as data:
+            return Page.from_bytes(data)
+
+    def fetch(self, rid) -> tuple:
+        """
+        Read the record with the given (page_idx, row_idx) record ID straight from the heap
+        file at file_path, with a positioned read of just its page.
+        """
+        return self.fetch_many([rid])[0]
+
+    def fetch_many(self, rids) -> list:
+        """
+        Records for a batch of RIDs, in the same order. The RIDs are grouped by page and the
+        pages read in file order, so each page is read once however many of them it holds.
+        """
+        if self.fd is None:
+            self.fd = os.open(self.file_path, os.O_RDONLY)
+            self.codec = file_codec(self.fd, self.schema)
+        return fetch_rids(rids, self.read_page_bytes, self.codec)
+
+    def read_page_bytes(self, page_idx):
+        if self.pool is not None:
+            if page_idx >= self.pool.page_count(self.file_path):
+                raise IndexError(f"Page {page_idx} is past the end of {self.file_path}")
+            with self.pool.page(self.file_path, page_idx) as data:
+                return logical_page(bytes(data))
+        page = os.pread(self.fd, PAGE_SIZE, page_idx * PAGE_SIZE)
+        if len(page) < PAGE_SIZE:
+            raise IndexError(f"Page {page_idx} is past the end of {self.file_path}")
+        return logical_page(page)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
     def next(self):
         # skip empty pages or if we are at the end
         if self.record_idx >= len(self.pages[self.page_idx].records):
@@ -171,7 +1160,698 @@ class HeapFile(object):
         return record
 
 
+# editing heap files in place. A page's data region starts right after its slots and the
+# slots are relative to it, so adding a slot just slides the data up 8 bytes. A deleted
+# record's slot is emptied to (0, 0) and reused by a later insert, so no other record's RID
+# changes; the bytes it held are dead until the page is compacted.
+
+# a free-space map byte is a page's free space in units of FSM_UNIT bytes, rounded down
+FSM_UNIT = 32
+
+class SlottedPage(object):
+    """
+    Insert, update, delete and compact records of a heap page in place, in a bytearray such
+    as a BufferPool frame.
+    """
+    # compact after a delete or update leaves more than this much of the page dead
+    COMPACT_THRESHOLD = PAGE_SIZE // 4
+
+    def __init__(self, buf):
+        self.buf = buf
+        self.num_records = struct.unpack_from("I", buf, 4)[0]
+        # (start, end) of every slot, flattened
+        self.slots = list(struct.unpack_from(f"{2 * self.num_records}I", buf, 8))
+
+    @property
+    def data_start(self) -> int:
+        return 8 + 8 * self.num_records
+
+    def data_end(self) -> int:
+        return max(self.slots[1::2], default=0)
+
+    def live_bytes(self) -> int:
+        return sum(self.slots[1::2]) - sum(self.slots[0::2])
+
+    def free_space(self) -> int:
+        """
+        Bytes free on the page, counting the dead bytes compaction would reclaim.
+        """
+        return PAGE_SIZE - self.data_start - self.live_bytes()
+
+    def is_live(self, row_idx) -> bool:
+        return row_idx < self.num_records and self.slots[2 * row_idx] != self.slots[2 * row_idx + 1]
+
+    def get(self, row_idx) -> int:
+        """
+        Offset of the record in buf.
+        """
+        if not self.is_live(row_idx):
+            raise IndexError(f"No record in slot {row_idx}")
+        return self.data_start + self.slots[2 * row_idx]
+
+    def write_slot(self, row_idx, start, end):
+        self.slots[2 * row_idx:2 * row_idx + 2] = start, end
+        struct.pack_into("II", self.buf, 8 + 8 * row_idx, start, end)
+
+    def add_slot(self) -> int:
+        # the data moves up 8 bytes to make room for the slot, and mustn't go off the page
+        if self.data_start + 8 + self.data_end() > PAGE_SIZE:
+            self.compact()
+        start, end = self.data_start, self.data_end()
+        self.buf[start + 8:start + 8 + end] = self.buf[start:start + end]
+        self.num_records += 1
+        struct.pack_into("I", self.buf, 4, self.num_records)
+        self.slots += (0, 0)
+        self.write_slot(self.num_records - 1, 0, 0)
+        return self.num_records - 1
+
+    def put(self, row_idx, record):
+        """
+        Write the record after the last one on the page, compacting first if it won't fit.
+        """
+        if self.data_start + self.data_end() + len(record) > PAGE_SIZE:
+            self.compact()
+        start = self.data_end()
+        pos = self.data_start + start
+        self.buf[pos:pos + len(record)] = record
+        self.write_slot(row_idx, start, start + len(record))
+
+    def insert(self, record) -> int:
+        """
+        Add the record, reusing an empty slot if there is one. Returns its slot, or None if
+        the page doesn't have room.
+        """
+        row_idx = next((i for i in range(self.num_records) if not self.is_live(i)), None)
+        if self.free_space() < len(record) + (8 if row_idx is None else 0):
+            return None
+        if row_idx is None:
+            row_idx = self.add_slot()
+        self.put(row_idx, record)
+        return row_idx
+
+    def delete(self, row_idx):
+        self.get(row_idx)
+        self.write_slot(row_idx, 0, 0)
+        self.maybe_compact()
+
+    def update(self, row_idx, record) -> bool:
+        """
+        Replace the record in place if it's no bigger, otherwise move it to the end of the
+        page. Returns False, leaving the page as it was, if the page doesn't have room.
+        """
+        self.get(row_idx)
+        start, end = self.slots[2 * row_idx:2 * row_idx + 2]
+        if len(record) <= end - start:
+            pos = self.data_start + start
+            self.buf[pos:pos + len(record)] = record
+            self.write_slot(row_idx, start, start + len(record))
+        elif self.free_space() + (end - start) < len(record):
+            return False
+        else:
+            self.write_slot(row_idx, 0, 0)
+            self.put(row_idx, record)
+        self.maybe_compact()
+        return True
+
+    def maybe_compact(self):
+        if self.data_end() - self.live_bytes() > self.COMPACT_THRESHOLD:
+            self.compact()
+
+    def compact(self):
+        """
+        Slide the live records down to the start of the data region, keeping their slots.
+        """
+        start, end = self.data_start, self.data_end()
+        data = bytes(self.buf[start:start + end])
+        live = sorted((i for i in range(self.num_records) if self.is_live(i)), key=lambda i: self.slots[2 * i])
+        pos = 0
+        for i in live:
+            a, b = self.slots[2 * i:2 * i + 2]
+            self.buf[start + pos:start + pos + b - a] = data[a:b]
+            self.write_slot(i, pos, pos + b - a)
+            pos += b - a
+        self.buf[start + pos:start + end] = bytes(end - pos)
+
+
+class HeapTable(object):
+    """
+    A heap file on disk that's changed a record at a time, through a BufferPool, instead of
+    rebuilt in memory and rewritten whole with write_to_disk. Changing a record dirties just
+    its page, so flushing writes only the pages that changed.
+
+    Records are addressed by (page_idx, row_idx) RIDs, like FileScanner.fetch. A free-space
+    map, one byte per page in the side file <path>.fsm, lets inserts find a page with room
+    without reading any pages. It's only a hint: a page is checked before inserting into it,
+    and its entry corrected if it was wrong, and the map is rebuilt if it's missing.
+
+    With a write-ahead log (heap-wal.py's WriteAheadLog), every change to a page is logged,
+    and each insert, update or delete is a transaction that's durable once it returns. Use
+    `with table.transaction():` to make several of them one transaction. The table is safe
+    to share between threads; they wait for their commits to be durable concurrently, which
+    is what lets the log group them into one fsync.
+    """
+    def __init__(self, path, schema, pool=None, wal=None):
+        self.path = path
+        self.codec = RecordCodec(schema)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        with open(path, "rb") as f:
+            if read_dictionaries(f.fileno()) is not None:
+                raise ValueError(f"{path} is compressed, and compressed heap files can't be edited in place")
+        if pool is None and wal is not None:
+            pool = wal.pool
+        self.own_pool = pool is None
+        self.pool = pool if pool is not None else BufferPool(64)
+        self.wal = wal
+        self.txid = None
+        self.lock = threading.RLock()
+        self.fsm_path = path + ".fsm"
+        self.fsm = self.load_fsm()
+        # the zone map isn't kept up to date with edits, so it goes on the first one
+        self.zone_map_removed = False
+
+    def load_fsm(self) -> bytearray:
+        num_pages = self.pool.page_count(self.path)
+        try:
+            with open(self.fsm_path, "rb") as f:
+                fsm = bytearray(f.read())
+        except FileNotFoundError:
+            fsm = bytearray()
+        self.fsm_dirty = len(fsm) < num_pages
+        if self.fsm_dirty:
+            fsm = bytearray()
+            for page_idx in range(num_pages):
+                with self.pool.page(self.path, page_idx, scan=True) as buf:
+                    fsm.append(self.fsm_value(SlottedPage(buf)))
+        # the file is padded out to whole pages
+        del fsm[num_pages:]
+        return fsm
+
+    def fsm_value(self, page) -> int:
+        return min(255, page.free_space() // FSM_UNIT)
+
+    def save_fsm(self):
+        with open(self.fsm_path, "wb") as f:
+            f.write(self.fsm)
+            f.write(bytes(-len(self.fsm) % PAGE_SIZE))
+        self.fsm_dirty = False
+
+    def find_page(self, size):
+        """
+        A page the free-space map says has at least size bytes free, or None.
+        """
+        need = -(-size // FSM_UNIT)
+        if need > 255 or not self.fsm:
+            return None
+        has_room = np.frombuffer(self.fsm, dtype=np.uint8) >= need
+        page_idx = int(has_room.argmax())
+        return page_idx if has_room[page_idx] else None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Make everything in the with block one transaction, committed (and with a log, durable)
+        at the end of it. Nested transactions are part of the outermost one.
+        """
+        with self.lock:
+            if self.txid is not None:
+                yield
+                return
+            self.txid = self.wal.begin() if self.wal is not None else 0
+            try:
+                yield
+            finally:
+                # there's no rolling back in memory, so whatever was done is committed
+                lsn = self.wal.log_commit(self.txid) if self.wal is not None else 0
+                self.txid = None
+        if self.wal is not None:
+            # outside the lock, so other threads can get their commits into the same fsync
+            self.wal.flush(lsn)
+            self.wal.maybe_checkpoint()
+
+    @contextlib.contextmanager
+    def page(self, page_idx):
+        """
+        Pin the page for editing, marking it dirty, logging the change and updating its
+        free-space map entry after.
+        """
+        if page_idx < 0 or page_idx >= len(self.fsm):
+            raise IndexError(f"Page {page_idx} is past the end of {self.path}")
+        if not self.zone_map_removed:
+            remove_zone_map(self.path)
+            self.zone_map_removed = True
+        buf = self.pool.fetch(self.path, page_idx)
+        before = bytes(buf) if self.wal is not None else None
+        page = SlottedPage(buf)
+        lsn = 0
+        try:
+            yield page
+        finally:
+            if self.wal is not None:
+                lsn = self.wal.log_update(self.txid, self.path, page_idx, before, buf)
+            self.fsm[page_idx] = self.fsm_value(page)
+            self.fsm_dirty = True
+            self.pool.unpin(self.path, page_idx, dirty=True, lsn=lsn)
+
+    def insert(self, row) -> tuple:
+        """
+        Add a row to the first page with room for it, or a new page. Returns its RID.
+        """
+        record = self.codec.encode(row)
+        if 16 + len(record) > PAGE_SIZE:
+            raise ValueError("Record is too large for a page")
+        with self.transaction():
+            while True:
+                page_idx = self.find_page(len(record) + 8)
+                new = page_idx is None
+                if new:
+                    page_idx, _ = self.pool.new_page(self.path)
+                    self.pool.unpin(self.path, page_idx, dirty=True)
+                    self.fsm.append(0)
+                with self.page(page_idx) as page:
+                    if new:
+                        struct.pack_into("I", page.buf, 0, page_idx)
+                    row_idx = page.insert(record)
+                if row_idx is not None:
+                    return page_idx, row_idx
+
+    def fetch(self, rid) -> tuple:
+        page_idx, row_idx = rid
+        with self.lock:
+            if page_idx < 0 or page_idx >= len(self.fsm):
+                raise IndexError(f"No record at {rid}")
+            with self.pool.page(self.path, page_idx) as buf:
+                return self.codec.decode(buf, SlottedPage(buf).get(row_idx))
+
+    def iter_rids(self):
+        """
+        (rid, row) for every record in the table.
+        """
+        with self.lock:
+            for page_idx in range(len(self.fsm)):
+                with self.pool.page(self.path, page_idx, scan=True) as buf:
+                    page = SlottedPage(buf)
+                    rows = [((page_idx, i), self.codec.decode(buf, page.get(i))) for i in range(page.num_records) if page.is_live(i)]
+                yield from rows
+
+    def delete(self, rid):
+        page_idx, row_idx = rid
+        with self.transaction(), self.page(page_idx) as page:
+            page.delete(row_idx)
+
+    def update(self, rid, row) -> tuple:
+        """
+        Replace the row at rid. It stays put if its page has room, and otherwise moves to
+        another page: the returned RID is where it ended up.
+        """
+        record = self.codec.encode(row)
+        page_idx, row_idx = rid
+        with self.transaction():
+            with self.page(page_idx) as page:
+                if page.update(row_idx, record):
+                    return rid
+                page.delete(row_idx)
+            return self.insert(row)
+
+    def flush(self):
+        with self.lock:
+            self.pool.flush(self.path)
+            if self.fsm_dirty:
+                self.save_fsm()
+
+    def close(self):
+        self.flush()
+        if self.own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# columnar ("PAX") pages: the same 8192 byte pages, but each page stores its rows column by
+# column, so a scan that only needs one column doesn't have to walk past all the others.
+#
+#   page_num, num_records              2 x uint32
+#   column offsets                     uint32 per column, from the start of the page
+#   then one section per column, each 8 byte aligned:
+#     int    num_records x uint32 (little endian)
+#     float  num_records x float64
+#     str    (num_records + 1) x uint32 offsets into the blob that follows, then the UTF-8 blob
+
+PAX_DTYPES = {int: np.dtype("<u4"), float: np.dtype("<f8")}
+
+def align8(n):
+    return (n + 7) & ~7
+
+
+def schema_types(schema) -> tuple:
+    items = schema.items() if isinstance(schema, dict) else schema
+    return tuple(t for _, t in items)
+
+
+class ColumnarWriter(object):
+    """
+    Buffer rows into per-column lists and write them out as PAX pages, starting a new page
+    whenever the next row wouldn't fit.
+    """
+    def __init__(self, out_file, schema):
+        self.file = open(out_file, "wb")
+        self.types = schema_types(schema)
+        for t in self.types:
+            if t not in PAX_DTYPES and t != str:
+                raise ValueError(f"Invalid type: {t}")
+        self.page_num = 0
+        self.reset()
+
+    def reset(self):
+        self.columns = [[] for _ in self.types]
+        self.num_records = 0
+        self.str_bytes = [0] * len(self.types)
+
+    def page_size(self, num_records, str_bytes) -> int:
+        size = align8(8 + 4 * len(self.types))
+        for i, t in enumerate(self.types):
+            if t == str:
+                size += align8(4 * (num_records + 1) + str_bytes[i])
+            else:
+                size += align8(PAX_DTYPES[t].itemsize * num_records)
+        return size
+
+    def append(self, record):
+        values = []
+        str_bytes = list(self.str_bytes)
+        for i, (t, v) in enumerate(zip(self.types, record)):
+            if t == str:
+                v = v.encode("utf-8")
+                str_bytes[i] += len(v)
+            else:
+                v = t(v)
+            values.append(v)
+        if self.page_size(self.num_records + 1, str_bytes) > PAGE_SIZE:
+            if self.num_records == 0:
+                raise ValueError("Record is too large for a page")
+            self.flush()
+            return self.append(record)
+        for col, v in zip(self.columns, values):
+            col.append(v)
+        self.num_records += 1
+        self.str_bytes = str_bytes
+
+    def flush(self):
+        if self.num_records == 0:
+            return
+        page = bytearray(PAGE_SIZE)
+        struct.pack_into("II", page, 0, self.page_num, self.num_records)
+        pos = align8(8 + 4 * len(self.types))
+        for i, (t, col) in enumerate(zip(self.types, self.columns)):
+            struct.pack_into("<I", page, 8 + 4 * i, pos)
+            if t == str:
+                offsets = np.zeros(len(col) + 1, dtype="<u4")
+                np.cumsum([len(v) for v in col], out=offsets[1:])
+                section = offsets.tobytes() + b"".join(col)
+            else:
+                section = np.array(col, dtype=PAX_DTYPES[t]).tobytes()
+            page[pos:pos + len(section)] = section
+            pos = align8(pos + len(section))
+        self.file.write(page)
+        self.page_num += 1
+        self.reset()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+def decode_pax_page(page, types, columns=None) -> list:
+    """
+    Decode a PAX page into one NumPy array per column. Fixed width columns are zero copy
+    views of the page; strings become object arrays. Columns not in `columns` are None.
+    """
+    num_records = int.from_bytes(page[4:8], "little")
+    offsets = struct.unpack_from(f"<{len(types)}I", page, 8)
+    out = []
+    for i, (t, pos) in enumerate(zip(types, offsets)):
+        if columns is not None and i not in columns:
+            out.append(None)
+        elif t == str:
+            ends = np.frombuffer(page, dtype="<u4", count=num_records + 1, offset=pos).tolist()
+            blob = pos + 4 * (num_records + 1)
+            values = np.empty(num_records, dtype=object)
+            values[:] = [page[blob + a:blob + b].decode("utf-8") for a, b in zip(ends, ends[1:])]
+            out.append(values)
+        else:
+            out.append(np.frombuffer(page, dtype=PAX_DTYPES[t], count=num_records, offset=pos))
+    return out
+
+
+def iter_heap_pages(in_file, schema):
+    """
+    Stream the records of a row format heap file (plain or compressed), a page at a time.
+    """
+    with open(in_file, "rb") as f:
+        codec = file_codec(f.fileno(), schema)
+        page = f.read(PAGE_SIZE)
+        while len(page) == PAGE_SIZE:
+            page = logical_page(page)
+            num_records = int.from_bytes(page[4:8], "little")
+            slots = struct.unpack_from(f"{2 * num_records}I", page, 8)
+            data_start = 8 + num_records * 8
+            yield [codec.decode(page, data_start + slots[i]) for i in range(0, 2 * num_records, 2) if slots[i] != slots[i + 1]]
+            page = f.read(PAGE_SIZE)
+
+
+def iter_heap_records(in_file, schema):
+    for records in iter_heap_pages(in_file, schema):
+        yield from records
+
+
+def iter_pax_records(in_file, schema):
+    types = schema_types(schema)
+    with open(in_file, "rb") as f:
+        page = f.read(PAGE_SIZE)
+        while len(page) == PAGE_SIZE:
+            yield from zip(*(col.tolist() for col in decode_pax_page(page, types)))
+            page = f.read(PAGE_SIZE)
+
+
+def row_to_columnar(in_file, out_file, schema):
+    """
+    Convert a row format heap file into a PAX one.
+    """
+    writer = ColumnarWriter(out_file, schema)
+    for record in iter_heap_records(in_file, schema):
+        writer.append(record)
+    writer.close()
+
+
+def columnar_to_row(in_file, out_file, schema):
+    """
+    Convert a PAX heap file back into the row format.
+    """
+    hf = HeapFile(in_file, schema)
+    for record in iter_pax_records(in_file, schema):
+        hf.append(record)
+    hf.write_to_disk(out_file)
+
+
+# table statistics for cost based decisions: a side file <heap file>.stats (JSON) written by
+# analyze(), with the row count and, per column, the fraction of nulls, a HyperLogLog estimate
+# of the number of distinct values, the most common values and an equi-depth histogram.
+# nothing keeps it up to date; like any database's statistics it's as of the last analyze().
+
+def value_hash(value) -> int:
+    return int.from_bytes(hashlib.blake2b(bloom_key(value), digest_size=8).digest(), "little")
+
+
+class HyperLogLog(object):
+    """
+    Estimate the number of distinct values seen in 2**p bytes, to within about
+    1.04 / sqrt(2**p) (1.6% for the default p = 12).
+
+    Each value's 64 bit hash picks a register with its top p bits, and the register keeps the
+    most leading zeros (plus one) seen in the rest of the bits.
+    """
+    def __init__(self, p=12):
+        self.p = p
+        self.registers = np.zeros(1 << p, dtype=np.uint8)
+
+    def add_hashes(self, hashes):
+        h = np.asarray(hashes, dtype=np.uint64)
+        idx = (h >> np.uint64(64 - self.p)).astype(np.intp)
+        rest = h & np.uint64((1 << (64 - self.p)) - 1)
+        # bit length of rest, from the float exponent (off by one for a handful of values
+        # within 2**-53 of a power of two, which doesn't matter here)
+        bits = np.frexp(rest.astype(np.float64))[1]
+        np.maximum.at(self.registers, idx, (64 - self.p - bits + 1).astype(np.uint8))
+
+    def add(self, values):
+        self.add_hashes([value_hash(v) for v in values])
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is better while lots of registers are still empty
+            return m * np.log(m / zeros)
+        return float(estimate)
+
+
+class TableStats(object):
+    """
+    Statistics for one heap file, from analyze(). columns has a dict per column:
+
+        null_frac   fraction of rows that are None or an empty string
+        distinct    estimated number of distinct non-null values
+        mcv         [[value, fraction of rows], ...] for the most common values
+        histogram   equi-depth bucket bounds: num_buckets + 1 values with as many of the
+                    column's non-null values between each pair
+
+    selectivity(col, op, value) estimates the fraction of rows where `row[col] op value`.
+    """
+    def __init__(self, row_count, columns, num_pages=0):
+        self.row_count = row_count
+        self.columns = columns
+        self.num_pages = num_pages
+
+    def save(self, heap_path):
+        with open(heap_path + ".stats", "w") as f:
+            json.dump({"row_count": self.row_count, "num_pages": self.num_pages, "columns": self.columns}, f)
+
+    @classmethod
+    def load(cls, heap_path):
+        """
+        The heap file's statistics, or None if it has never been analyzed.
+        """
+        try:
+            with open(heap_path + ".stats") as f:
+                stats = json.load(f)
+        except FileNotFoundError:
+            return None
+        return cls(stats["row_count"], stats["columns"], stats["num_pages"])
+
+    def eq_selectivity(self, col, value) -> float:
+        stats = self.columns[col]
+        for v, frac in stats["mcv"]:
+            if v == value:
+                return frac
+        if value is None or value == "":
+            return stats["null_frac"]
+        if stats["histogram"] and not stats["histogram"][0] <= value <= stats["histogram"][-1]:
+            return 0.0
+        # whatever isn't null or a common value, spread evenly over the other distinct values
+        rest = 1 - stats["null_frac"] - sum(frac for _, frac in stats["mcv"])
+        return max(rest, 0.0) / max(stats["distinct"] - len(stats["mcv"]), 1)
+
+    def lt_fraction(self, col, value) -> float:
+        """
+        The fraction of non-null values below value, going by the histogram.
+        """
+        bounds = self.columns[col]["histogram"]
+        if not bounds or value <= bounds[0]:
+            return 0.0
+        if value > bounds[-1]:
+            return 1.0
+        i = bisect.bisect_left(bounds, value) - 1
+        lo, hi = bounds[i], bounds[i + 1]
+        within = (value - lo) / (hi - lo) if isinstance(value, (int, float)) and hi != lo else 0.5
+        return (i + within) / (len(bounds) - 1)
+
+    def selectivity(self, col, op, value) -> float:
+        if self.row_count == 0:
+            return 0.0
+        non_null = 1 - self.columns[col]["null_frac"]
+        if op == "==":
+            sel = self.eq_selectivity(col, value)
+        elif op == "!=":
+            sel = non_null - self.eq_selectivity(col, value)
+        elif op in ("<", ">="):
+            lt = non_null * self.lt_fraction(col, value)
+            sel = lt if op == "<" else non_null - lt
+        elif op in ("<=", ">"):
+            le = non_null * self.lt_fraction(col, value) + self.eq_selectivity(col, value)
+            sel = le if op == "<=" else non_null - le
+        else:
+            raise ValueError(f"Invalid operator: {op}")
+        return min(max(sel, 0.0), 1.0)
+
+
+def remove_stats(heap_path):
+    try:
+        os.remove(heap_path + ".stats")
+    except FileNotFoundError:
+        pass
+
+
+def analyze(heap_file, schema, sample_pages=None, sample_rows=30_000, num_buckets=100, num_mcv=10, seed=0):
+    """
+    Gather and save a heap file's TableStats in one streaming pass, or from sample_pages
+    random pages (scaling the counts up) if it has more than that.
+
+    Null counts and distinct estimates see every row read. The MCVs and histograms come from a
+    reservoir sample of sample_rows of them, so memory use doesn't grow with the file.
+    """
+    types = schema_types(schema)
+    rng = random.Random(seed)
+    num_pages = os.path.getsize(heap_file) // PAGE_SIZE
+    pages = range(num_pages)
+    if sample_pages is not None and sample_pages < num_pages:
+        pages = sorted(rng.sample(pages, sample_pages))
+    hlls = [HyperLogLog() for _ in types]
+    nulls = [0] * len(types)
+    sample = []
+    rows_read = 0
+    with open(heap_file, "rb") as f:
+        codec = file_codec(f.fileno(), schema)
+        for page_idx in pages:
+            page = logical_page(os.pread(f.fileno(), PAGE_SIZE, page_idx * PAGE_SIZE))
+            n = int.from_bytes(page[4:8], "little")
+            slots = struct.unpack_from(f"{2 * n}I", page, 8)
+            records = [codec.decode(page, 8 + 8 * n + slots[k]) for k in range(0, 2 * n, 2) if slots[k] != slots[k + 1]]
+            for i, column in enumerate(zip(*records)):
+                values = [v for v in column if v is not None and v != ""]
+                nulls[i] += len(column) - len(values)
+                hlls[i].add(values)
+            for record in records:
+                rows_read += 1
+                if len(sample) < sample_rows:
+                    sample.append(record)
+                else:
+                    j = rng.randrange(rows_read)
+                    if j < sample_rows:
+                        sample[j] = record
+    scale = num_pages / len(pages) if len(pages) else 0
+    row_count = round(rows_read * scale)
+    columns = []
+    for i in range(len(types)):
+        values = sorted(r[i] for r in sample if r[i] is not None and r[i] != "")
+        counts = collections.Counter(values)
+        # a value is only common if it shows up more than once in the sample
+        mcv = [[v, c / len(sample)] for v, c in counts.most_common(num_mcv) if c > 1]
+        buckets = min(num_buckets, len(values) - 1)
+        histogram = [values[k * (len(values) - 1) // buckets] for k in range(buckets + 1)] if buckets > 0 else values[:1]
+        distinct = hlls[i].estimate()
+        if distinct > 0.1 * rows_read:
+            # a sample only sees some of the values. like PostgreSQL, take a column with
+            # this many of them to have distinct values in proportion to the table's size
+            distinct *= scale
+        columns.append({
+            "null_frac": nulls[i] / rows_read if rows_read else 0.0,
+            "distinct": min(round(distinct), row_count),
+            "mcv": mcv,
+            "histogram": histogram,
+        })
+    stats = TableStats(row_count, columns, num_pages)
+    stats.save(heap_file)
+    return stats
+
+
 def main():
+    import pytest
     schema = {
         "movieId": int,
         "title": str,
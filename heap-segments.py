@@ -0,0 +1,458 @@
+# segmented tables for heap-db.py: a directory of ordinary heap files ("segments") and a
+# manifest saying which of them make up the table. every writer (thread or process) appends
+# to a segment of its own, and only adds it to the manifest once it's complete and fsynced,
+# so writers never contend on a page cursor and readers never see half a segment.
+#
+#   MANIFEST        json: version, next_segment, segments [{name, pages, rows}], retired [names]
+#   MANIFEST.lock   flock'd exclusively while the manifest is read or replaced
+#   COMPACT.lock    flock'd by whoever is compacting
+#   seg-000001.hf   the segments, each with its .zm zone map
+#
+# files are protected with flock too: a writer holds an exclusive lock on the segment it's
+# writing, and a snapshot holds shared locks on the segments it lists. a segment dropped from
+# the manifest (by compaction) is only deleted once nobody holds a lock on it, and a segment
+# file that isn't in the manifest and isn't locked is left over from a crashed writer.
+
+import contextlib
+import fcntl
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import re
+import tempfile
+import threading
+
+heapdb = importlib.import_module("heap-db")
+
+PAGE_SIZE = heapdb.PAGE_SIZE
+SEGMENT_NAME = re.compile(r"seg-\d+\.hf$")
+
+
+def fsync_dir(path):
+    dir_fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def try_lock(path, mode):
+    """
+    Open path and flock it without blocking. Returns the fd, or None if someone else holds
+    a conflicting lock (or the file is gone).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fd, mode | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return None
+    return fd
+
+
+class SegmentedTable(object):
+    """
+    An append-only table stored as a directory of heap file segments plus a manifest.
+
+    Appends go through a SegmentWriter (see writer()), and any number of them can run at
+    once, in threads or in other processes opening the same directory. Each fills its own
+    segment and starts a new one every segment_pages pages; a segment becomes visible when
+    it's published to the manifest, on rolling over, flush() or close().
+
+    snapshot() gives a consistent view: the segments in the manifest at that moment, which
+    stay readable (even if compaction replaces them) until the snapshot is closed.
+
+    compact() merges small segments (under a quarter of segment_pages) into bigger ones, and
+    start_compactor() runs it in a background thread every interval seconds.
+    """
+    def __init__(self, path, schema, segment_pages=1024):
+        self.path = path
+        self.schema = schema
+        self.segment_pages = segment_pages
+        self.manifest_path = os.path.join(path, "MANIFEST")
+        self.compactor = None
+        self.stop_compactor = threading.Event()
+        os.makedirs(path, exist_ok=True)
+        with self.manifest() as manifest:
+            if manifest["version"] == 0:
+                self.write_manifest(manifest)
+
+    def segment_path(self, name):
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def manifest(self):
+        """
+        Hold the manifest lock, and yield the current manifest.
+        """
+        fd = os.open(os.path.join(self.path, "MANIFEST.lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                with open(self.manifest_path) as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                manifest = {"version": 0, "next_segment": 1, "segments": [], "retired": []}
+            yield manifest
+        finally:
+            os.close(fd)
+
+    def write_manifest(self, manifest):
+        """
+        Atomically replace the manifest, with the lock held.
+        """
+        manifest["version"] += 1
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.manifest_path)
+        fsync_dir(self.path)
+
+    def new_segment(self):
+        """
+        Create and exclusively lock an empty segment. Returns (name, fd of the lock).
+        """
+        with self.manifest() as manifest:
+            name = f"seg-{manifest['next_segment']:06d}.hf"
+            manifest["next_segment"] += 1
+            self.write_manifest(manifest)
+            # locked before the manifest is, so collect_garbage can't take it for a leftover
+            fd = os.open(self.segment_path(name), os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        return name, fd
+
+    def publish(self, segments, replaces=()):
+        """
+        Add segments ({name, pages, rows} dicts, already fsynced) to the manifest, in place of
+        the segments named in replaces, which are then deleted once no snapshot needs them.
+        """
+        with self.manifest() as manifest:
+            names = [s["name"] for s in manifest["segments"]]
+            missing = set(replaces) - set(names)
+            if missing:
+                raise ValueError(f"Segments {sorted(missing)} aren't in the manifest")
+            # merged segments take the place of the first one they replace
+            pos = min((names.index(name) for name in replaces), default=len(names))
+            kept = [s for s in manifest["segments"] if s["name"] not in replaces]
+            manifest["segments"] = kept[:pos] + list(segments) + kept[pos:]
+            manifest["retired"] += list(replaces)
+            self.collect_garbage(manifest)
+            self.write_manifest(manifest)
+
+    def collect_garbage(self, manifest) -> bool:
+        """
+        Delete retired segments nobody is reading, and segment files left behind by writers
+        that died before publishing them. Called with the manifest lock held. Returns whether
+        the manifest changed.
+        """
+        live = {s["name"] for s in manifest["segments"]}
+        retired = set(manifest["retired"])
+        for name in os.listdir(self.path):
+            if not SEGMENT_NAME.match(name) or (name in live and name not in retired):
+                continue
+            fd = try_lock(self.segment_path(name), fcntl.LOCK_EX)
+            if fd is None:
+                continue
+            try:
+                os.unlink(self.segment_path(name))
+                heapdb.remove_zone_map(self.segment_path(name))
+                heapdb.remove_stats(self.segment_path(name))
+            finally:
+                os.close(fd)
+            retired.discard(name)
+        changed = manifest["retired"] != sorted(retired)
+        manifest["retired"] = sorted(retired)
+        return changed
+
+    def writer(self, bloom_columns=()):
+        return SegmentWriter(self, bloom_columns)
+
+    def append_many(self, rows):
+        with self.writer() as writer:
+            for row in rows:
+                writer.append(row)
+
+    def snapshot(self):
+        """
+        The table as of now. Close it (or use it as a context manager) when done, so
+        compaction can delete the segments it holds on to.
+        """
+        with self.manifest() as manifest:
+            fds = []
+            for segment in manifest["segments"]:
+                fd = os.open(self.segment_path(segment["name"]), os.O_RDONLY)
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                fds.append(fd)
+            return Snapshot(self, manifest["version"], manifest["segments"], fds)
+
+    def compact(self) -> int:
+        """
+        Merge runs of small segments into segments of up to segment_pages pages. Returns the
+        number of segments merged away, or 0 if there was nothing to do or another compaction
+        is running.
+        """
+        lock = os.open(os.path.join(self.path, "COMPACT.lock"), os.O_RDWR | os.O_CREAT)
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            with self.snapshot() as snapshot:
+                small = [s for s in snapshot.segments if s["pages"] < self.segment_pages // 4]
+                groups, group = [], []
+                for segment in small:
+                    if group and sum(s["pages"] for s in group) + segment["pages"] > self.segment_pages:
+                        groups.append(group)
+                        group = []
+                    group.append(segment)
+                groups.append(group)
+                merged = 0
+                for group in groups:
+                    if len(group) < 2:
+                        continue
+                    self.merge(group)
+                    merged += len(group) - 1
+            with self.manifest() as manifest:
+                # the snapshot's locks are gone now, so what we replaced can go too
+                if self.collect_garbage(manifest):
+                    self.write_manifest(manifest)
+            return merged
+        finally:
+            os.close(lock)
+
+    def merge(self, group):
+        name, fd = self.new_segment()
+        path = self.segment_path(name)
+        try:
+            rows = 0
+            with heapdb.HeapFileWriter(path, self.schema) as writer:
+                for segment in group:
+                    for row in heapdb.iter_heap_records(self.segment_path(segment["name"]), self.schema):
+                        writer.append(row)
+                        rows += 1
+            os.fsync(fd)
+            pages = os.fstat(fd).st_size // PAGE_SIZE
+            self.publish([{"name": name, "pages": pages, "rows": rows}], [s["name"] for s in group])
+        finally:
+            os.close(fd)
+
+    def start_compactor(self, interval=1.0):
+        """
+        Compact in a background thread every interval seconds, until close().
+        """
+        def run():
+            while not self.stop_compactor.wait(interval):
+                self.compact()
+        self.stop_compactor.clear()
+        self.compactor = threading.Thread(target=run, daemon=True)
+        self.compactor.start()
+
+    def close(self):
+        if self.compactor is not None:
+            self.stop_compactor.set()
+            self.compactor.join()
+            self.compactor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SegmentWriter(object):
+    """
+    Appends rows to a SegmentedTable through segments of its own, publishing each one when
+    it reaches the table's segment_pages, and the last one on flush() or close().
+    """
+    def __init__(self, table, bloom_columns=()):
+        self.table = table
+        self.bloom_columns = bloom_columns
+        self.writer = None
+        self.name = None
+        self.fd = None
+        self.rows = 0
+
+    def append(self, row):
+        if self.writer is None:
+            self.name, self.fd = self.table.new_segment()
+            self.writer = heapdb.HeapFileWriter(self.table.segment_path(self.name), self.table.schema, bloom_columns=self.bloom_columns)
+            self.rows = 0
+        self.writer.append(row)
+        self.rows += 1
+        if self.writer.page_num >= self.table.segment_pages:
+            self.flush()
+
+    def flush(self):
+        """
+        Publish the rows appended so far, so new snapshots see them.
+        """
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            os.fsync(self.fd)
+            pages = os.fstat(self.fd).st_size // PAGE_SIZE
+            self.table.publish([{"name": self.name, "pages": pages, "rows": self.rows}])
+        finally:
+            os.close(self.fd)
+            self.writer = self.fd = None
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Snapshot(object):
+    """
+    The segments of a SegmentedTable as of one manifest version, held open with shared locks
+    until close().
+    """
+    def __init__(self, table, version, segments, fds):
+        self.table = table
+        self.schema = table.schema
+        self.version = version
+        self.segments = segments
+        self.paths = [table.segment_path(s["name"]) for s in segments]
+        self.fds = fds
+
+    def num_rows(self) -> int:
+        return sum(s["rows"] for s in self.segments)
+
+    def iter_records(self):
+        for path in self.paths:
+            yield from heapdb.iter_heap_records(path, self.schema)
+
+    def close(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+SCHEMA = (("id", int), ("name", str))
+
+
+def rows_for(writer_id, n):
+    return [(writer_id * 1_000_000 + i, f"writer {writer_id} row {i}") for i in range(n)]
+
+
+def write_rows(path, writer_id, n):
+    table = SegmentedTable(path, SCHEMA, segment_pages=4)
+    table.append_many(rows_for(writer_id, n))
+
+
+def test_concurrent_writers(d):
+    """
+    Threads and processes appending at once each get their own segments, and nothing is lost.
+    """
+    table = SegmentedTable(d, SCHEMA, segment_pages=4)
+    threads = [threading.Thread(target=write_rows, args=(d, t, 2_000)) for t in range(4)]
+    ctx = multiprocessing.get_context("fork")
+    procs = [ctx.Process(target=write_rows, args=(d, t, 2_000)) for t in range(4, 6)]
+    # fork before starting the threads, or a child could inherit a lock one of them holds
+    for w in procs + threads:
+        w.start()
+    for w in procs + threads:
+        w.join()
+    assert all(p.exitcode == 0 for p in procs)
+    with table.snapshot() as snapshot:
+        expected = sorted(row for t in range(6) for row in rows_for(t, 2_000))
+        assert sorted(snapshot.iter_records()) == expected and snapshot.num_rows() == len(expected)
+        assert len({os.path.basename(p) for p in snapshot.paths}) == len(snapshot.paths) > 6
+        # rows from one writer keep their order
+        mine = [row for row in snapshot.iter_records() if row[0] < 1_000_000]
+        assert mine == rows_for(0, 2_000)
+
+
+def test_snapshots(d):
+    """
+    A snapshot sees the segments published before it, and keeps reading them after they're
+    compacted away and even deleted from the manifest.
+    """
+    table = SegmentedTable(d, SCHEMA, segment_pages=64)
+    for t in range(5):
+        table.append_many(rows_for(t, 100))
+    old = table.snapshot()
+    with table.writer() as writer:
+        for row in rows_for(9, 100):
+            writer.append(row)
+        # not published yet
+        with table.snapshot() as snapshot:
+            assert snapshot.num_rows() == 500
+    assert table.compact() == 5
+    with table.snapshot() as snapshot:
+        assert len(snapshot.segments) == 1 and snapshot.version > old.version
+        assert sorted(snapshot.iter_records()) == sorted(row for t in (0, 1, 2, 3, 4, 9) for row in rows_for(t, 100))
+    # the old segments are retired, but still there for the old snapshot. the one published
+    # after it was taken is already gone
+    assert sorted(old.iter_records()) == sorted(row for t in range(5) for row in rows_for(t, 100))
+    with table.manifest() as manifest:
+        assert manifest["retired"] == [f"seg-{i:06d}.hf" for i in range(1, 6)]
+    old.close()
+    table.compact()
+    with table.manifest() as manifest:
+        assert manifest["retired"] == []
+    assert sorted(os.listdir(d)) == ["COMPACT.lock", "MANIFEST", "MANIFEST.lock", "seg-000007.hf", "seg-000007.hf.zm"]
+
+
+def test_background_compaction(d):
+    """
+    A writer publishing lots of small segments, with a compactor merging them as it goes and
+    readers taking snapshots meanwhile.
+    """
+    table = SegmentedTable(d, SCHEMA, segment_pages=16)
+    table.start_compactor(interval=0.01)
+    rng = random.Random(0)
+    written = []
+    with table.writer() as writer:
+        for i in range(20_000):
+            row = (i, f"row {i}")
+            writer.append(row)
+            written.append(row)
+            if rng.random() < 0.01:
+                writer.flush()
+                with table.snapshot() as snapshot:
+                    assert sorted(snapshot.iter_records()) == written
+    table.close()
+    table.compact()
+    with table.snapshot() as snapshot:
+        assert sorted(snapshot.iter_records()) == written
+        small = [s for s in snapshot.segments if s["pages"] < 16 // 4]
+        print(f"compaction: {len(snapshot.segments)} segments left, {len(small)} small")
+        assert len(small) <= 1
+    # a crashed writer's segment is cleaned up
+    name, fd = table.new_segment()
+    table.compact()
+    assert os.path.exists(table.segment_path(name))
+    os.close(fd)
+    table.compact()
+    assert not os.path.exists(table.segment_path(name))
+
+
+def main():
+    for test in (test_concurrent_writers, test_snapshots, test_background_compaction):
+        with tempfile.TemporaryDirectory() as d:
+            test(d)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+# a write-ahead log for heap-db.py's HeapTable.
+# every change to a page is appended to the log before the page can reach the heap file, and
+# a transaction is durable once its commit record is fsynced, so heap pages themselves never
+# need to be fsynced on commit. after a crash, replaying the log brings the heap files back to
+# exactly the committed transactions.
+#
+# the log file is a 16 byte header (magic, and the LSN the file starts at) followed by records:
+#   length, crc32 of the body      2 x uint32
+#   body: type, txid               uint8, uint64
+#     UPDATE  path (relative to the log's directory, 2 byte length + UTF-8), page_idx uint32,
+#             offset uint16, length uint16, then the changed bytes before and after
+#     COMMIT  nothing more
+# an LSN is a position in the log, counting from when it was created (checkpoints start a new
+# file but LSNs keep going), and a record's LSN is where it ends.
+
+import importlib
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+
+import numpy as np
+
+heapdb = importlib.import_module("heap-db")
+
+PAGE_SIZE = heapdb.PAGE_SIZE
+WAL_HEADER = struct.Struct("<8sQ")
+WAL_MAGIC = b"HEAPWAL1"
+RECORD_HEADER = struct.Struct("<II")
+RECORD_TYPE = struct.Struct("<BQ")
+UPDATE = struct.Struct("<IHH")
+UPDATE_RECORD, COMMIT_RECORD = 1, 2
+
+
+def changed_range(before, after):
+    """
+    (offset, length) of the smallest byte range covering every difference, or None.
+    """
+    diff = np.flatnonzero(np.frombuffer(before, dtype=np.uint8) != np.frombuffer(after, dtype=np.uint8))
+    if not len(diff):
+        return None
+    return int(diff[0]), int(diff[-1]) + 1 - int(diff[0])
+
+
+class WriteAheadLog(object):
+    """
+    A redo/undo log of page changes for heap files edited through a BufferPool.
+
+    HeapTable logs each page it changes (the bytes before and after) and a commit record per
+    transaction. The pool won't write a page back until the log is durable up to its last
+    change, so anything on disk can be redone or undone from the log.
+
+    flush(lsn) waits until the log is durable up to lsn. With group_commit, one thread at a
+    time writes and fsyncs everything appended so far, while the others wait for it; whatever
+    they append meanwhile goes out together in the next fsync. Without it, every commit does
+    its own write and fsync.
+
+    Once the log is bigger than checkpoint_bytes, the next commit (with no other transaction
+    in progress) checkpoints: every dirty page in the pool is written back and fsynced, and
+    the log starts over empty. Opening a log recovers from it first: every change is redone in
+    log order, changes of transactions that never committed are undone in reverse, and then
+    it checkpoints. A torn record at the end (a crash mid-write) ends the log.
+    """
+    def __init__(self, path, pool, group_commit=True, checkpoint_bytes=16 << 20):
+        self.path = path
+        self.dir = os.path.dirname(os.path.abspath(path))
+        self.pool = pool
+        self.group_commit = group_commit
+        self.checkpoint_bytes = checkpoint_bytes
+        self.cond = threading.Condition(threading.RLock())
+        self.pending = bytearray()
+        self.flushing = False
+        self.next_txid = 1
+        self.active = set()
+        self.fsyncs = 0
+        self.commits = 0
+        self.base_lsn = 0
+        if os.path.exists(path):
+            self.recover()
+        else:
+            self.reset()
+        pool.wal = self
+
+    def open(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.end_lsn = self.durable_lsn = self.base_lsn + os.fstat(self.fd).st_size - WAL_HEADER.size
+
+    def reset(self):
+        """
+        Atomically replace the log with an empty one starting at base_lsn.
+        """
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(WAL_HEADER.pack(WAL_MAGIC, self.base_lsn))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        dir_fd = os.open(self.dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        self.open()
+
+    def append(self, body) -> int:
+        with self.cond:
+            self.pending += RECORD_HEADER.pack(len(body), zlib.crc32(body))
+            self.pending += body
+            self.end_lsn += RECORD_HEADER.size + len(body)
+            return self.end_lsn
+
+    def begin(self) -> int:
+        with self.cond:
+            txid = self.next_txid
+            self.next_txid += 1
+            self.active.add(txid)
+            return txid
+
+    def log_update(self, txid, path, page_idx, before, after) -> int:
+        """
+        Log a change to a page. Returns its LSN, or 0 if nothing changed.
+        """
+        changed = changed_range(before, after)
+        if changed is None:
+            return 0
+        offset, length = changed
+        rel = os.path.relpath(os.path.abspath(path), self.dir).encode("utf-8")
+        body = b"".join((
+            RECORD_TYPE.pack(UPDATE_RECORD, txid),
+            len(rel).to_bytes(2, "little"), rel,
+            UPDATE.pack(page_idx, offset, length),
+            before[offset:offset + length], after[offset:offset + length],
+        ))
+        return self.append(body)
+
+    def log_commit(self, txid) -> int:
+        with self.cond:
+            self.active.discard(txid)
+            self.commits += 1
+            return self.append(RECORD_TYPE.pack(COMMIT_RECORD, txid))
+
+    def commit(self, txid):
+        self.flush(self.log_commit(txid))
+
+    def flush(self, lsn=None):
+        """
+        Wait until the log is durable up to lsn (everything appended so far, by default).
+        """
+        with self.cond:
+            if lsn is None:
+                lsn = self.end_lsn
+            while self.durable_lsn < lsn:
+                if self.flushing:
+                    self.cond.wait()
+                    continue
+                data, self.pending = self.pending, bytearray()
+                end = self.end_lsn
+                if not self.group_commit:
+                    self.write(data)
+                    self.durable_lsn = end
+                    continue
+                # write outside the lock, so other threads can keep appending to the next group
+                self.flushing = True
+                self.cond.release()
+                try:
+                    self.write(data)
+                finally:
+                    self.cond.acquire()
+                    self.flushing = False
+                    self.cond.notify_all()
+                self.durable_lsn = end
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+        os.fdatasync(self.fd)
+        self.fsyncs += 1
+
+    def log_size(self) -> int:
+        return self.end_lsn - self.base_lsn
+
+    def maybe_checkpoint(self):
+        if self.log_size() > self.checkpoint_bytes:
+            self.checkpoint()
+
+    def checkpoint(self) -> bool:
+        """
+        Write back and fsync every dirty page, then empty the log. Returns False if it can't
+        because a transaction is in progress.
+        """
+        with self.cond:
+            if self.active:
+                return False
+            self.flush()
+            self.pool.flush()
+            self.pool.sync()
+            os.close(self.fd)
+            self.base_lsn = self.end_lsn
+            self.reset()
+            return True
+
+    def records(self):
+        """
+        (type, txid, rest of the body) for every intact record in the log file.
+        """
+        with open(self.path, "rb") as f:
+            data = f.read()
+        magic, self.base_lsn = WAL_HEADER.unpack_from(data)
+        if magic != WAL_MAGIC:
+            raise ValueError(f"{self.path} isn't a write-ahead log")
+        pos = WAL_HEADER.size
+        while pos + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, pos)
+            body = data[pos + RECORD_HEADER.size:pos + RECORD_HEADER.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            record_type, txid = RECORD_TYPE.unpack_from(body)
+            yield record_type, txid, body[RECORD_TYPE.size:]
+            pos += RECORD_HEADER.size + length
+        self.base_lsn += pos - WAL_HEADER.size
+
+    def recover(self):
+        updates, committed = [], set()
+        for record_type, txid, body in self.records():
+            if record_type == COMMIT_RECORD:
+                committed.add(txid)
+                continue
+            n = int.from_bytes(body[:2], "little")
+            path = os.path.join(self.dir, body[2:2 + n].decode("utf-8"))
+            page_idx, offset, length = UPDATE.unpack_from(body, 2 + n)
+            pos = 2 + n + UPDATE.size
+            updates.append((txid, path, page_idx * PAGE_SIZE + offset, body[pos:pos + length], body[pos + length:]))
+            self.next_txid = max(self.next_txid, txid + 1)
+        fds = {}
+        try:
+            for _, path, offset, _, after in updates:
+                if path not in fds:
+                    fds[path] = os.open(path, os.O_RDWR | os.O_CREAT)
+                os.pwrite(fds[path], after, offset)
+            for txid, path, offset, before, _ in reversed(updates):
+                if txid not in committed:
+                    os.pwrite(fds[path], before, offset)
+            for path, fd in fds.items():
+                # a page that was only ever in the pool may not have reached a full page yet
+                size = os.fstat(fd).st_size
+                if size % PAGE_SIZE:
+                    os.ftruncate(fd, size + PAGE_SIZE - size % PAGE_SIZE)
+                os.fsync(fd)
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        self.reset()
+
+    def close(self):
+        self.checkpoint()
+        self.pool.wal = None
+        os.close(self.fd)
+
+
+SCHEMA = (("id", int), ("name", str))
+
+
+def test_group_commit(d):
+    """
+    Threads committing at once share fsyncs, and everything they committed is there after
+    reopening.
+    """
+    pool = heapdb.BufferPool(64)
+    wal = WriteAheadLog(os.path.join(d, "heap.wal"), pool)
+    table = heapdb.HeapTable(os.path.join(d, "heap.hf"), SCHEMA, wal=wal)
+    rows = {}
+
+    def worker(t):
+        for i in range(50):
+            row = (t * 1_000 + i, f"row {i}")
+            rows[table.insert(row)] = row
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert wal.commits == 400 and len(rows) == 400
+    print(f"group commit: {wal.commits} commits in {wal.fsyncs} fsyncs")
+    table.close()
+    wal.close()
+    pool.close()
+    table = heapdb.HeapTable(os.path.join(d, "heap.hf"), SCHEMA)
+    assert dict(table.iter_rids()) == rows
+    table.close()
+
+
+def random_changes(table, rng, n, oracle):
+    """
+    n random inserts, updates and deletes, kept track of in oracle (rid -> row). Yields after
+    each one.
+    """
+    for i in range(n):
+        op = rng.random()
+        row = (i, "x" * rng.randint(0, 200))
+        if op < 0.5 or not oracle:
+            oracle[table.insert(row)] = row
+        elif op < 0.75:
+            rid = rng.choice(sorted(oracle))
+            table.delete(rid)
+            del oracle[rid]
+        else:
+            rid = rng.choice(sorted(oracle))
+            del oracle[rid]
+            oracle[table.update(rid, row)] = row
+        yield
+
+
+def crash(d, name, cut=None):
+    """
+    Copy the heap file and the log (cut off after `cut` bytes) as they are on disk, like after
+    a crash, and recover the copy.
+    """
+    crash_dir = os.path.join(d, name)
+    os.mkdir(crash_dir)
+    shutil.copy(os.path.join(d, "heap.hf"), crash_dir)
+    with open(os.path.join(d, "heap.wal"), "rb") as f, open(os.path.join(crash_dir, "heap.wal"), "wb") as g:
+        g.write(f.read()[:cut])
+    WriteAheadLog(os.path.join(crash_dir, "heap.wal"), heapdb.BufferPool(4)).close()
+    table = heapdb.HeapTable(os.path.join(crash_dir, "heap.hf"), SCHEMA)
+    rows = dict(table.iter_rids())
+    table.close()
+    return rows
+
+
+def test_crash_recovery(d):
+    """
+    Cutting the log off at random points has to recover exactly the transactions whose commit
+    records survived.
+    """
+    rng = random.Random(0)
+    # big enough that no page is written back, so the heap file on disk is still empty and any
+    # prefix of the log is a state we could have crashed in
+    pool = heapdb.BufferPool(256)
+    wal = WriteAheadLog(os.path.join(d, "heap.wal"), pool)
+    table = heapdb.HeapTable(os.path.join(d, "heap.hf"), SCHEMA, wal=wal)
+    oracle = {}
+    # (LSN the log ends at, committed contents) after each transaction
+    states = [(wal.end_lsn, {})]
+    for _ in random_changes(table, rng, 300, oracle):
+        states.append((wal.end_lsn, dict(oracle)))
+    assert pool.writes == 0
+    size = os.path.getsize(os.path.join(d, "heap.wal"))
+    for n, cut in enumerate(sorted(rng.sample(range(WAL_HEADER.size, size + 1), 30)) + [size]):
+        lsn = wal.base_lsn + cut - WAL_HEADER.size
+        expected = [state for end, state in states if end <= lsn][-1]
+        assert crash(d, f"crash-{n}", cut) == expected, cut
+    table.close()
+    wal.close()
+    pool.close()
+
+
+def test_write_ahead(d):
+    """
+    With a tiny pool, pages are written back all the time. Committed changes survive a crash,
+    and a transaction in progress is undone even though its pages reached the disk.
+    """
+    rng = random.Random(1)
+    pool = heapdb.BufferPool(2)
+    wal = WriteAheadLog(os.path.join(d, "heap.wal"), pool, checkpoint_bytes=64 << 10)
+    table = heapdb.HeapTable(os.path.join(d, "heap.hf"), SCHEMA, wal=wal)
+    oracle = {}
+    for _ in random_changes(table, rng, 1_000, oracle):
+        pass
+    assert pool.writes > 0 and wal.base_lsn > 0
+    assert crash(d, "committed") == oracle
+    with table.transaction():
+        table.insert((1, "uncommitted"))
+        table.delete(next(iter(oracle)))
+        pool.flush()
+        assert crash(d, "in-progress") == oracle
+    table.close()
+    wal.close()
+    pool.close()
+
+
+def main():
+    for test in (test_group_commit, test_crash_recovery, test_write_ahead):
+        with tempfile.TemporaryDirectory() as d:
+            test(d)
+    print("ok")
+
+
+if __name__ == "__main__":
+    main()